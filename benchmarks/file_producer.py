@@ -0,0 +1,72 @@
+"""
+Measures the throughput of tx_clients.utils.web.LargeFileBodyProducer against
+twisted.web.client.FileBodyProducer when sending a file from disk.
+
+Usage:
+    python benchmarks/file_producer.py [size in MiB]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer, task
+from twisted.web.client import FileBodyProducer
+
+from tx_clients.utils.web import LargeFileBodyProducer
+
+
+class NullConsumer(object):
+    """ Counts the bytes and writes it is given. See: twisted.internet.interfaces.IConsumer """
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+
+
+def make_file(size):
+    fd, path = tempfile.mkstemp(prefix='tx_clients_benchmark')
+    block = os.urandom(2 ** 20)
+    with os.fdopen(fd, 'wb') as out:
+        for _ in xrange(size):
+            out.write(block)
+    return path
+
+
+@defer.inlineCallbacks
+def measure(path, producer, repeat, **kwargs):
+    consumer = NullConsumer()
+    start = time.time()
+    for _ in xrange(repeat):
+        yield producer(open(path, 'rb'), **kwargs).startProducing(consumer)
+    elapsed = time.time() - start
+    defer.returnValue({
+        'producer': producer.__name__,
+        'options': kwargs,
+        'seconds': round(elapsed, 4),
+        'writes': consumer.writes / repeat,
+        'mb_per_second': round(consumer.bytes / elapsed / 2 ** 20, 2),
+    })
+
+
+@defer.inlineCallbacks
+def main(size):
+    path = make_file(size)
+    try:
+        for producer, options in ((FileBodyProducer, {}),
+                                  (LargeFileBodyProducer, {'readSize': 2 ** 16}),
+                                  (LargeFileBodyProducer, {}),
+                                  (LargeFileBodyProducer, {'readSize': 2 ** 22})):
+            result = yield measure(path, producer, 3, **options)
+            result['size'] = size * 2 ** 20
+            print json.dumps(result, sort_keys=True)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    task.react(lambda _: main(int(sys.argv[1]) if len(sys.argv) > 1 else 256))
@@ -0,0 +1,327 @@
+"""
+Drives BasicAgent, BasicJSONAgent and BasicFileAgent against a local
+twisted.web server on loopback and prints one json line per scenario with
+the throughput, latency percentiles and peak RSS of the client process.
+
+The server runs in a separate process so it does not share the reactor or
+the memory of the client being measured. Peak RSS is the high water mark of
+the client process, run one scenario per invocation to compare it between
+scenarios.
+
+Scenarios:
+    small: Requests per second of small GET requests, one at a time
+    fanout: Small GET requests with many requests in flight
+    download: Streamed download throughput of a large body
+    upload: Upload throughput of a large file with BasicFileAgent
+    json: Encode and decode throughput of BasicJSONAgent
+    retry: Overhead of Retry on requests which succeed, and which are
+        retried once after a 503
+
+Usage:
+    python benchmarks/http_agents.py [--seconds 5] [--size 64] [--concurrency 100] [scenario ...]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.web import resource as web_resource, server
+
+from tx_clients.clients.http import BasicAgent, BasicFileAgent, BasicJSONAgent
+from tx_clients.clients.metrics import Histogram
+from tx_clients.clients.pool import BasicConnectionPool
+from tx_clients.exceptions import ServerError
+from tx_clients.utils.retry import Retry
+
+
+BLOCK = os.urandom(2 ** 16)
+
+RECORDS = [
+    {
+        'id': i,
+        'name': u'record %d' % i,
+        'tags': ['alpha', 'beta', 'gamma'],
+        'active': i % 2 == 0,
+        'owner': {'id': i % 7, 'email': 'user%d@example.com' % i},
+    }
+    for i in xrange(1000)
+]
+
+
+class Small(web_resource.Resource):
+    isLeaf = True
+
+    def render(self, request):
+        return 'ok'
+
+
+class _BlockProducer(object):
+    """ Writes size bytes to a request one block at a time as it is resumed """
+    def __init__(self, request, size):
+        self.request = request
+        self.remaining = size
+
+    def resumeProducing(self):
+        if not self.remaining:
+            self.request.unregisterProducer()
+            self.request.finish()
+            return
+        data = BLOCK[:self.remaining]
+        self.remaining -= len(data)
+        self.request.write(data)
+
+    def stopProducing(self):
+        self.remaining = 0
+
+
+class Large(web_resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        size = int(request.args.get('size', [2 ** 20])[0])
+        request.setHeader('Content-Length', str(size))
+        request.registerProducer(_BlockProducer(request, size), False)
+        return server.NOT_DONE_YET
+
+
+class Upload(web_resource.Resource):
+    isLeaf = True
+
+    def render_POST(self, request):
+        request.content.seek(0, os.SEEK_END)
+        return str(request.content.tell())
+
+
+class Records(web_resource.Resource):
+    isLeaf = True
+
+    def __init__(self):
+        web_resource.Resource.__init__(self)
+        self.body = json.dumps(RECORDS)
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        return self.body
+
+    def render_POST(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps({'count': len(json.load(request.content))})
+
+
+class Flaky(web_resource.Resource):
+    """ Answers every other request with a 503 """
+    isLeaf = True
+
+    def __init__(self):
+        web_resource.Resource.__init__(self)
+        self.requests = 0
+
+    def render(self, request):
+        self.requests += 1
+        if self.requests % 2:
+            request.setResponseCode(503)
+            return 'unavailable'
+        return 'ok'
+
+
+def serve():
+    root = web_resource.Resource()
+    root.putChild('small', Small())
+    root.putChild('large', Large())
+    root.putChild('upload', Upload())
+    root.putChild('records', Records())
+    root.putChild('flaky', Flaky())
+    site = server.Site(root)
+    site.noisy = False
+    port = reactor.listenTCP(0, site, backlog=1024, interface='127.0.0.1')
+    print port.getHost().port
+    sys.stdout.flush()
+    reactor.run()
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+@defer.inlineCallbacks
+def drive(call, seconds, concurrency=1):
+    """
+    Calls call() from concurrency workers until seconds have passed.
+    Returns the number of calls, the elapsed seconds, the bytes each call
+    fired with and a Histogram of the latency of each call.
+    """
+    latencies = Histogram()
+    totals = {'calls': 0, 'bytes': 0}
+    start = time.time()
+    deadline = start + seconds
+
+    @defer.inlineCallbacks
+    def worker():
+        while time.time() < deadline:
+            started = time.time()
+            size = yield call()
+            latencies.record(time.time() - started)
+            totals['calls'] += 1
+            totals['bytes'] += size or 0
+
+    yield defer.gatherResults([worker() for _ in xrange(concurrency)], consumeErrors=True)
+    defer.returnValue((totals['calls'], time.time() - start, totals['bytes'], latencies))
+
+
+def report(scenario, agent, calls, elapsed, transferred, latencies, **extra):
+    result = {
+        'scenario': scenario,
+        'agent': agent,
+        'requests': calls,
+        'seconds': round(elapsed, 4),
+        'requests_per_second': round(calls / elapsed, 2),
+        'mb_per_second': round(transferred / elapsed / 2 ** 20, 2),
+        'peak_rss_kb': peak_rss_kb(),
+    }
+    for name, value in latencies.stats().iteritems():
+        if name != 'count' and value is not None:
+            result['latency_' + name] = round(value, 6)
+    result.update(extra)
+    print json.dumps(result, sort_keys=True)
+    sys.stdout.flush()
+
+
+def body_size(response):
+    return len(response.body or '')
+
+
+@defer.inlineCallbacks
+def small(base, options, pool):
+    agent = BasicAgent(reactor, pool=pool)
+    result = yield drive(lambda: agent.get(base + 'small').addCallback(body_size),
+                         options.seconds)
+    report('small', 'BasicAgent', *result)
+
+
+@defer.inlineCallbacks
+def fanout(base, options, pool):
+    agent = BasicAgent(reactor, pool=pool)
+    result = yield drive(lambda: agent.get(base + 'small').addCallback(body_size),
+                         options.seconds, options.concurrency)
+    report('fanout', 'BasicAgent', *result, concurrency=options.concurrency)
+
+
+@defer.inlineCallbacks
+def download(base, options, pool):
+    agent = BasicAgent(reactor, pool=pool)
+    uri = '{}large?size={}'.format(base, options.size * 2 ** 20)
+
+    @defer.inlineCallbacks
+    def call():
+        response = yield agent.get(uri, stream=True)
+        received = yield response.stream.each(lambda data: None)
+        defer.returnValue(received)
+    result = yield drive(call, options.seconds)
+    report('download', 'BasicAgent', *result, size=options.size * 2 ** 20)
+
+
+@defer.inlineCallbacks
+def upload(base, options, pool):
+    agent = BasicFileAgent(reactor, pool=pool)
+    fd, path = tempfile.mkstemp(prefix='tx_clients_benchmark')
+    size = options.size * 2 ** 20
+    with os.fdopen(fd, 'wb') as out:
+        for _ in xrange(size // len(BLOCK)):
+            out.write(BLOCK)
+
+    @defer.inlineCallbacks
+    def call():
+        with open(path, 'rb') as fd:
+            yield agent.post(base + 'upload', data=fd)
+        defer.returnValue(size)
+    try:
+        result = yield drive(call, options.seconds)
+    finally:
+        os.remove(path)
+    report('upload', 'BasicFileAgent', *result, size=size)
+
+
+@defer.inlineCallbacks
+def json_records(base, options, pool):
+    agent = BasicJSONAgent(reactor, pool=pool)
+    size = len(json.dumps(RECORDS))
+
+    def decode():
+        d = agent.get(base + 'records', decode=True)
+        d.addCallback(lambda _: size)
+        return d
+
+    def encode():
+        d = agent.post(base + 'records', data=RECORDS)
+        d.addCallback(lambda _: size)
+        return d
+    result = yield drive(decode, options.seconds)
+    report('json', 'BasicJSONAgent', *result, operation='decode', size=size)
+    result = yield drive(encode, options.seconds)
+    report('json', 'BasicJSONAgent', *result, operation='encode', size=size)
+
+
+@defer.inlineCallbacks
+def retry(base, options, pool):
+    agent = BasicAgent(reactor, pool=pool)
+    retried = Retry(3, (ServerError,), initialDelay=0, retryCodes=(503,))
+    retried.noisy = False
+    retried.jitter = 0
+    get = retried(agent.get)
+    result = yield drive(lambda: get(base + 'small').addCallback(body_size), options.seconds)
+    report('retry', 'BasicAgent', *result, path='small', retries=retried.stats()['retries'])
+    retried = Retry(3, (ServerError,), initialDelay=0, retryCodes=(503,))
+    retried.noisy = False
+    retried.jitter = 0
+    get = retried(agent.get)
+    result = yield drive(lambda: get(base + 'flaky').addCallback(body_size), options.seconds)
+    report('retry', 'BasicAgent', *result, path='flaky', retries=retried.stats()['retries'])
+
+
+SCENARIOS = [
+    ('small', small),
+    ('fanout', fanout),
+    ('download', download),
+    ('upload', upload),
+    ('json', json_records),
+    ('retry', retry),
+]
+
+
+@defer.inlineCallbacks
+def run(_, options):
+    process = subprocess.Popen([sys.executable, __file__, '--serve'], stdout=subprocess.PIPE)
+    try:
+        base = 'http://127.0.0.1:{}/'.format(int(process.stdout.readline()))
+        for name, scenario in SCENARIOS:
+            if options.scenarios and name not in options.scenarios:
+                continue
+            pool = BasicConnectionPool(reactor, maxPersistentPerHost=options.concurrency)
+            yield scenario(base, options, pool)
+            yield pool.closeCachedConnections()
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', choices=[[]] + [name for name, _ in SCENARIOS])
+    parser.add_argument('--seconds', type=float, default=5, help='Duration of each scenario')
+    parser.add_argument('--size', type=int, default=64, help='MiB per download and upload')
+    parser.add_argument('--concurrency', type=int, default=100, help='Requests in flight for fanout')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.serve:
+        serve()
+    else:
+        task.react(run, (options,))
+
+
+if __name__ == '__main__':
+    main()
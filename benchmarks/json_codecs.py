@@ -0,0 +1,72 @@
+"""
+Compares the encode and decode throughput of the json codecs which are
+installed. See: tx_clients.utils.codecs
+
+Usage:
+    python benchmarks/json_codecs.py
+"""
+import json
+import time
+
+from tx_clients.utils import codecs
+
+
+PAYLOADS = {
+    # A small rpc style request or response.
+    'rpc': {
+        'id': 'a3f0c2d4-5b6e-4f7a-8b9c-0d1e2f3a4b5c',
+        'method': 'update',
+        'params': {'site': 'example', 'environment': 'live', 'enabled': True, 'retries': 3},
+    },
+    # A page of records from a list api.
+    'records': [
+        {
+            'id': i,
+            'name': u'record %d' % i,
+            'tags': ['alpha', 'beta', 'gamma'],
+            'active': i % 2 == 0,
+            'score': i * 0.5,
+            'owner': {'id': i % 7, 'email': 'user%d@example.com' % i},
+        }
+        for i in xrange(1000)
+    ],
+    # A document dominated by long strings.
+    'text': {'files': [{'path': '/srv/%d.txt' % i, 'content': 'lorem ipsum ' * 500} for i in xrange(50)]},
+}
+
+
+def timed(fn, value, seconds=0.5):
+    """ Returns the number of calls per second of fn(value) """
+    calls = 0
+    start = time.time()
+    while True:
+        fn(value)
+        calls += 1
+        elapsed = time.time() - start
+        if elapsed >= seconds:
+            return calls / elapsed
+
+
+def main():
+    for shape, value in sorted(PAYLOADS.items()):
+        size = len(json.dumps(value))
+        encoded = json.dumps(value)
+        for name in codecs.available_codecs():
+            codec = codecs.get_codec(name)
+            result = {
+                'codec': name,
+                'payload': shape,
+                'size': size,
+                'dumps_mb_per_second': round(timed(codec.dumps, value) * size / 2 ** 20, 2),
+                'loads_mb_per_second': round(timed(codec.loads, encoded) * size / 2 ** 20, 2),
+            }
+            if codec.iterencode is not None:
+                iterencode = lambda v, codec=codec: ''.join(codec.iterencode(v))
+                result['iterencode_mb_per_second'] = round(
+                    timed(iterencode, value) * size / 2 ** 20, 2
+                )
+            print json.dumps(result, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
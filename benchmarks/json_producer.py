@@ -0,0 +1,74 @@
+"""
+Measures the throughput of tx_clients.utils.web.JSONBodyProducer.
+
+A chunkSize of 1 writes every fragment from json.JSONEncoder.iterencode to the
+consumer as it is produced, which is how the producer behaved before fragments
+were coalesced.
+
+Usage:
+    python benchmarks/json_producer.py
+"""
+import json
+import time
+
+from twisted.internet import defer, reactor, task
+
+from tx_clients.utils.web import JSONBodyProducer
+
+
+class NullConsumer(object):
+    """ Counts the bytes and writes it is given. See: twisted.internet.interfaces.IConsumer """
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+
+
+def payload(records):
+    return {
+        'count': records,
+        'items': [
+            {
+                'id': i,
+                'name': 'record %d' % i,
+                'tags': ['alpha', 'beta', 'gamma'],
+                'active': i % 2 == 0,
+                'score': i * 0.5,
+            }
+            for i in xrange(records)
+        ]
+    }
+
+
+@defer.inlineCallbacks
+def measure(body, repeat, **kwargs):
+    consumer = NullConsumer()
+    start = time.time()
+    for _ in xrange(repeat):
+        yield JSONBodyProducer(body, codec='json', **kwargs).startProducing(consumer)
+    elapsed = time.time() - start
+    defer.returnValue({
+        'options': kwargs,
+        'seconds': round(elapsed, 4),
+        'writes': consumer.writes / repeat,
+        'mb_per_second': round(consumer.bytes / elapsed / 2 ** 20, 2),
+    })
+
+
+@defer.inlineCallbacks
+def main():
+    for records, repeat in ((10, 500), (1000, 20), (50000, 2)):
+        body = payload(records)
+        for options in ({'chunkSize': 1}, {'chunkSize': 2 ** 14}, {'chunkSize': 2 ** 16},
+                        {'chunkSize': 2 ** 16, 'chunksPerSlice': 4}):
+            result = yield measure(body, repeat, **options)
+            result['records'] = records
+            result['size'] = len(json.dumps(body))
+            print json.dumps(result, sort_keys=True)
+
+
+if __name__ == '__main__':
+    task.react(lambda _: main())
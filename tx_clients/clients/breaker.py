@@ -0,0 +1,223 @@
+from collections import deque
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from tx_clients.clients.http import AgentWrapper
+from tx_clients.clients.scheduler import host_key
+from tx_clients.exceptions import CircuitOpenError
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the outcome of recent calls to a service.
+
+    closed: Calls are allowed. When at least minRequests of the last
+        windowSize calls have been recorded and failureRate of them failed
+        the breaker opens.
+    open: Calls are refused until resetTimeout seconds have passed. Then the
+        breaker becomes half-open.
+    half-open: Up to halfOpenRequests trial calls are allowed. The breaker
+        closes when they all succeed and opens again when one fails.
+
+    onStateChange is called with (breaker, old state, new state).
+
+    generation changes with every state change. Outcomes of calls allowed in
+    an earlier generation are ignored when it is passed to record and release.
+    """
+    def __init__(self, failureRate=0.5, minRequests=10, windowSize=100, resetTimeout=30,
+                 halfOpenRequests=1, clock=None, onStateChange=None, key=None):
+        """
+        key: Identifies the service the breaker protects
+        clock: See: twisted.internet.interfaces.IReactorTime
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.key = key
+        self.failureRate = failureRate
+        self.minRequests = minRequests
+        self.resetTimeout = resetTimeout
+        self.halfOpenRequests = halfOpenRequests
+        self.onStateChange = onStateChange
+        self.state = CLOSED
+        self.opened = 0
+        self.generation = 0
+        self._clock = clock
+        self._window = deque(maxlen=windowSize)
+        self._openedAt = None
+        self._trials = 0
+        self._successes = 0
+
+    def allow(self):
+        """ Returns True when a call may be made. The outcome MUST be recorded or released """
+        if self.state == OPEN:
+            if self._clock.seconds() < self._openedAt + self.resetTimeout:
+                return False
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._trials >= self.halfOpenRequests:
+                return False
+            self._trials += 1
+        return True
+
+    def record(self, failed, generation=None):
+        """ Record the outcome of a call allowed in generation """
+        if generation is not None and generation != self.generation:
+            return
+        if self.state == HALF_OPEN:
+            if failed:
+                self._open()
+                return
+            self._successes += 1
+            if self._successes >= self.halfOpenRequests:
+                self._transition(CLOSED)
+            return
+        if self.state == CLOSED:
+            self._window.append(failed)
+            if len(self._window) >= self.minRequests and self.failures() >= self.failureRate:
+                self._open()
+
+    def release(self, generation=None):
+        """ Forget an allowed call which finished without an outcome, e.g. it was cancelled """
+        if generation is not None and generation != self.generation:
+            return
+        if self.state == HALF_OPEN and self._trials:
+            self._trials -= 1
+
+    def failures(self):
+        """ Returns the rate of failures in the window """
+        if not self._window:
+            return 0.0
+        return float(sum(self._window)) / len(self._window)
+
+    def _open(self):
+        self.opened += 1
+        self._openedAt = self._clock.seconds()
+        self._transition(OPEN)
+
+    def _transition(self, state):
+        old, self.state = self.state, state
+        self.generation += 1
+        self._trials = 0
+        self._successes = 0
+        if state == CLOSED:
+            self._window.clear()
+        if old != state and self.onStateChange is not None:
+            self.onStateChange(self, old, state)
+
+
+class CircuitBreakerAgent(AgentWrapper):
+    """
+    See: AgentWrapper
+
+    Keeps a CircuitBreaker per host:port. While the breaker for a host is open
+    requests fail immediately with tx_clients.exceptions.CircuitOpenError
+    instead of waiting for a doomed connection or response.
+
+    A request fails when it errbacks, when the response has a status code of
+    500 or more, or when it takes longer than slowRequestDuration seconds.
+    Cancelled requests are not recorded, nor are requests which finish after
+    the breaker changed state.
+
+    Hooks added with addStateChangeHook are called with (host key, old state,
+    new state) whenever a breaker changes state so load can be shed upstream.
+
+    Usage:
+        agent = CircuitBreakerAgent(BasicAgent(reactor), failureRate=0.5, resetTimeout=10)
+        agent.addStateChangeHook(lambda key, old, new: log.warn(...))
+        d = agent.get(url)
+    """
+    failureCode = 500
+
+    def __init__(self, agent, failureRate=0.5, minRequests=10, windowSize=100, resetTimeout=30,
+                 halfOpenRequests=1, slowRequestDuration=None, clock=None):
+        """
+        agent: The BasicAgent or AgentWrapper which performs the requests
+        failureRate: Rate of failed requests in the window which opens the breaker
+        minRequests: Requests recorded in the window before the breaker may open
+        windowSize: Number of recent requests considered per host
+        resetTimeout: Seconds a breaker stays open before trial requests are allowed
+        halfOpenRequests: Trial requests which must succeed to close the breaker
+        slowRequestDuration: Requests slower than this many seconds count as
+            failures. None disables the latency threshold.
+        clock: See: twisted.internet.interfaces.IReactorTime
+        """
+        AgentWrapper.__init__(self, agent)
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.failureRate = failureRate
+        self.minRequests = minRequests
+        self.windowSize = windowSize
+        self.resetTimeout = resetTimeout
+        self.halfOpenRequests = halfOpenRequests
+        self.slowRequestDuration = slowRequestDuration
+        self._clock = clock
+        self._breakers = {}
+        self._hooks = []
+        self.rejected = 0
+
+    def addStateChangeHook(self, hook):
+        """ Call hook with (host key, old state, new state) when a breaker changes state """
+        self._hooks.append(hook)
+
+    def breaker(self, uri):
+        """ Returns the CircuitBreaker for the host:port of uri """
+        key = host_key(uri)
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = self._breakers[key] = CircuitBreaker(
+                self.failureRate, self.minRequests, self.windowSize, self.resetTimeout,
+                self.halfOpenRequests, self._clock, self._stateChanged, key
+            )
+        return breaker
+
+    def request(self, method, uri, headers=None, data=None, **kwargs):
+        """ See: BasicAgent.request """
+        breaker = self.breaker(uri)
+        if not breaker.allow():
+            self.rejected += 1
+            scheme, host, port = breaker.key
+            return defer.fail(CircuitOpenError(
+                'Circuit open for {}://{}:{}'.format(scheme, host, port)
+            ))
+        d = defer.maybeDeferred(self.agent.request, method, uri, headers, data, **kwargs)
+        d.addBoth(self._record, breaker, breaker.generation, self._clock.seconds())
+        return d
+
+    def stats(self):
+        """
+        Returns a dictionary describing the breakers.
+
+        rejected: Requests refused while a breaker was open
+        opened: Number of times a breaker opened
+        states: The state of the breaker for each host key
+        """
+        return {
+            'rejected': self.rejected,
+            'opened': sum(breaker.opened for breaker in self._breakers.itervalues()),
+            'states': dict((key, breaker.state) for key, breaker in self._breakers.iteritems()),
+        }
+
+    def _failed(self, result, started):
+        if isinstance(result, failure.Failure):
+            return True
+        if getattr(result, 'code', None) >= self.failureCode:
+            return True
+        return (self.slowRequestDuration is not None and
+                self._clock.seconds() - started > self.slowRequestDuration)
+
+    def _record(self, result, breaker, generation, started):
+        if isinstance(result, failure.Failure) and result.check(defer.CancelledError):
+            breaker.release(generation)
+        else:
+            breaker.record(self._failed(result, started), generation)
+        return result
+
+    def _stateChanged(self, breaker, old, new):
+        for hook in self._hooks:
+            hook(breaker.key, old, new)
@@ -0,0 +1,170 @@
+# pylint: disable=redefined-builtin
+from twisted.internet import defer
+from twisted.python import failure
+
+
+class _Bulk(object):
+    """ Feeds requests from an iterator to an agent keeping up to concurrency in flight """
+    def __init__(self, agent, requests, callback, concurrency, ordered, kwargs):
+        self.agent = agent
+        self.requests = iter(requests)
+        self.callback = callback
+        self.concurrency = concurrency
+        self.ordered = ordered
+        self.kwargs = kwargs
+        self.deferred = defer.Deferred(self._cancel)
+        self.running = {}
+        self.completed = {}
+        self.index = 0
+        self.nextIndex = 0
+        self.busy = 0
+        self.exhausted = False
+        self.failure = None
+        self.feeding = False
+
+    def feed(self):
+        if self.feeding:
+            # Completions during the loop are picked up by the loop.
+            return
+        self.feeding = True
+        try:
+            while not self.exhausted and self.failure is None and self.busy < self.concurrency:
+                try:
+                    request = next(self.requests)
+                except StopIteration:
+                    self.exhausted = True
+                    break
+                except Exception:  # pylint: disable=broad-except
+                    self.abort(failure.Failure())
+                    break
+                self.send(request)
+        finally:
+            self.feeding = False
+        self.checkDone()
+
+    def send(self, request):
+        index = self.index
+        self.index += 1
+        self.busy += 1
+        method, uri = request[:2]
+        headers = request[2] if len(request) > 2 else None
+        data = request[3] if len(request) > 3 else None
+        d = defer.maybeDeferred(self.agent.request, method, uri, headers, data, **self.kwargs)
+        self.running[index] = d
+        d.addBoth(self.cbResult, index)
+
+    def cbResult(self, result, index):
+        del self.running[index]
+        if self.failure is not None:
+            self.busy -= 1
+            self.checkDone()
+            return None
+        if not self.ordered:
+            self.deliver(index, result)
+            return None
+        self.completed[index] = result
+        while self.nextIndex in self.completed and self.failure is None:
+            index = self.nextIndex
+            self.nextIndex += 1
+            self.deliver(index, self.completed.pop(index))
+        return None
+
+    def deliver(self, index, result):
+        try:
+            d = self.callback(index, result)
+        except Exception:  # pylint: disable=broad-except
+            self.busy -= 1
+            self.abort(failure.Failure())
+            return
+        if isinstance(d, defer.Deferred):
+            d.addCallbacks(self.cbDelivered, self.ebDelivered)
+        else:
+            self.cbDelivered(None)
+
+    def cbDelivered(self, _):
+        self.busy -= 1
+        self.feed()
+
+    def ebDelivered(self, reason):
+        self.busy -= 1
+        self.abort(reason)
+
+    def abort(self, reason):
+        """ Stop the batch. In flight requests are cancelled """
+        if self.failure is None:
+            self.failure = reason
+            # Results held for ordering are dropped.
+            self.busy -= len(self.completed)
+            self.completed.clear()
+            for d in self.running.values():
+                d.cancel()
+        self.checkDone()
+
+    def checkDone(self):
+        if self.deferred.called or self.busy or self.running:
+            return
+        if self.failure is not None:
+            self.deferred.errback(self.failure)
+        elif self.exhausted:
+            self.deferred.callback(self.index)
+
+    def _cancel(self, _):
+        self.abort(failure.Failure(defer.CancelledError()))
+
+
+def imap(agent, requests, callback, concurrency=10, ordered=False, **kwargs):
+    """
+    Makes a request for every item of requests keeping up to concurrency
+    requests in flight and calls callback(index, result) with each result.
+    index is the position of the item in requests. result is the response
+    or the Failure of the request, a failed request does not stop the batch.
+
+    Items are (method, uri), (method, uri, headers) or (method, uri, headers,
+    data) tuples. They are taken from requests only when a request may be
+    sent, so a generator can describe a batch of any size with bounded memory.
+
+    Results are passed to callback as they complete. With ordered=True they
+    are passed in the order of requests. Results which complete early are
+    held and count towards concurrency until they are passed on.
+
+    When callback returns a Deferred no more requests are sent for its slot
+    until it fires. If callback raises, or its Deferred fails, the batch stops,
+    requests in flight are cancelled and the returned Deferred fails.
+
+    Returns a Deferred which fires with the number of requests made once every
+    result has been passed to callback. Cancelling it stops the batch.
+
+    agent: A BasicAgent or AgentWrapper
+    kwargs: See: BasicAgent.request
+
+    Usage:
+        def cbResult(index, result):
+            if isinstance(result, Failure):
+                print index, result.getErrorMessage()
+            else:
+                return store(result.json)
+        requests = (('GET', '{}/items/{}'.format(url, id)) for id in ids)
+        d = agent.imap(requests, cbResult, concurrency=50, decode=True)
+    """
+    bulk = _Bulk(agent, requests, callback, concurrency, ordered, kwargs)
+    bulk.feed()
+    return bulk.deferred
+
+
+def map(agent, requests, concurrency=10, **kwargs):
+    """
+    Returns a Deferred which fires with a list of the result of each of
+    requests, in the order of requests, once every request is complete. A
+    result is the response or the Failure of the request. See: imap
+
+    Usage:
+        results = yield agent.map([('GET', url_a), ('GET', url_b)], concurrency=2)
+    """
+    results = []
+
+    def cbResult(index, result):
+        results.extend([None] * (index + 1 - len(results)))
+        results[index] = result
+    d = imap(agent, requests, cbResult, concurrency, **kwargs)
+    d.addCallback(lambda _: results)
+    return d
@@ -0,0 +1,251 @@
+from collections import OrderedDict
+
+from twisted.internet import defer
+from twisted.web.http_headers import Headers
+
+from tx_clients.clients.coalesce import request_key
+from tx_clients.clients.http import AgentWrapper
+
+
+CACHEABLE_CODES = frozenset([200, 203, 300, 301, 410])
+
+
+def cache_control(headers):
+    """ Returns the Cache-Control directives of headers as a dictionary """
+    directives = {}
+    for value in headers.getRawHeaders('Cache-Control', []):
+        for directive in value.split(','):
+            name, _, argument = directive.strip().partition('=')
+            if name:
+                directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def _response_size(response):
+    """ Returns the bytes held by the body and headers of response """
+    size = len(response.body or '')
+    for name, values in response.headers.getAllRawHeaders():
+        size += len(name) + sum(len(value) for value in values)
+    return size
+
+
+class _CacheEntry(object):
+    def __init__(self, response, expires, size):
+        self.response = response
+        self.expires = expires
+        self.size = size
+        self.etag = None
+        self.lastModified = None
+        self.updateValidators()
+
+    def updateValidators(self):
+        headers = self.response.headers
+        self.etag = headers.getRawHeaders('ETag', [None])[0]
+        self.lastModified = headers.getRawHeaders('Last-Modified', [None])[0]
+
+    @property
+    def validatable(self):
+        return self.etag is not None or self.lastModified is not None
+
+
+class ResponseCache(object):
+    """
+    An in memory least recently used cache of responses bounded by the total
+    size of the cached bodies and headers and by the number of entries.
+
+    Usage:
+        cache = ResponseCache(maxBytes=2 ** 24)
+        agent = CachingAgent(BasicAgent(reactor), cache=cache)
+    """
+    maxBytes = 2 ** 26
+    maxEntries = None
+
+    def __init__(self, maxBytes=None, maxEntries=None):
+        """
+        maxBytes: Maximum number of bytes held by the cache
+        maxEntries: Maximum number of cached responses. None is unbounded.
+        """
+        if maxBytes is not None:
+            self.maxBytes = maxBytes
+        if maxEntries is not None:
+            self.maxEntries = maxEntries
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ Returns the entry for key and marks it as recently used or None """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._entries[key] = entry
+        return entry
+
+    def put(self, key, entry):
+        """ Stores entry for key. Entries larger than the cache are not stored """
+        self.remove(key)
+        if entry.size > self.maxBytes:
+            return
+        self._entries[key] = entry
+        self.bytes += entry.size
+        while self.bytes > self.maxBytes or (
+                self.maxEntries is not None and len(self._entries) > self.maxEntries):
+            _, evicted = self._entries.popitem(False)
+            self.bytes -= evicted.size
+            self.evicted += 1
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+
+class CachingAgent(AgentWrapper):
+    """
+    See: AgentWrapper
+
+    Caches the responses to GET requests in a ResponseCache following the
+    Cache-Control max-age, no-cache and no-store directives of the response.
+
+    Fresh responses are returned from the cache without a request. Stale
+    responses with an ETag or Last-Modified header are revalidated with a
+    conditional request and the cached body is reused when the server answers
+    304 Not Modified. Responses with validators but no max-age are always
+    revalidated.
+
+    Every caller receives its own copy of the cached BasicResponse.
+    See: BasicResponse.clone
+
+    Requests with a body and streamed requests are never cached.
+
+    Usage:
+        agent = CachingAgent(BasicJSONAgent(reactor), maxBytes=2 ** 24)
+        response = yield agent.get(url, decode=True)
+        print agent.stats()
+    """
+    def __init__(self, agent, cache=None, maxBytes=None, clock=None):
+        """
+        agent: The BasicAgent or AgentWrapper which performs the requests
+        cache: A ResponseCache which may be shared between agents. When given
+            maxBytes is ignored.
+        maxBytes: Maximum number of bytes held by the cache
+        clock: See: twisted.internet.interfaces.IReactorTime
+        """
+        AgentWrapper.__init__(self, agent)
+        if clock is None:
+            from twisted.internet import reactor as clock
+        if cache is None:
+            cache = ResponseCache(maxBytes)
+        self.cache = cache
+        self._clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stored = 0
+
+    def request(self, method, uri, headers=None, data=None, **kwargs):
+        """ See: BasicAgent.request """
+        if method != 'GET' or data is not None or kwargs.get('stream'):
+            return self.agent.request(method, uri, headers, data, **kwargs)
+        try:
+            key = request_key(method, uri, headers, kwargs)
+            entry = self.cache.get(key)
+        except TypeError:
+            # Options which can not be hashed are never cached.
+            return self.agent.request(method, uri, headers, data, **kwargs)
+
+        if entry is not None and self._clock.seconds() < entry.expires:
+            self.hits += 1
+            return defer.succeed(entry.response.clone())
+
+        if entry is not None and entry.validatable:
+            conditional = headers.copy() if headers is not None else Headers()
+            if entry.etag is not None:
+                conditional.setRawHeaders('If-None-Match', [entry.etag])
+            if entry.lastModified is not None:
+                conditional.setRawHeaders('If-Modified-Since', [entry.lastModified])
+            d = self.agent.request(method, uri, conditional, data, **kwargs)
+            d.addCallback(self._cbRevalidated, key, entry)
+            return d
+
+        self.misses += 1
+        d = self.agent.request(method, uri, headers, data, **kwargs)
+        d.addCallback(self._cbStore, key)
+        return d
+
+    def stats(self):
+        """
+        Returns a dictionary describing the cache.
+
+        hits: Requests answered from the cache without a request
+        misses: Requests sent without a cached response
+        revalidated: Stale responses reused after a 304 Not Modified
+        stored: Responses added to the cache
+        evicted: Responses evicted to stay within the cache bounds
+        entries: Responses in the cache
+        bytes: Bytes held by the cache
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidated': self.revalidated,
+            'stored': self.stored,
+            'evicted': self.cache.evicted,
+            'entries': len(self.cache),
+            'bytes': self.cache.bytes,
+        }
+
+    def _expires(self, response):
+        """ Returns when response becomes stale or None if it must not be cached """
+        if response.code not in CACHEABLE_CODES or response.headers is None:
+            return None
+        directives = cache_control(response.headers)
+        if 'no-store' in directives:
+            return None
+        now = self._clock.seconds()
+        if 'no-cache' in directives:
+            return now
+        try:
+            return now + int(directives['max-age'])
+        except (KeyError, TypeError, ValueError):
+            return now
+
+    def _entry(self, response, expires):
+        return _CacheEntry(response.clone(), expires, _response_size(response))
+
+    def _cbStore(self, response, key):
+        expires = self._expires(response)
+        if expires is None:
+            return response
+        entry = self._entry(response, expires)
+        if expires > self._clock.seconds() or entry.validatable:
+            self.cache.put(key, entry)
+            self.stored += 1
+        return response
+
+    def _cbRevalidated(self, response, key, entry):
+        if response.code != 304:
+            self.misses += 1
+            self.cache.remove(key)
+            return self._cbStore(response, key)
+        self.revalidated += 1
+        cached = entry.response
+        # The entry is stored again with the size of the merged headers.
+        self.cache.remove(key)
+        # The 304 carries the current caching headers for the cached response.
+        for name, values in response.headers.getAllRawHeaders():
+            if name.lower() not in ('content-length', 'transfer-encoding'):
+                cached.headers.setRawHeaders(name, values)
+        entry.updateValidators()
+        expires = self._expires(cached)
+        if expires is not None:
+            entry.expires = expires
+            entry.size = _response_size(cached)
+            self.cache.put(key, entry)
+        return cached.clone()
@@ -0,0 +1,120 @@
+from twisted.internet import defer
+
+from tx_clients.clients.http import AgentWrapper
+
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+def request_key(method, uri, headers, kwargs):
+    """ Returns a hashable key which identifies identical requests """
+    raw = ()
+    if headers is not None:
+        raw = tuple(sorted(
+            (name.lower(), tuple(values)) for name, values in headers.getAllRawHeaders()
+        ))
+    return (method, uri, raw, tuple(sorted(kwargs.iteritems())))
+
+
+class _InFlight(object):
+    def __init__(self):
+        self.deferred = None
+        self.waiters = []
+
+
+class CoalescingAgent(AgentWrapper):
+    """
+    See: AgentWrapper
+
+    Concurrent identical requests with an idempotent method share a single
+    request (single flight). A request is identical when the method, uri,
+    headers and options match. Every caller receives its own copy of the
+    BasicResponse. See: BasicResponse.clone
+
+    Requests with a body, streamed requests and requests with other methods
+    are always sent.
+
+    Cancelling a caller's Deferred only cancels the shared request once every
+    caller waiting on it has cancelled.
+
+    Usage:
+        agent = CoalescingAgent(BasicAgent(reactor))
+        first = agent.get(url)
+        second = agent.get(url)  # Shares the request made for first
+        print agent.deduplicated
+    """
+    methods = IDEMPOTENT_METHODS
+
+    def __init__(self, agent, methods=None):
+        """
+        agent: The BasicAgent or AgentWrapper which performs the requests
+        methods: The HTTP verbs which may be coalesced
+        """
+        AgentWrapper.__init__(self, agent)
+        if methods is not None:
+            self.methods = frozenset(methods)
+        self._inflight = {}
+        self.requests = 0
+        self.deduplicated = 0
+
+    def request(self, method, uri, headers=None, data=None, **kwargs):
+        """ See: BasicAgent.request """
+        self.requests += 1
+        if method not in self.methods or data is not None or kwargs.get('stream'):
+            return self.agent.request(method, uri, headers, data, **kwargs)
+        try:
+            key = request_key(method, uri, headers, kwargs)
+            inflight = self._inflight.get(key)
+        except TypeError:
+            # Options which can not be hashed are never coalesced.
+            return self.agent.request(method, uri, headers, data, **kwargs)
+
+        if inflight is not None:
+            self.deduplicated += 1
+            return self._wait(key, inflight)
+
+        inflight = self._inflight[key] = _InFlight()
+        # The waiter is registered first in case the request fires synchronously.
+        waiter = self._wait(key, inflight)
+        inflight.deferred = self.agent.request(method, uri, headers, data, **kwargs)
+        inflight.deferred.addBoth(self._cbDeliver, key, inflight)
+        return waiter
+
+    def stats(self):
+        """
+        Returns a dictionary describing the agent.
+
+        requests: Total requests made through the agent
+        deduplicated: Requests which shared another request instead of being sent
+        inflight: Shared requests currently in flight
+        """
+        return {
+            'requests': self.requests,
+            'deduplicated': self.deduplicated,
+            'inflight': len(self._inflight),
+        }
+
+    def _wait(self, key, inflight):
+        waiter = defer.Deferred(lambda d: self._cancel(d, key, inflight))
+        inflight.waiters.append(waiter)
+        return waiter
+
+    def _cbDeliver(self, result, key, inflight):
+        if self._inflight.get(key) is inflight:
+            del self._inflight[key]
+        waiters, inflight.waiters = inflight.waiters, []
+        for waiter in waiters:
+            if hasattr(result, 'clone'):
+                waiter.callback(result.clone())
+            else:
+                waiter.callback(result)
+        # Waiters received their own copy of the result.
+        return None
+
+    def _cancel(self, waiter, key, inflight):
+        if waiter in inflight.waiters:
+            inflight.waiters.remove(waiter)
+        if not inflight.waiters:
+            if self._inflight.get(key) is inflight:
+                del self._inflight[key]
+            inflight.deferred.cancel()
@@ -0,0 +1,332 @@
+import os
+
+from twisted.internet import defer
+from twisted.internet.error import ConnectError
+from twisted.web.client import ResponseFailed, ResponseNeverReceived, UNKNOWN_LENGTH
+from twisted.web.http_headers import Headers
+
+from tx_clients.exceptions import ClientError, ResponseError, TimeoutError
+from tx_clients.utils.retry import Retry
+
+
+PART_SUFFIX = '.part'
+
+
+class _FileSink(object):
+    """ Writes a downloaded body to a path, through a .part file, or to a file object """
+    def __init__(self, target, resume):
+        self.written = 0
+        self.offset = 0
+        if isinstance(target, basestring):
+            self.path = target
+            self.partPath = target + PART_SUFFIX
+            self.file = None
+            if resume and os.path.exists(self.partPath):
+                self.offset = os.path.getsize(self.partPath)
+        else:
+            self.path = None
+            self.partPath = None
+            self.file = target
+
+    def open(self, append):
+        if not append:
+            self.offset = 0
+        if self.partPath is not None:
+            self.file = open(self.partPath, 'ab' if append else 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+        self.written += len(data)
+
+    def commit(self, fsync):
+        self.file.flush()
+        if fsync and (self.partPath is not None or hasattr(self.file, 'fileno')):
+            # File objects which are not backed by a file, e.g. StringIO, are not synced
+            os.fsync(self.file.fileno())
+        if self.partPath is None:
+            return
+        self.file.close()
+        os.rename(self.partPath, self.path)
+        if fsync:
+            # Persist the rename
+            directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+    def close(self):
+        """ Close a .part file. It is kept so the download may be resumed """
+        if self.partPath is not None and self.file is not None:
+            self.file.close()
+
+    def remove(self):
+        """ Close and remove a .part file """
+        self.close()
+        if self.partPath is not None and os.path.exists(self.partPath):
+            os.remove(self.partPath)
+
+
+def _content_range_total(response):
+    """ Returns the complete length from a Content-Range header or None """
+    value = response.headers.getRawHeaders('Content-Range', [''])[0]
+    _, _, total = value.partition('/')
+    try:
+        return int(total)
+    except ValueError:
+        return None
+
+
+def _content_range_start(response):
+    """ Returns the first byte position from a Content-Range header or None """
+    value = response.headers.getRawHeaders('Content-Range', [''])[0]
+    _, _, positions = value.partition(' ')
+    try:
+        return int(positions.partition('-')[0])
+    except ValueError:
+        return None
+
+
+def download(agent, uri, target, headers=None, fsync=True, resume=False, **kwargs):
+    """
+    Returns a Deferred which fires with a BasicResponse once the body of uri
+    has been written to target. The body is written as it arrives so memory
+    use does not grow with the size of the body. The response carries the path
+    written to and the number of bytes in the file as length instead of the
+    body.
+
+    When target is a path the body is written to path + '.part' which is
+    renamed to path once the whole body has been received. A failed download
+    leaves the .part file behind. With resume=True an existing .part file is
+    continued with a Range request. Servers which do not answer 206 Partial
+    Content restart the download from the beginning. A 206 response whose
+    Content-Range does not start at the end of the .part file is discarded
+    and the whole body is requested again.
+
+    Responses which are not 2xx are not written to target. Their body is
+    attached to the response as usual.
+
+    The body MUST match the Content-Length of the response or the download
+    fails with tx_clients.exceptions.ResponseError.
+
+    agent: A BasicAgent or AgentWrapper
+    target: A path or a file object opened for writing
+    fsync: fsync the file, and the directory after the rename, when complete.
+        File objects without a fileno are only flushed.
+    resume: Continue an existing .part file
+    kwargs: See: BasicAgent.request
+
+    Usage:
+        response = yield download(agent, url, '/tmp/artifact.tar.gz')
+        print response.path, response.length
+    """
+    sink = _FileSink(target, resume)
+    headers = headers.copy() if headers is not None else Headers()
+    if sink.offset:
+        headers.setRawHeaders('Range', ['bytes={}-'.format(sink.offset)])
+    kwargs['stream'] = True
+
+    def cbResponse(response):
+        if sink.offset and response.code == 416 and _content_range_total(response) == sink.offset:
+            # The .part file is already complete.
+            if response.stream is not None:
+                response.stream.stop()
+            sink.open(append=True)
+            return cbWritten(response)
+        if not 200 <= response.code < 300:
+            return cbBuffer(response)
+        if (sink.offset and response.code == 206 and
+                _content_range_start(response) != sink.offset):
+            # Appending a misaligned range would corrupt the file.
+            if response.stream is not None:
+                response.stream.stop()
+            sink.offset = 0
+            headers.removeHeader('Range')
+            return send()
+        sink.open(append=bool(sink.offset) and response.code == 206)
+        if response.stream is None:
+            return cbWritten(response)
+        d = response.stream.each(sink.write)
+        d.addCallback(lambda _: cbWritten(response))
+        d.addErrback(ebWrite)
+        return d
+
+    def cbBuffer(response):
+        if response.stream is None:
+            return response
+        chunks = []
+        d = response.stream.each(chunks.append)
+        d.addCallback(lambda _: response.cbAttachBody(''.join(chunks)))
+        return d
+
+    def cbWritten(response):
+        expected = response.length
+        if response.code == 416 or response.contentEncoding is not None:
+            expected = UNKNOWN_LENGTH
+        if expected is not UNKNOWN_LENGTH and sink.written != expected:
+            sink.close()
+            raise ResponseError('Expected {} bytes, received {}'.format(expected, sink.written))
+        sink.commit(fsync)
+        response.path = sink.path
+        response.length = sink.offset + sink.written
+        return response
+
+    def ebWrite(reason):
+        sink.close()
+        return reason
+
+    def send():
+        d = agent.request('GET', uri, headers, **kwargs)
+        d.addCallback(cbResponse)
+        return d
+
+    return send()
+
+
+# Failures which are retried per segment by default
+SEGMENT_FAILURES = (
+    ConnectError, ResponseError, ResponseFailed, ResponseNeverReceived, TimeoutError
+)
+
+
+class _RangeIgnored(Exception):
+    """ The server answered a range request with the whole body """
+
+
+class _Segment(object):
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.written = 0
+
+    @property
+    def remaining(self):
+        return self.end - self.start + 1 - self.written
+
+
+def _segments(length, count, minSegmentSize):
+    """ Splits length bytes into at most count segments of at least minSegmentSize bytes """
+    size = max(minSegmentSize, -(-length // count), 1)
+    return [_Segment(start, min(start + size, length) - 1) for start in xrange(0, length, size)]
+
+
+def _content_length(response):
+    try:
+        return int(response.headers.getRawHeaders('Content-Length')[0])
+    except (TypeError, ValueError):
+        return None
+
+
+def segmented_download(agent, uri, path, headers=None, fsync=True, segments=4,
+                       minSegmentSize=2 ** 22, retry=None, **kwargs):
+    """
+    Returns a Deferred which fires with a BasicResponse once the body of uri
+    has been written to path. See: download
+
+    A HEAD request finds the length of the body and whether the server accepts
+    byte ranges. The body is then fetched as up to segments byte ranges of at
+    least minSegmentSize bytes concurrently, each over its own pooled
+    connection, and written in place into path + '.part'. Once every segment is
+    complete the file is fsynced and renamed to path.
+
+    A segment which fails is retried from where it stopped with retry, a
+    tx_clients.utils.retry.Retry. By default segments are retried 3 times on
+    SEGMENT_FAILURES. When any segment fails for good the other segments are
+    cancelled and the .part file is removed.
+
+    Servers which do not advertise Accept-Ranges: bytes, bodies too small to
+    split and servers which answer a range request with the whole body fall
+    back to a single streamed download.
+
+    agent: A BasicAgent or AgentWrapper
+    path: The path the body is written to
+    segments: Maximum number of concurrent range requests
+    minSegmentSize: Minimum number of bytes per range request
+    retry: A Retry which decorates the request for each segment
+    kwargs: See: BasicAgent.request
+
+    Usage:
+        response = yield segmented_download(agent, url, '/tmp/artifact.tar.gz', segments=8)
+        print response.path, response.length
+    """
+    if not isinstance(path, basestring):
+        raise ClientError('Segmented downloads must be written to a path')
+    if retry is None:
+        retry = Retry(3, SEGMENT_FAILURES, maxDelay=30)
+    headers = headers.copy() if headers is not None else Headers()
+    sink = _FileSink(path, False)
+    running = []
+    failed = []
+
+    def fallback():
+        return download(agent, uri, path, headers, fsync, **kwargs)
+
+    def cbHead(head):
+        length = _content_length(head)
+        ranges = head.headers.getRawHeaders('Accept-Ranges', [''])[0].lower()
+        if (head.code != 200 or 'bytes' not in ranges or length is None or
+                length < 2 * minSegmentSize):
+            return fallback()
+        sink.open(append=False)
+        sink.file.truncate(length)
+        for segment in _segments(length, segments, minSegmentSize):
+            running.append(retry(fetch)(segment))
+        d = defer.DeferredList(running, fireOnOneErrback=True, consumeErrors=True)
+        d.addCallbacks(cbComplete, ebSegment, callbackArgs=(head, length))
+        return d
+
+    def fetch(segment):
+        if failed:
+            return defer.fail(defer.CancelledError())
+        offset = segment.start + segment.written
+        segmentHeaders = headers.copy()
+        segmentHeaders.setRawHeaders('Range', ['bytes={}-{}'.format(offset, segment.end)])
+        d = agent.request('GET', uri, segmentHeaders, stream=True, **kwargs)
+        d.addCallback(cbSegment, segment, offset)
+        return d
+
+    def cbSegment(response, segment, offset):
+        if response.code != 206 or _content_range_start(response) != offset:
+            if response.stream is not None:
+                response.stream.stop()
+            if response.code == 200:
+                raise _RangeIgnored()
+            raise ResponseError('Unexpected response {} to a range request'.format(response.code))
+
+        def write(data):
+            if failed:
+                raise defer.CancelledError()
+            if len(data) > segment.remaining:
+                raise ResponseError('Segment exceeded the requested range')
+            sink.file.seek(segment.start + segment.written)
+            sink.file.write(data)
+            segment.written += len(data)
+
+        def cbWritten(_):
+            if segment.remaining:
+                raise ResponseError('Segment truncated with {} bytes remaining'.format(
+                    segment.remaining
+                ))
+        d = response.stream.each(write)
+        d.addCallback(cbWritten)
+        return d
+
+    def cbComplete(_, head, length):
+        sink.commit(fsync)
+        head.path = path
+        head.length = length
+        return head
+
+    def ebSegment(reason):
+        failed.append(reason)
+        for d in running:
+            d.cancel()
+        sink.remove()
+        reason = reason.value.subFailure
+        if reason.check(_RangeIgnored):
+            return fallback()
+        return reason
+
+    d = agent.request('HEAD', uri, headers, **kwargs)
+    d.addCallback(cbHead)
+    return d
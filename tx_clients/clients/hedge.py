@@ -0,0 +1,160 @@
+import bisect
+from collections import deque
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from tx_clients.clients.coalesce import IDEMPOTENT_METHODS
+from tx_clients.clients.http import AgentWrapper
+
+
+class _HedgedRequest(object):
+    """ A request which may be sent a second time. The first response wins """
+    def __init__(self, hedging, args, kwargs, delay):
+        self.hedging = hedging
+        self.args = args
+        self.kwargs = kwargs
+        self.deferred = defer.Deferred(self._cancel)
+        self.attempts = []
+        self.timer = None
+        self.finished = False
+        self.startedAt = hedging._clock.seconds()
+        self._send(False)
+        if delay is not None and not self.finished:
+            self.timer = hedging._clock.callLater(delay, self._hedge)
+
+    def _send(self, hedge):
+        d = self.hedging.agent.request(*self.args, **self.kwargs)
+        self.attempts.append(d)
+        d.addBoth(self._cbAttempt, d, hedge)
+
+    def _hedge(self):
+        self.timer = None
+        if self.hedging._mayHedge():
+            self.hedging.hedged += 1
+            self._send(True)
+
+    def _cbAttempt(self, result, d, hedge):
+        self.attempts.remove(d)
+        if self.finished:
+            # The loser. Its result, usually a CancelledError, is discarded.
+            return None
+        if isinstance(result, failure.Failure) and self.attempts:
+            # Wait for the other attempt.
+            return None
+        if not isinstance(result, failure.Failure):
+            # The latency seen by the caller, from when the request was first sent
+            self.hedging._record(self.hedging._clock.seconds() - self.startedAt)
+            if hedge:
+                self.hedging.won += 1
+        self._finish()
+        self.deferred.callback(result)
+        return None
+
+    def _finish(self):
+        self.finished = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for attempt in list(self.attempts):
+            attempt.cancel()
+
+    def _cancel(self, _):
+        self._finish()
+
+
+class HedgingAgent(AgentWrapper):
+    """
+    See: AgentWrapper
+
+    Sends a second identical request for an idempotent request which has not
+    been answered within a delay. The first response wins and the other
+    request is cancelled. This trims the latency added by an occasional slow
+    backend.
+
+    The delay is a fixed number of seconds or a percentile of the latency of
+    recent responses, e.g. 0.95 hedges the slowest 5% of requests. Until
+    minSamples responses have been seen the fixed delay is used.
+
+    At most maxHedgeRate of the requests made through the agent are hedged.
+
+    Requests with a body and methods which are not idempotent are never hedged.
+    A request which fails while the other is in flight waits for the other.
+
+    Usage:
+        agent = HedgingAgent(BasicAgent(reactor), percentile=0.95, maxHedgeRate=0.05)
+        d = agent.get(url)
+        print agent.stats()
+    """
+    methods = IDEMPOTENT_METHODS
+
+    def __init__(self, agent, delay=None, percentile=None, maxHedgeRate=0.1, windowSize=1000,
+                 minSamples=20, methods=None, clock=None):
+        """
+        agent: The BasicAgent or AgentWrapper which performs the requests
+        delay: Seconds to wait before hedging. None does not hedge until the
+            percentile is known.
+        percentile: Hedge requests slower than this percentile of recent
+            latencies. None always uses the fixed delay.
+        maxHedgeRate: Maximum ratio of hedged requests to requests
+        windowSize: Number of recent latencies the percentile is taken from
+        minSamples: Latencies required before the percentile is used
+        methods: The HTTP verbs which may be hedged
+        clock: See: twisted.internet.interfaces.IReactorTime
+        """
+        AgentWrapper.__init__(self, agent)
+        if clock is None:
+            from twisted.internet import reactor as clock
+        if methods is not None:
+            self.methods = frozenset(methods)
+        self.delay = delay
+        self.percentile = percentile
+        self.maxHedgeRate = maxHedgeRate
+        self.minSamples = minSamples
+        self._clock = clock
+        self._windowSize = windowSize
+        # The latencies in the window by arrival, for eviction, and sorted
+        self._latencies = deque()
+        self._sorted = []
+        self.requests = 0
+        self.hedged = 0
+        self.won = 0
+
+    def request(self, method, uri, headers=None, data=None, **kwargs):
+        """ See: BasicAgent.request """
+        self.requests += 1
+        if method not in self.methods or data is not None:
+            return self.agent.request(method, uri, headers, data, **kwargs)
+        hedged = _HedgedRequest(self, (method, uri, headers, data), kwargs, self.hedgeDelay())
+        return hedged.deferred
+
+    def hedgeDelay(self):
+        """ Returns the seconds to wait before hedging or None to not hedge """
+        if self.percentile is not None and len(self._sorted) >= self.minSamples:
+            return self._sorted[int(self.percentile * (len(self._sorted) - 1))]
+        return self.delay
+
+    def stats(self):
+        """
+        Returns a dictionary describing the agent.
+
+        requests: Total requests made through the agent
+        hedged: Hedge requests sent
+        won: Hedge requests which answered first
+        delay: The current hedge delay
+        """
+        return {
+            'requests': self.requests,
+            'hedged': self.hedged,
+            'won': self.won,
+            'delay': self.hedgeDelay(),
+        }
+
+    def _mayHedge(self):
+        return self.hedged < self.maxHedgeRate * self.requests
+
+    def _record(self, latency):
+        self._latencies.append(latency)
+        bisect.insort(self._sorted, latency)
+        if len(self._latencies) > self._windowSize:
+            del self._sorted[bisect.bisect_left(self._sorted, self._latencies.popleft())]
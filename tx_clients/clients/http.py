@@ -1,20 +1,38 @@
 # pylint: disable=protected-access, too-many-arguments, too-many-instance-attributes
+import copy
+import random
 from collections import OrderedDict
 
 from zope.interface import implements
 
+from twisted import logger
 from twisted.web import client, http
 from twisted.web.iweb import IResponse
 from twisted.internet import defer
+from twisted.python import failure
 from twisted.web.http_headers import Headers
 from twisted.test.proto_helpers import StringTransport
 
 
+from tx_clients.clients import bulk
+from tx_clients.clients.download import download, segmented_download
+from tx_clients.clients.http2 import h2, h2_endpoint_factory, shared_h2_pool
+from tx_clients.clients.metrics import RequestMetrics, TimedEndpoint
+from tx_clients.clients.pool import shared_pool
+from tx_clients.clients.resolver import ResolvingEndpointFactory
+from tx_clients.clients.tls import shared_tls_policy
+from tx_clients.exceptions import ClientError, TimeoutError
+from tx_clients.clients.stream import ACCEPT_ENCODING, DECODERS, BodyStream, DecodingProtocol
+from tx_clients.utils.codecs import get_codec
 from tx_clients.utils.web import (
+    GzipBodyProducer,
     JSONBodyProducer,
+    JSONStreamDecoder,
+    LargeFileBodyProducer,
     StringBodyProducer
 )
 
+log = logger.Logger()
 
 # A dictionary is insufficient for supplying headers since a header may be
 # sent multiple times. Dont be lazy, Create a Headers object whenever possible
@@ -36,8 +54,36 @@ class BasicResponse(object):
     """
     implements(IResponse)
 
-    def __init__(self):
-        """ BasicResponse objects wrap twisted.web.client.iweb.IResponse """
+    def __init__(self, stream=False, maxBodySize=None, decompress=False, maxDecodedSize=None,
+                 idleTimeout=None, clock=None):
+        """ BasicResponse objects wrap twisted.web.client.iweb.IResponse
+
+        stream: When True the response is returned as soon as the headers
+            arrive. The body is never buffered and is instead available
+            incrementally from the stream attribute.
+            See: tx_clients.clients.stream.BodyStream
+        maxBodySize: Maximum number of body bytes accepted. Larger bodies fail
+            with tx_clients.exceptions.ResponseTooLarge. None is unbounded.
+        decompress: Decompress bodies sent with a supported Content-Encoding.
+            The body, length and stream are the decoded body. The encoding
+            is available as contentEncoding.
+            See: tx_clients.clients.stream.DecodingProtocol
+        maxDecodedSize: Maximum number of decompressed bytes accepted. Larger
+            bodies fail with tx_clients.exceptions.ResponseTooLarge.
+        idleTimeout: Maximum seconds between chunks of the body. The
+            connection is dropped and the body fails with
+            tx_clients.exceptions.TimeoutError when exceeded.
+        clock: See: twisted.internet.interfaces.IReactorTime
+        """
+        self._stream = stream
+        self.maxBodySize = maxBodySize
+        self._decompress = decompress
+        self.maxDecodedSize = maxDecodedSize
+        self.idleTimeout = idleTimeout
+        self._clock = clock
+        self._decoder = None
+        self.contentEncoding = None
+        self.stream = None
         self._response = None
         self.method = None
         self.version = None
@@ -46,6 +92,8 @@ class BasicResponse(object):
         self.headers = None
         self.length = None
         self.body = None
+        self.json = None
+        self.path = None
 
     def __call__(self, response, method):
         """
@@ -62,6 +110,28 @@ class BasicResponse(object):
         self.body = None
         return self.deliverBody()
 
+    def clone(self):
+        """
+        Returns a copy of the response which may be handed to another caller.
+        The headers and any decoded json body are copied. A streamed body can
+        only be read once and is not cloned.
+        """
+        response = copy.copy(self)
+        if self.headers is not None:
+            response.headers = self.headers.copy()
+        response.json = copy.deepcopy(self.json)
+        response.stream = None
+        return response
+
+    @property
+    def wireLength(self):
+        """ The number of body bytes received before decompression """
+        if self._decoder is not None:
+            return self._decoder.received
+        if self.stream is not None:
+            return self.stream.received
+        return self.length
+
     def cbAttachBody(self, body):
         # Attach the body and return the BasicResponse object
         self.body = body
@@ -72,12 +142,82 @@ class BasicResponse(object):
     def deliverBody(self):
         if self._response.code in http.NO_BODY_CODES or self.method == 'HEAD':
             return defer.succeed(self)
-        d = client.readBody(self._response)
+        if self._decompress:
+            encoding = self.headers.getRawHeaders('Content-Encoding', [''])[-1].strip().lower()
+            if encoding in DECODERS:
+                self.contentEncoding = encoding
+        if self._stream:
+            self.stream = self._bodyStream()
+            self._deliverTo(self.stream)
+            return defer.succeed(self)
+        if self.maxBodySize is None and self.contentEncoding is None and self.idleTimeout is None:
+            d = client.readBody(self._response)
+        else:
+            chunks = []
+            stream = self._bodyStream()
+            self._deliverTo(stream)
+            d = stream.each(chunks.append)
+            d.addCallback(lambda _: ''.join(chunks))
         d.addCallback(self.cbAttachBody)
         return d
 
+    def _bodyStream(self):
+        return BodyStream(self.maxBodySize, idleTimeout=self.idleTimeout, clock=self._clock)
+
+    def _deliverTo(self, protocol):
+        if self.contentEncoding is not None:
+            self._decoder = DecodingProtocol(protocol, self.contentEncoding, self.maxDecodedSize)
+            protocol = self._decoder
+        self._response.deliverBody(protocol)
+
+
+class RequestMethodsMixin(object):
+    """ Maps HTTP verbs, downloads and bulk requests to methods which call self.request """
+    def get(self, *args, **kwargs):
+        return self.request('GET', *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self.request('DELETE', *args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        return self.request('POST', *args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        return self.request('PUT', *args, **kwargs)
+
+    def patch(self, *args, **kwargs):
+        return self.request('PATCH', *args, **kwargs)
+
+    def options(self, *args, **kwargs):
+        return self.request('OPTIONS', *args, **kwargs)
+
+    def head(self, *args, **kwargs):
+        return self.request('HEAD', *args, **kwargs)
+
+    def trace(self, *args, **kwargs):
+        return self.request('TRACE', *args, **kwargs)
+
+    def connect(self, *args, **kwargs):
+        return self.request('CONNECT', *args, **kwargs)
+
+    def download(self, uri, target, *args, **kwargs):
+        """ See: tx_clients.clients.download.download """
+        return download(self, uri, target, *args, **kwargs)
+
+    def segmented_download(self, uri, path, *args, **kwargs):
+        """ See: tx_clients.clients.download.segmented_download """
+        return segmented_download(self, uri, path, *args, **kwargs)
 
-class BasicAgent(client.Agent):
+    def imap(self, requests, callback, *args, **kwargs):
+        """ See: tx_clients.clients.bulk.imap """
+        return bulk.imap(self, requests, callback, *args, **kwargs)
+
+    def map(self, requests, *args, **kwargs):
+        """ See: tx_clients.clients.bulk.map """
+        return bulk.map(self, requests, *args, **kwargs)
+
+
+class BasicAgent(RequestMethodsMixin, client.Agent):
     """ Returns a Deferred which contains a BasicResponse
     Asynchronous HTTP Client Helper which makes some assumptions to satisfy the
     majority of use cases. See: twisted.web.iweb.IAgent for the details of
@@ -111,43 +251,253 @@ class BasicAgent(client.Agent):
         return d
     """
     bodyProducer = StringBodyProducer
-
-    def request(self, method, uri, headers=None, data=None):
-        """ Returns an imutable Response object when the body is availabele """
+    maxBodySize = None
+    decompress = False
+    maxDecodedSize = 2 ** 28
+    compress = False
+    compressLevel = 6
+    compressThreshold = 2 ** 10
+    timeout = None
+    headersTimeout = None
+    idleTimeout = None
+    metricsSampleRate = 1.0
+    _observers = ()
+    _metrics = None
+    _h2Pool = None
+    _h2EndpointFactory = None
+
+    def __init__(self, reactor, contextFactory=None, connectTimeout=None, bindAddress=None,
+                 pool=None, http2=False, resolver=None):
+        """
+        See: twisted.web.client.Agent
+        contextFactory: A twisted.web.iweb.IPolicyForHTTPS. By default the
+            CachingPolicyForHTTPS shared by all agents on the reactor, which
+            resumes TLS sessions. See: tx_clients.clients.tls
+        pool: A twisted.web.client.HTTPConnectionPool. By default the
+            persistent BasicConnectionPool shared by all agents on the reactor
+            is used. See: tx_clients.clients.pool.shared_pool
+        http2: Offer HTTP/2 with ALPN on https connections. Concurrent requests
+            to a host which accepts it share one connection. Other hosts are
+            sent HTTP/1.1 requests through pool. Requires the h2 package.
+            See: tx_clients.clients.http2
+        resolver: A tx_clients.clients.resolver.CachingResolver which resolves
+            hostnames instead of the reactor. Connections are raced across the
+            addresses of a host. See: tx_clients.clients.resolver.shared_resolver
+        """
+        if pool is None:
+            pool = shared_pool(reactor)
+        if contextFactory is None:
+            contextFactory = shared_tls_policy(reactor)
+        client.Agent.__init__(self, reactor, contextFactory, connectTimeout, bindAddress, pool)
+        self._observers = []
+        self._resolver = resolver
+        if resolver is not None:
+            self._endpointFactory = ResolvingEndpointFactory(
+                reactor, resolver, self._endpointFactory._policyForHTTPS, connectTimeout,
+                bindAddress
+            )
+        if http2:
+            if h2 is None:
+                raise ClientError('http2 requires the h2 package')
+            self._h2EndpointFactory = h2_endpoint_factory(self._endpointFactory)
+            self._h2Pool = shared_h2_pool(reactor)
+
+    @property
+    def pool(self):
+        """ The connection pool used by the agent """
+        return self._pool
+
+    @property
+    def http2Pool(self):
+        """ The H2ConnectionPool used by the agent, None unless http2 is enabled """
+        return self._h2Pool
+
+    def addObserver(self, observer):
+        """
+        Call observer with a tx_clients.clients.metrics.RequestMetrics once each
+        request is complete. Streamed requests are complete once the body has
+        been received. Only metricsSampleRate of the requests are measured.
+        Nothing is measured while the agent has no observers.
+        See: tx_clients.clients.metrics.MetricsAggregator
+        """
+        self._observers.append(observer)
+
+    def removeObserver(self, observer):
+        self._observers.remove(observer)
+
+    def request(self, method, uri, headers=None, data=None, stream=False, maxBodySize=None,
+                decompress=None, compress=None, timeout=None, headersTimeout=None,
+                idleTimeout=None):
+        """ Returns an imutable Response object when the body is availabele
+
+        stream: Fire as soon as the headers arrive and expose the body
+            incrementally on BasicResponse.stream instead of buffering it.
+        maxBodySize: Maximum number of body bytes accepted. Defaults to the
+            maxBodySize of the agent.
+        decompress: Send Accept-Encoding and decompress gzip, deflate and
+            brotli bodies. Decompressed bodies larger than the maxDecodedSize
+            of the agent fail. Defaults to the decompress of the agent.
+        compress: Send the body gzip compressed with compressLevel. Bodies
+            known to be smaller than compressThreshold bytes are sent as is.
+            Defaults to the compress of the agent.
+            See: tx_clients.utils.web.GzipBodyProducer
+        timeout: Maximum seconds until the response, including the body unless
+            it is streamed, has been received.
+        headersTimeout: Maximum seconds until the response headers arrive
+        idleTimeout: Maximum seconds between chunks of the body
+
+        Timeouts default to those of the agent. When one expires the request is
+        cancelled, the connection is closed and the Deferred fails with
+        tx_clients.exceptions.TimeoutError. The connect timeout is set when
+        the agent is created. See: twisted.web.client.Agent
+        """
         producer = None
         if data is not None:
-            producer = self.bodyProducer(data)
-
-        d = client.Agent.request(self, method, uri, headers, producer)
-        d.addCallback(BasicResponse(), method)
+            producer = self._bodyProducerFor(data)
+        if compress is None:
+            compress = self.compress
+        if compress and producer is not None and self._shouldCompress(producer):
+            producer = GzipBodyProducer(producer, self.compressLevel)
+            headers = headers.copy() if headers is not None else Headers()
+            headers.setRawHeaders('Content-Encoding', ['gzip'])
+        if maxBodySize is None:
+            maxBodySize = self.maxBodySize
+        if decompress is None:
+            decompress = self.decompress
+        if decompress:
+            headers = headers.copy() if headers is not None else Headers()
+            if not headers.hasHeader('Accept-Encoding'):
+                headers.addRawHeader('Accept-Encoding', ACCEPT_ENCODING)
+
+        if timeout is None:
+            timeout = self.timeout
+        if headersTimeout is None:
+            headersTimeout = self.headersTimeout
+        if idleTimeout is None:
+            idleTimeout = self.idleTimeout
+
+        metrics = self._startMetrics(method, uri, producer)
+        # Read by _requestWithEndpoint which Agent.request calls synchronously.
+        self._metrics = metrics
+        try:
+            d = client.Agent.request(self, method, uri, headers, producer)
+        finally:
+            self._metrics = None
+        if headersTimeout is not None:
+            self._timeout(d, headersTimeout, 'Timed out waiting for response headers')
+        if metrics is not None:
+            d.addBoth(self._cbMetricsHeaders, metrics)
+        d.addCallback(BasicResponse(
+            stream, maxBodySize, decompress, self.maxDecodedSize, idleTimeout, self._reactor
+        ), method)
+        if timeout is not None:
+            self._timeout(d, timeout, 'Timed out waiting for the response')
+        if metrics is not None:
+            d.addBoth(self._cbMetricsResponse, metrics)
         return d
 
-    def get(self, *args, **kwargs):
-        return self.request('GET', *args, **kwargs)
-
-    def delete(self, *args, **kwargs):
-        return self.request('DELETE', *args, **kwargs)
-
-    def post(self, *args, **kwargs):
-        return self.request('POST', *args, **kwargs)
-
-    def put(self, *args, **kwargs):
-        return self.request('PUT', *args, **kwargs)
-
-    def patch(self, *args, **kwargs):
-        return self.request('PATCH', *args, **kwargs)
-
-    def options(self, *args, **kwargs):
-        return self.request('OPTIONS', *args, **kwargs)
-
-    def head(self, *args, **kwargs):
-        return self.request('HEAD', *args, **kwargs)
-
-    def trace(self, *args, **kwargs):
-        return self.request('TRACE', *args, **kwargs)
+    def _requestWithEndpoint(self, key, endpoint, *args):
+        metrics = self._metrics
+        parsedURI = args[1]
+        if self._h2Pool is not None and parsedURI.scheme == 'https':
+            return self._requestH2(key, endpoint, metrics, *args)
+        if metrics is not None:
+            endpoint = TimedEndpoint(endpoint, metrics, self._reactor)
+        return client.Agent._requestWithEndpoint(self, key, endpoint, *args)
+
+    def _requestH2(self, key, endpoint, metrics, method, parsedURI, headers, bodyProducer,
+                   requestPath):
+        """ Make the request on the HTTP/2 connection to the host, or over HTTP/1.1 """
+        h2Endpoint = self._h2EndpointFactory.endpointForURI(parsedURI)
+        if metrics is not None:
+            h2Endpoint = TimedEndpoint(h2Endpoint, metrics, self._reactor)
+
+        def cbConnection(connection):
+            if connection is None:
+                # The host did not negotiate h2.
+                fallback = endpoint
+                if metrics is not None:
+                    fallback = TimedEndpoint(endpoint, metrics, self._reactor)
+                return client.Agent._requestWithEndpoint(
+                    self, key, fallback, method, parsedURI, headers, bodyProducer, requestPath
+                )
+            authority = self._computeHostValue(parsedURI.scheme, parsedURI.host, parsedURI.port)
+            return connection.request(method, authority, requestPath, headers, bodyProducer)
+        d = self._h2Pool.getConnection(key, h2Endpoint)
+        d.addCallback(cbConnection)
+        return d
 
-    def connect(self, *args, **kwargs):
-        return self.request('CONNECT', *args, **kwargs)
+    def _startMetrics(self, method, uri, producer):
+        """ Returns a RequestMetrics when the request is measured or None """
+        if not self._observers:
+            return None
+        if self.metricsSampleRate < 1 and random.random() >= self.metricsSampleRate:
+            return None
+        metrics = RequestMetrics(method, uri, self._reactor.seconds())
+        if producer is not None and producer.length is not client.UNKNOWN_LENGTH:
+            metrics.bytesOut = producer.length
+        else:
+            metrics.bytesOut = 0 if producer is None else None
+        return metrics
+
+    def _cbMetricsHeaders(self, result, metrics):
+        if not isinstance(result, failure.Failure):
+            metrics.headers = self._reactor.seconds() - metrics.started
+            if metrics.reused is None:
+                metrics.reused = True
+        return result
+
+    def _cbMetricsResponse(self, result, metrics):
+        if isinstance(result, failure.Failure):
+            self._cbMetricsBody(result, metrics, None)
+            return result
+        metrics.code = result.code
+        if result.stream is not None:
+            result.stream.notifyFinish().addBoth(self._cbMetricsBody, metrics, result)
+        else:
+            self._cbMetricsBody(None, metrics, result)
+        return result
+
+    def _cbMetricsBody(self, reason, metrics, response):
+        metrics.total = self._reactor.seconds() - metrics.started
+        if response is not None:
+            metrics.body = metrics.total - metrics.headers
+            if response.body is not None or response.stream is not None:
+                metrics.bytesIn = response.wireLength
+            else:
+                metrics.bytesIn = 0
+        if isinstance(reason, failure.Failure):
+            metrics.failure = reason
+        for observer in list(self._observers):
+            try:
+                observer(metrics)
+            except Exception:  # pylint: disable=broad-except
+                log.failure('Request metrics observer {observer} failed', observer=observer)
+
+    def _timeout(self, d, seconds, message):
+        """ Cancel d unless it fires within seconds and fail with TimeoutError instead """
+        timedOut = []
+
+        def expired():
+            timedOut.append(True)
+            d.cancel()
+        call = self._reactor.callLater(seconds, expired)
+
+        def cbFired(result):
+            if call.active():
+                call.cancel()
+            if timedOut and isinstance(result, failure.Failure):
+                return failure.Failure(TimeoutError('{} after {} seconds'.format(message, seconds)))
+            return result
+        d.addBoth(cbFired)
+
+    def _bodyProducerFor(self, data):
+        """ Returns the twisted.web.iweb.IBodyProducer which sends data """
+        return self.bodyProducer(data)
+
+    def _shouldCompress(self, producer):
+        """ Bodies of unknown length are always compressed """
+        return producer.length is client.UNKNOWN_LENGTH or producer.length >= self.compressThreshold
 
 
 class BasicFileAgent(BasicAgent):
@@ -155,9 +505,11 @@ class BasicFileAgent(BasicAgent):
     See: BasicHTTPClient
 
     - The basic File Agent asynchronously sends data from a file like object
-    - Automatically sets transfer encoding to chunked
+    - Files on disk are sent in large memory mapped blocks with a content-length.
+    See: tx_clients.utils.web.LargeFileBodyProducer
+    - Automatically sets transfer encoding to chunked for other file like objects
     """
-    bodyProducer = client.FileBodyProducer
+    bodyProducer = LargeFileBodyProducer
 
 
 class BasicJSONAgent(BasicAgent):
@@ -166,17 +518,106 @@ class BasicJSONAgent(BasicAgent):
 
     - The basic JSON Agent asynchronously encodes and sends data as json
     - Automatically sets the content-type
-    - Automatically sets transfer encoding to chunked
+    - Small documents are sent with a content-length. Larger documents
+    automatically set transfer encoding to chunked
+    - When a threadPool is set, documents are encoded and responses larger
+    than threadedBodySize are decoded in the pool instead of on the reactor
+    thread.
+    See: tx_clients.utils.threads.CodecThreadPool
+    - The json serializer may be overridden per agent with codec. By default the
+    stdlib json is used. See: tx_clients.utils.codecs
     """
     bodyProducer = JSONBodyProducer
+    threadPool = None
+    threadedBodySize = 2 ** 14
+    codec = None
 
-    def request(self, method, uri, headers=None, data=None):
+    def request(self, method, uri, headers=None, data=None, decode=False, **kwargs):
+        """
+        See: BasicAgent.request
+        decode: Decode the json body of the response and attach it to the
+            BasicResponse as the json attribute.
+        """
         if data is not None:
             if headers is None:
                 headers = Headers()
             headers.removeHeader('Content-Type')
             headers.addRawHeader('Content-Type', 'application/json; charset=utf-8')
-        return BasicAgent.request(self, method, uri, headers, data)
+        d = BasicAgent.request(self, method, uri, headers, data, **kwargs)
+        if decode:
+            d.addCallback(self._cbDecode)
+        return d
+
+    def decode(self, body):
+        """
+        Returns a Deferred which fires with the decoded json body. Bodies
+        larger than threadedBodySize are decoded in the threadPool.
+        """
+        codec = get_codec(self.codec)
+        if self.threadPool is not None and len(body) > self.threadedBodySize:
+            return self.threadPool.run(codec.loads, body)
+        return defer.maybeDeferred(codec.loads, body)
+
+    def _cbDecode(self, response):
+        if not response.body:
+            return response
+        d = self.decode(response.body)
+
+        def cbAttach(decoded):
+            response.json = decoded
+            return response
+        d.addCallback(cbAttach)
+        return d
+
+    def _bodyProducerFor(self, data):
+        kwargs = {}
+        if self.codec is not None:
+            kwargs['codec'] = self.codec
+        if self.threadPool is not None:
+            kwargs['threadPool'] = self.threadPool
+        return self.bodyProducer(data, **kwargs)
+
+    def stream_json(self, method, uri, callback, headers=None, data=None, ndjson=False, **kwargs):
+        """
+        Returns a Deferred which fires with a BasicResponse once the whole
+        body has been decoded. The body is decoded incrementally as it arrives
+        and callback is called with every record as soon as it is complete.
+        See: tx_clients.utils.web.JSONStreamDecoder
+
+        ndjson: The body contains one json document per line.
+        """
+        def cbDecode(response):
+            if response.stream is None:
+                return response
+            decoder = JSONStreamDecoder(callback, ndjson, self.codec)
+            d = response.stream.each(decoder.feed)
+            d.addCallback(lambda _: decoder.close())
+            d.addCallback(lambda _: response)
+            return d
+
+        kwargs['stream'] = True
+        d = self.request(method, uri, headers, data, **kwargs)
+        d.addCallback(cbDecode)
+        return d
+
+
+class AgentWrapper(RequestMethodsMixin):
+    """
+    Base class for helpers which wrap a BasicAgent, or another AgentWrapper,
+    to add behaviour around BasicAgent.request. Wrappers may be stacked:
+
+        agent = SchedulingAgent(BasicJSONAgent(reactor), maxConcurrent=50)
+
+    Subclasses override request and call self.agent.request to perform the
+    request. Keyword arguments which the wrapper does not handle MUST be passed
+    through to the wrapped agent.
+    """
+    def __init__(self, agent):
+        self.agent = agent
+
+    def request(self, method, uri, headers=None, data=None, **kwargs):
+        """ See: BasicAgent.request """
+        return self.agent.request(method, uri, headers, data, **kwargs)
 
 
 def stub_agent_factory(agent_cls):
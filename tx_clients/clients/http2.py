@@ -0,0 +1,696 @@
+# pylint: disable=protected-access, too-many-instance-attributes
+"""
+An opt-in HTTP/2 transport for BasicAgent. See: BasicAgent(http2=True)
+
+https requests offer h2 and http/1.1 with ALPN. When the server selects h2
+every request to the host is multiplexed as a stream over one connection with
+HPACK compressed headers. Hosts which select http/1.1, or nothing, are
+remembered and served by the HTTP/1.1 connection pool of the agent.
+
+Requires the h2 package.
+"""
+import copy
+from collections import deque
+
+from zope.interface import implementer
+
+from twisted.internet import defer, error, protocol
+from twisted.internet.interfaces import (
+    IConsumer, IHandshakeListener, IOpenSSLClientConnectionCreator, IPushProducer, IReactorCore
+)
+from twisted.python import failure
+from twisted.web import client, http
+from twisted.web.client import ResponseDone, ResponseFailed, ResponseNeverReceived
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IPolicyForHTTPS, IResponse, UNKNOWN_LENGTH
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:
+    h2 = None
+
+
+# Protocols offered with ALPN in order of preference
+ALPN_PROTOCOLS = [b'h2', b'http/1.1']
+
+# HTTP/1.1 connection headers which are not valid in HTTP/2
+_CONNECTION_HEADERS = frozenset([
+    'connection', 'host', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade'
+])
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class _ALPNCreator(object):
+    """ Offers h2 and http/1.1 with ALPN on the connections of another creator """
+    def __init__(self, creator):
+        self._creator = creator
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = self._creator.clientConnectionForTLS(tlsProtocol)
+        connection.set_alpn_protos(ALPN_PROTOCOLS)
+        return connection
+
+
+@implementer(IPolicyForHTTPS)
+class H2PolicyForHTTPS(object):
+    """ See: twisted.web.iweb.IPolicyForHTTPS
+
+    Offers h2 and http/1.1 with ALPN on the TLS connections of policy, which
+    verifies certificates and resumes sessions as usual.
+    """
+    def __init__(self, policy):
+        """
+        policy: The twisted.web.iweb.IPolicyForHTTPS of the agent
+        """
+        self.policy = policy
+
+    def creatorForNetloc(self, hostname, port):
+        return _ALPNCreator(self.policy.creatorForNetloc(hostname, port))
+
+
+def h2_endpoint_factory(endpointFactory):
+    """
+    Returns a copy of endpointFactory, the endpoint factory of an agent, whose
+    https endpoints offer h2 with ALPN. The host is resolved and connected to,
+    and TLS is set up, exactly as for the HTTP/1.1 requests of the agent.
+    See: twisted.web.iweb.IAgentEndpointFactory
+    """
+    factory = copy.copy(endpointFactory)
+    factory._policyForHTTPS = H2PolicyForHTTPS(endpointFactory._policyForHTTPS)
+    return factory
+
+
+@implementer(IPushProducer)
+class _StreamTransport(object):
+    """ The transport of the protocol a response body is delivered to """
+    def __init__(self, stream):
+        self._stream = stream
+
+    def pauseProducing(self):
+        self._stream.pauseBody()
+
+    def resumeProducing(self):
+        self._stream.resumeBody()
+
+    def stopProducing(self):
+        self._stream.cancel()
+
+    # See: twisted.web.client.readBody
+    abortConnection = stopProducing
+
+
+@implementer(IResponse)
+class H2Response(object):
+    """ A twisted.web.iweb.IResponse received on a HTTP/2 stream """
+    version = ('HTTP', 2, 0)
+    request = None
+    previousResponse = None
+
+    def __init__(self, stream, code, headers):
+        self._stream = stream
+        self.code = code
+        self.phrase = http.RESPONSES.get(code, 'Unknown Status')
+        self.headers = headers
+        self.length = UNKNOWN_LENGTH
+        try:
+            self.length = int(headers.getRawHeaders('content-length')[0])
+        except (TypeError, ValueError):
+            pass
+
+    def deliverBody(self, protocol):
+        self._stream.deliverBody(protocol)
+
+    def setPreviousResponse(self, response):
+        self.previousResponse = response
+
+
+@implementer(IConsumer)
+class _Stream(object):
+    """
+    A request and its response on a H2ClientProtocol. The stream is the
+    consumer of the request body producer and the producer of the response
+    body.
+    """
+    # Bytes of request body buffered before the body producer is paused
+    bufferSize = 2 ** 16
+
+    def __init__(self, connection, method, authority, path, headers, bodyProducer):
+        self.connection = connection
+        self.method = method
+        self.authority = authority
+        self.path = path
+        self.headers = headers
+        self.producer = bodyProducer
+        self.streamId = None
+        self.deferred = defer.Deferred(self._cancelRequest)
+        self.response = None
+        self.closed = False
+        # Request body
+        self.outbound = deque()
+        self.outboundSize = 0
+        self.producing = False
+        self.producerPaused = False
+        self.bodySent = bodyProducer is None
+        self.ended = bodyProducer is None
+        # Response body
+        self.bodyProtocol = None
+        self.received = deque()
+        self.paused = False
+        self.reason = None
+        self.delivered = False
+
+    def requestHeaders(self):
+        headers = [
+            (':method', self.method),
+            (':scheme', 'https'),
+            (':authority', self.authority),
+            (':path', self.path),
+        ]
+        if self.headers is not None:
+            for name, values in self.headers.getAllRawHeaders():
+                name = name.lower()
+                if name not in _CONNECTION_HEADERS:
+                    headers.extend((name, value) for value in values)
+        if self.producer is not None and self.producer.length is not UNKNOWN_LENGTH:
+            headers.append(('content-length', str(self.producer.length)))
+        return headers
+
+    # IConsumer of the request body
+
+    def startProducing(self):
+        self.producing = True
+        d = self.producer.startProducing(self)
+        d.addCallbacks(self._cbProduced, self._ebProduced)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, data):
+        if self.closed or not data:
+            return
+        self.outbound.append(data)
+        self.outboundSize += len(data)
+        self.connection.sendBody(self)
+        if self.outboundSize > self.bufferSize and not self.producerPaused and self.producing:
+            self.producerPaused = True
+            self.producer.pauseProducing()
+
+    def sent(self):
+        """ Called by the connection when buffered body data has been sent """
+        if self.producerPaused and self.outboundSize <= self.bufferSize:
+            self.producerPaused = False
+            self.producer.resumeProducing()
+
+    def _cbProduced(self, _):
+        self.producing = False
+        self.bodySent = True
+        if not self.closed:
+            self.connection.sendBody(self)
+
+    def _ebProduced(self, reason):
+        self.producing = False
+        if not self.closed:
+            self.connection.resetStream(self)
+            self.fail(reason)
+
+    def _stopProducer(self):
+        if self.producing:
+            self.producing = False
+            self.producer.stopProducing()
+
+    # The response
+
+    def responseReceived(self, code, headers):
+        self.response = H2Response(self, code, headers)
+        self.deferred.callback(self.response)
+
+    def dataReceived(self, data, flowLength):
+        if self.bodyProtocol is not None and not self.paused and not self.received:
+            self.bodyProtocol.dataReceived(data)
+            self.connection.acknowledge(self, flowLength)
+        else:
+            self.received.append((data, flowLength))
+
+    def deliverBody(self, protocol):
+        self.bodyProtocol = protocol
+        protocol.makeConnection(_StreamTransport(self))
+        self._deliver()
+
+    def pauseBody(self):
+        self.paused = True
+
+    def resumeBody(self):
+        self.paused = False
+        self._deliver()
+
+    def _deliver(self):
+        """ Deliver buffered body data, and the end of the body, unless paused """
+        while self.received and not self.paused and self.bodyProtocol is not None:
+            data, flowLength = self.received.popleft()
+            self.bodyProtocol.dataReceived(data)
+            self.connection.acknowledge(self, flowLength)
+        if self.closed and not self.received and self.bodyProtocol is not None and (
+                not self.delivered):
+            self.delivered = True
+            self.bodyProtocol.connectionLost(self.reason)
+
+    def streamEnded(self):
+        self.close(failure.Failure(ResponseDone()))
+
+    def close(self, reason):
+        self.closed = True
+        self.reason = reason
+        self._stopProducer()
+        self._deliver()
+
+    def fail(self, reason):
+        """ Fail the request, or the body when the response has been received """
+        if self.closed:
+            return
+        if self.response is None:
+            self.close(reason)
+            if not self.deferred.called:
+                self.deferred.errback(ResponseNeverReceived([reason]))
+        else:
+            self.close(failure.Failure(ResponseFailed([reason])))
+
+    def cancel(self):
+        """ Stop receiving the body. The stream is reset """
+        if not self.closed:
+            self.connection.resetStream(self)
+            self.received.clear()
+            self.fail(failure.Failure(defer.CancelledError()))
+
+    def _cancelRequest(self, _):
+        if not self.closed:
+            self.connection.resetStream(self)
+            self.closed = True
+            self._stopProducer()
+
+
+@implementer(IHandshakeListener)
+class H2ClientProtocol(protocol.Protocol):
+    """
+    A HTTP/2 client connection. The protocol waits for the TLS handshake.
+    When h2 was negotiated requests may be made with request(). Otherwise the
+    connection is closed. See: whenReady
+
+    Requests beyond the maximum concurrent streams of the server wait for a
+    stream to close. The connection is closed once it has been idle for
+    idleTimeout seconds.
+    """
+    initialWindowSize = 2 ** 20
+    connectionWindowSize = 2 ** 24
+    idleTimeout = 120
+
+    def __init__(self, clock, idleTimeout=None):
+        self._clock = clock
+        if idleTimeout is not None:
+            self.idleTimeout = idleTimeout
+        self.conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=True, header_encoding=None)
+        )
+        self.streams = {}
+        self.pending = deque()
+        self.negotiated = None
+        self.goingAway = False
+        self.lost = False
+        self._ready = []
+        self._idleCall = None
+        self.onLost = None
+
+    @property
+    def available(self):
+        """ Whether new requests may be made on the connection """
+        return self.negotiated and not self.goingAway and not self.lost
+
+    def whenReady(self):
+        """
+        Returns a Deferred which fires with the protocol once h2 has been
+        negotiated or None when the server selected another protocol. It fails
+        when the connection is lost first.
+        """
+        if self.negotiated is not None:
+            return defer.succeed(self if self.negotiated else None)
+        d = defer.Deferred()
+        self._ready.append(d)
+        return d
+
+    def handshakeCompleted(self):
+        if getattr(self.transport, 'negotiatedProtocol', None) != b'h2':
+            self.negotiated = False
+            self._fireReady(None)
+            self.transport.loseConnection()
+            return
+        self.negotiated = True
+        self.conn.initiate_connection()
+        self.conn.update_settings({
+            h2.settings.SettingCodes.ENABLE_PUSH: 0,
+            h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: self.initialWindowSize,
+        })
+        self.conn.increment_flow_control_window(
+            self.connectionWindowSize - self.conn.inbound_flow_control_window
+        )
+        self._flush()
+        self._resetIdle()
+        self._fireReady(self)
+
+    def request(self, method, authority, path, headers=None, bodyProducer=None):
+        """
+        Returns a Deferred which fires with a H2Response once the response
+        headers have been received.
+
+        authority: The host[:port] the request is for
+        path: The path and query of the request
+        See: twisted.web.iweb.IAgent.request
+        """
+        stream = _Stream(self, method, authority, path, headers, bodyProducer)
+        if not self.available:
+            stream.fail(failure.Failure(error.ConnectionLost('The HTTP/2 connection is closed')))
+        elif self.conn.open_outbound_streams >= self.conn.remote_settings.max_concurrent_streams:
+            self.pending.append(stream)
+        else:
+            self._start(stream)
+        return stream.deferred
+
+    def _start(self, stream):
+        self._cancelIdle()
+        stream.streamId = self.conn.get_next_available_stream_id()
+        self.streams[stream.streamId] = stream
+        self.conn.send_headers(stream.streamId, stream.requestHeaders(), end_stream=stream.ended)
+        self._flush()
+        if stream.producer is not None:
+            stream.startProducing()
+
+    def _startPending(self):
+        while self.pending and self.available and (
+                self.conn.open_outbound_streams < self.conn.remote_settings.max_concurrent_streams):
+            stream = self.pending.popleft()
+            if not stream.closed:
+                self._start(stream)
+
+    def sendBody(self, stream):
+        """ Send as much of the buffered body of stream as flow control allows """
+        if stream.streamId is None or stream.closed:
+            return
+        while stream.outbound:
+            window = min(self.conn.local_flow_control_window(stream.streamId),
+                         self.conn.max_outbound_frame_size)
+            if window <= 0:
+                break
+            data = stream.outbound.popleft()
+            if len(data) > window:
+                stream.outbound.appendleft(data[window:])
+                data = data[:window]
+            stream.outboundSize -= len(data)
+            self.conn.send_data(stream.streamId, data)
+        if not stream.outbound and stream.bodySent and not stream.ended:
+            stream.ended = True
+            self.conn.end_stream(stream.streamId)
+        self._flush()
+        stream.sent()
+
+    def acknowledge(self, stream, flowLength):
+        """ Open the flow control window once body data has been delivered """
+        if not self.lost and flowLength:
+            self.conn.acknowledge_received_data(flowLength, stream.streamId)
+            self._flush()
+
+    def resetStream(self, stream):
+        if stream.streamId is None:
+            if stream in self.pending:
+                self.pending.remove(stream)
+            return
+        if self.streams.pop(stream.streamId, None) is not None and not self.lost:
+            try:
+                self.conn.reset_stream(stream.streamId, h2.errors.ErrorCodes.CANCEL)
+            except h2.exceptions.StreamClosedError:
+                pass
+            self._flush()
+            self._streamClosed()
+
+    def dataReceived(self, data):
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            self._flush()
+            self.transport.loseConnection()
+            self._failStreams(failure.Failure())
+            return
+        for event in events:
+            handler = self._handlers.get(type(event))
+            if handler is not None:
+                handler(self, event)
+        self._flush()
+
+    def _responseReceived(self, event):
+        stream = self.streams.get(event.stream_id)
+        if stream is None:
+            return
+        headers = Headers()
+        code = None
+        for name, value in event.headers:
+            if name == ':status':
+                code = int(value)
+            elif not name.startswith(':'):
+                headers.addRawHeader(name, value)
+        stream.responseReceived(code, headers)
+
+    def _dataReceived(self, event):
+        stream = self.streams.get(event.stream_id)
+        if stream is None:
+            self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            return
+        stream.dataReceived(event.data, event.flow_controlled_length)
+
+    def _streamEnded(self, event):
+        stream = self.streams.pop(event.stream_id, None)
+        if stream is not None:
+            stream.streamEnded()
+            self._streamClosed()
+
+    def _streamReset(self, event):
+        stream = self.streams.pop(event.stream_id, None)
+        if stream is not None:
+            stream.fail(failure.Failure(error.ConnectionLost(
+                'HTTP/2 stream reset with error code {}'.format(event.error_code)
+            )))
+            self._streamClosed()
+
+    def _windowUpdated(self, event):
+        if event.stream_id:
+            stream = self.streams.get(event.stream_id)
+            streams = [stream] if stream is not None else []
+        else:
+            streams = self.streams.values()
+        for stream in streams:
+            self.sendBody(stream)
+
+    def _settingsChanged(self, _):
+        self._startPending()
+
+    def _connectionTerminated(self, event):
+        # h2 closes the connection on GOAWAY, streams in flight cannot complete.
+        self.goingAway = True
+        self._failStreams(failure.Failure(error.ConnectionLost(
+            'HTTP/2 connection closed by the server with error code {}'.format(event.error_code)
+        )))
+        self.transport.loseConnection()
+
+    if h2 is not None:
+        _handlers = {
+            h2.events.ResponseReceived: _responseReceived,
+            h2.events.DataReceived: _dataReceived,
+            h2.events.StreamEnded: _streamEnded,
+            h2.events.StreamReset: _streamReset,
+            h2.events.WindowUpdated: _windowUpdated,
+            h2.events.RemoteSettingsChanged: _settingsChanged,
+            h2.events.ConnectionTerminated: _connectionTerminated,
+        }
+
+    def _streamClosed(self):
+        self._startPending()
+        if not self.streams and not self.pending:
+            self._resetIdle()
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.lost = True
+        self._cancelIdle()
+        ready, self._ready = self._ready, []
+        for d in ready:
+            d.errback(ResponseNeverReceived([reason]))
+        self._failStreams(reason)
+        if self.onLost is not None:
+            self.onLost(self)
+
+    def _failStreams(self, reason):
+        streams, self.streams = self.streams, {}
+        for stream in streams.values():
+            stream.fail(reason)
+        self._failPending(reason)
+
+    def _failPending(self, reason):
+        pending, self.pending = self.pending, deque()
+        for stream in pending:
+            stream.fail(reason)
+
+    def _fireReady(self, result):
+        ready, self._ready = self._ready, []
+        for d in ready:
+            d.callback(result)
+
+    def _flush(self):
+        data = self.conn.data_to_send()
+        if data and not self.lost:
+            self.transport.write(data)
+
+    def _resetIdle(self):
+        self._cancelIdle()
+        if self.idleTimeout is not None:
+            self._idleCall = self._clock.callLater(self.idleTimeout, self._idle)
+
+    def _cancelIdle(self):
+        if self._idleCall is not None and self._idleCall.active():
+            self._idleCall.cancel()
+        self._idleCall = None
+
+    def _idle(self):
+        self._idleCall = None
+        self.goingAway = True
+        self.conn.close_connection()
+        self._flush()
+        self.transport.loseConnection()
+
+
+class _H2ClientFactory(protocol.Factory):
+    def __init__(self, pool, key):
+        self._pool = pool
+        self._key = key
+
+    def buildProtocol(self, addr):
+        connection = H2ClientProtocol(self._pool._reactor, self._pool.idleTimeout)
+        connection.onLost = lambda lost: self._pool._connectionLost(self._key, lost)
+        return connection
+
+
+class H2ConnectionPool(object):
+    """
+    Keeps one HTTP/2 connection per (scheme, host, port). Requests made while
+    the connection is being established wait for it and share it.
+
+    Hosts which did not negotiate h2 are remembered so later requests go
+    straight to HTTP/1.1.
+    """
+    idleTimeout = 120
+
+    def __init__(self, reactor, idleTimeout=None):
+        """
+        reactor: See: twisted.internet.interfaces.IReactorTime
+        idleTimeout: Seconds an idle connection stays open
+        """
+        self._reactor = reactor
+        if idleTimeout is not None:
+            self.idleTimeout = idleTimeout
+        self._connections = {}
+        self._connecting = {}
+        self._http1 = set()
+        self.created = 0
+        self.requests = 0
+
+    def getConnection(self, key, endpoint):
+        """
+        Returns a Deferred which fires with a H2ClientProtocol for key, or
+        None when the host does not speak HTTP/2.
+        """
+        self.requests += 1
+        connection = self._connections.get(key)
+        if connection is not None and connection.available:
+            return defer.succeed(connection)
+        if key in self._http1:
+            return defer.succeed(None)
+        waiting = self._connecting.get(key)
+        if waiting is None:
+            waiting = self._connecting[key] = []
+            self.created += 1
+            d = endpoint.connect(_H2ClientFactory(self, key))
+            d.addCallback(lambda connection: connection.whenReady())
+            d.addBoth(self._cbConnected, key)
+        d = defer.Deferred(lambda d: waiting.remove(d))
+        waiting.append(d)
+        return d
+
+    def _cbConnected(self, result, key):
+        waiting = self._connecting.pop(key)
+        if isinstance(result, H2ClientProtocol):
+            self._connections[key] = result
+        elif result is None:
+            self._http1.add(key)
+        for d in waiting:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def _connectionLost(self, key, connection):
+        if self._connections.get(key) is connection:
+            del self._connections[key]
+
+    def closeCachedConnections(self):
+        """ Close every connection. Returns a Deferred which fires once they are closed """
+        for connection in self._connections.values():
+            connection.goingAway = True
+            connection.transport.loseConnection()
+        self._connections.clear()
+        return defer.succeed(None)
+
+    def stats(self):
+        """
+        Returns a dictionary describing the pool.
+
+        connections: Open HTTP/2 connections
+        streams: Requests in flight on the connections
+        pending: Requests waiting for a stream
+        requests: Total connections handed out by the pool
+        created: Total connections opened by the pool
+        http1_hosts: Hosts which did not negotiate h2
+        """
+        connections = self._connections.values()
+        return {
+            'connections': len(connections),
+            'streams': sum(len(connection.streams) for connection in connections),
+            'pending': sum(len(connection.pending) for connection in connections),
+            'requests': self.requests,
+            'created': self.created,
+            'http1_hosts': len(self._http1),
+        }
+
+
+_shared_pools = {}
+
+
+def shared_h2_pool(reactor):
+    """
+    Returns the H2ConnectionPool shared by every agent using the reactor.
+    The pool is created on first use and closed before the reactor shuts down.
+    """
+    pool = _shared_pools.get(reactor)
+    if pool is None:
+        pool = _shared_pools[reactor] = H2ConnectionPool(reactor)
+        if IReactorCore.providedBy(reactor):
+            reactor.addSystemEventTrigger('before', 'shutdown', _close_shared_h2_pool, reactor)
+    return pool
+
+
+def _close_shared_h2_pool(reactor):
+    pool = _shared_pools.pop(reactor, None)
+    if pool is not None:
+        return pool.closeCachedConnections()
+    return None
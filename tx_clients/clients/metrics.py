@@ -0,0 +1,253 @@
+import math
+from urlparse import urlsplit
+
+from zope.interface import implementer
+
+from twisted.internet.interfaces import IStreamClientEndpoint
+
+
+class RequestMetrics(object):
+    """
+    Timings, in seconds from the start of the request, and sizes of a single
+    request made by a BasicAgent. See: BasicAgent.addObserver
+
+    connect: Seconds spent resolving and connecting, including the TLS
+        handshake for endpoints which complete it before connecting. None when
+        a pooled connection was reused.
+    headers: Seconds until the response headers arrived, time to first byte
+    body: Seconds spent receiving the body after the headers
+    total: Seconds until the response was complete or failed
+    reused: Whether a pooled connection served the request
+    bytesOut: Bytes in the request body or None when the length is unknown
+    bytesIn: Body bytes received on the wire
+    code: The status code of the response
+    failure: A twisted.python.failure.Failure when the request failed
+    """
+    __slots__ = ('method', 'uri', 'started', 'connect', 'headers', 'body', 'total', 'reused',
+                 'bytesOut', 'bytesIn', 'code', 'failure')
+
+    def __init__(self, method, uri, started):
+        self.method = method
+        self.uri = uri
+        self.started = started
+        self.connect = None
+        self.headers = None
+        self.body = None
+        self.total = None
+        self.reused = None
+        self.bytesOut = None
+        self.bytesIn = None
+        self.code = None
+        self.failure = None
+
+    @property
+    def host(self):
+        """ The host[:port] the request was sent to """
+        return urlsplit(self.uri).netloc
+
+
+@implementer(IStreamClientEndpoint)
+class TimedEndpoint(object):
+    """ Records how long connecting takes on a RequestMetrics. See: IStreamClientEndpoint """
+    def __init__(self, endpoint, metrics, clock):
+        self._endpoint = endpoint
+        self._metrics = metrics
+        self._clock = clock
+
+    def connect(self, protocolFactory):
+        started = self._clock.seconds()
+        self._metrics.reused = False
+        d = self._endpoint.connect(protocolFactory)
+        d.addCallback(self._cbConnected, started)
+        return d
+
+    def _cbConnected(self, protocol, started):
+        self._metrics.connect = self._clock.seconds() - started
+        return protocol
+
+
+class Histogram(object):
+    """
+    A log linear histogram in the style of HdrHistogram. Values are recorded
+    into buckets which keep significantFigures decimal digits of precision
+    whatever the magnitude of the value, so memory does not grow with the
+    number of values and recording is constant time.
+
+    Values are stored as integer multiples of unit, microseconds by default.
+
+    Usage:
+        histogram = Histogram()
+        histogram.record(0.0123)
+        print histogram.percentile(0.99)
+    """
+    def __init__(self, significantFigures=2, unit=1e-6):
+        """
+        significantFigures: Decimal digits of precision kept, 1 to 5
+        unit: The smallest value distinguished
+        """
+        self.unit = unit
+        self._subBucketBits = int(math.ceil(math.log(2 * 10 ** significantFigures, 2)))
+        self._subBucketCount = 1 << self._subBucketBits
+        self._subBucketHalf = self._subBucketCount >> 1
+        self._counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        """ Record a value. Negative values are recorded as 0 """
+        value = max(value, 0)
+        index = self._index(int(value / self.unit))
+        self._counts[index] = self._counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        """
+        Returns the value below which percentile, 0.0 to 1.0, of the recorded
+        values fall or None when nothing has been recorded.
+        """
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(percentile * self.count)), 1)
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen >= rank:
+                return min(max(self._value(index), self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def stats(self, percentiles=(0.5, 0.9, 0.99)):
+        """ Returns a dictionary with count, min, mean, max and p50 style percentiles """
+        stats = {
+            'count': self.count,
+            'min': self.min,
+            'mean': self.mean,
+            'max': self.max,
+        }
+        for percentile in percentiles:
+            stats['p{:g}'.format(percentile * 100)] = self.percentile(percentile)
+        return stats
+
+    def _index(self, value):
+        if value < self._subBucketCount:
+            return value
+        shift = value.bit_length() - self._subBucketBits
+        return self._subBucketCount + (shift - 1) * self._subBucketHalf + (
+            (value >> shift) - self._subBucketHalf
+        )
+
+    def _value(self, index):
+        """ Returns the value in the middle of the bucket at index """
+        if index < self._subBucketCount:
+            return index * self.unit
+        shift, offset = divmod(index - self._subBucketCount, self._subBucketHalf)
+        shift += 1
+        lowest = (offset + self._subBucketHalf) << shift
+        return (lowest + (1 << shift) / 2.0) * self.unit
+
+
+class _Aggregate(object):
+    def __init__(self, phases, significantFigures):
+        self.requests = 0
+        self.failures = 0
+        self.reused = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.codes = {}
+        self.histograms = dict(
+            (phase, Histogram(significantFigures)) for phase in phases
+        )
+
+    def record(self, metrics):
+        self.requests += 1
+        if metrics.failure is not None:
+            self.failures += 1
+        if metrics.reused:
+            self.reused += 1
+        if metrics.code is not None:
+            self.codes[metrics.code] = self.codes.get(metrics.code, 0) + 1
+        self.bytesIn += metrics.bytesIn or 0
+        self.bytesOut += metrics.bytesOut or 0
+        for phase, histogram in self.histograms.iteritems():
+            value = getattr(metrics, phase)
+            if value is not None:
+                histogram.record(value)
+
+    def stats(self, percentiles):
+        stats = {
+            'requests': self.requests,
+            'failures': self.failures,
+            'reused': self.reused,
+            'bytes_in': self.bytesIn,
+            'bytes_out': self.bytesOut,
+            'codes': dict(self.codes),
+        }
+        for phase, histogram in self.histograms.iteritems():
+            stats[phase] = histogram.stats(percentiles)
+        return stats
+
+
+class MetricsAggregator(object):
+    """
+    An observer which aggregates RequestMetrics in memory by host and method.
+    Each phase is recorded in a Histogram so memory use is bounded by the
+    number of hosts and methods, not the number of requests.
+
+    Usage:
+        aggregator = MetricsAggregator()
+        agent = BasicAgent(reactor)
+        agent.addObserver(aggregator)
+        ...
+        print aggregator.stats()[('api.example.com', 'GET')]['total']['p99']
+    """
+    phases = ('connect', 'headers', 'body', 'total')
+    percentiles = (0.5, 0.9, 0.99)
+
+    def __init__(self, significantFigures=2, phases=None, percentiles=None):
+        """
+        significantFigures: Precision of the histograms. See: Histogram
+        phases: The RequestMetrics timings recorded
+        percentiles: The percentiles included in stats()
+        """
+        self.significantFigures = significantFigures
+        if phases is not None:
+            self.phases = tuple(phases)
+        if percentiles is not None:
+            self.percentiles = tuple(percentiles)
+        self._aggregates = {}
+
+    def __call__(self, metrics):
+        key = (metrics.host, metrics.method)
+        aggregate = self._aggregates.get(key)
+        if aggregate is None:
+            aggregate = self._aggregates[key] = _Aggregate(self.phases, self.significantFigures)
+        aggregate.record(metrics)
+
+    def histogram(self, host, method, phase):
+        """ Returns the Histogram of phase for host and method or None """
+        aggregate = self._aggregates.get((host, method))
+        return aggregate.histograms.get(phase) if aggregate is not None else None
+
+    def stats(self):
+        """
+        Returns a dictionary keyed by (host, method) of dictionaries with
+        requests, failures, reused, bytes_in, bytes_out, codes and the
+        Histogram stats of each phase.
+        """
+        return dict(
+            (key, aggregate.stats(self.percentiles))
+            for key, aggregate in self._aggregates.iteritems()
+        )
+
+    def reset(self):
+        self._aggregates.clear()
@@ -0,0 +1,138 @@
+# pylint: disable=protected-access
+from twisted.internet.interfaces import IReactorCore
+from twisted.web import client
+from twisted.web._newclient import HTTP11ClientProtocol
+
+
+class _TrackedHTTP11ClientProtocol(HTTP11ClientProtocol):
+    """ Tells the pool when the connection is lost """
+    def __init__(self, quiescentCallback, lostCallback):
+        HTTP11ClientProtocol.__init__(self, quiescentCallback)
+        self._lostCallback = lostCallback
+
+    def connectionLost(self, reason):
+        HTTP11ClientProtocol.connectionLost(self, reason)
+        self._lostCallback(self)
+
+
+class _TrackedHTTP11ClientFactory(client._HTTP11ClientFactory):
+    def __init__(self, quiescentCallback, lostCallback):
+        client._HTTP11ClientFactory.__init__(self, quiescentCallback)
+        self._lostCallback = lostCallback
+
+    def buildProtocol(self, addr):
+        return _TrackedHTTP11ClientProtocol(self._quiescentCallback, self._lostCallback)
+
+
+class BasicConnectionPool(client.HTTPConnectionPool):
+    """ See: twisted.web.client.HTTPConnectionPool
+
+    A persistent connection pool with defaults tuned for api clients that make
+    many requests to a small number of hosts. Reusing a cached connection
+    avoids a TCP and TLS handshake per request.
+
+    - Connections are persistent
+    - Up to maxPersistentPerHost idle connections are cached per host:port
+    - Idle connections are closed after cachedConnectionTimeout seconds
+    - Idempotent requests which fail on a stale cached connection are retried
+    once on a new connection. See: retryAutomatically
+
+    The pool tracks connection usage which can be inspected with stats()
+    """
+    maxPersistentPerHost = 10
+    cachedConnectionTimeout = 120
+    retryAutomatically = True
+
+    def __init__(self, reactor, persistent=True, maxPersistentPerHost=None,
+                 cachedConnectionTimeout=None, retryAutomatically=None):
+        """
+        reactor: See: twisted.internet.interfaces.IReactorTime
+        persistent: When False connections are closed after each request.
+        maxPersistentPerHost: Maximum number of idle connections per host:port.
+        cachedConnectionTimeout: Seconds an idle connection stays open.
+        retryAutomatically: Retry idempotent requests on stale connections.
+        Options which are None use the class defaults.
+        """
+        client.HTTPConnectionPool.__init__(self, reactor, persistent)
+        if maxPersistentPerHost is not None:
+            self.maxPersistentPerHost = maxPersistentPerHost
+        if cachedConnectionTimeout is not None:
+            self.cachedConnectionTimeout = cachedConnectionTimeout
+        if retryAutomatically is not None:
+            self.retryAutomatically = retryAutomatically
+        self._protocols = set()
+        self.requests = 0
+        self.created = 0
+        self.reused = 0
+
+    def getConnection(self, key, endpoint):
+        """ See: twisted.web.client.HTTPConnectionPool.getConnection """
+        self.requests += 1
+        connections = self._connections.get(key, ())
+        if any(connection.state == 'QUIESCENT' for connection in connections):
+            self.reused += 1
+        return client.HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        self.created += 1
+        d = client.HTTPConnectionPool._newConnection(self, key, endpoint)
+        d.addCallback(self._cbTrackConnection)
+        return d
+
+    def _factory(self, quiescentCallback):
+        return _TrackedHTTP11ClientFactory(quiescentCallback, self._protocols.discard)
+
+    def _cbTrackConnection(self, protocol):
+        if protocol.state != 'CONNECTION_LOST':
+            self._protocols.add(protocol)
+        return protocol
+
+    def stats(self):
+        """
+        Returns a dictionary describing the current state of the pool.
+
+        open: Connections which have not been lost
+        idle: Open connections cached in the pool waiting for a request
+        in_use: Open connections currently serving a request
+        requests: Total connections handed out by the pool
+        created: Total connections opened by the pool
+        reused: Total requests served by a cached connection
+        """
+        idle = sum(
+            1 for connections in self._connections.itervalues()
+            for connection in connections if connection.state == 'QUIESCENT'
+        )
+        opened = sum(
+            1 for protocol in self._protocols if protocol.state != 'CONNECTION_LOST'
+        )
+        return {
+            'open': opened,
+            'idle': idle,
+            'in_use': max(opened - idle, 0),
+            'requests': self.requests,
+            'created': self.created,
+            'reused': self.reused,
+        }
+
+
+_shared_pools = {}
+
+
+def shared_pool(reactor):
+    """
+    Returns the BasicConnectionPool shared by every agent using the reactor.
+    The pool is created on first use and closed before the reactor shuts down.
+    """
+    pool = _shared_pools.get(reactor)
+    if pool is None:
+        pool = _shared_pools[reactor] = BasicConnectionPool(reactor)
+        if IReactorCore.providedBy(reactor):
+            reactor.addSystemEventTrigger('before', 'shutdown', _close_shared_pool, reactor)
+    return pool
+
+
+def _close_shared_pool(reactor):
+    pool = _shared_pools.pop(reactor, None)
+    if pool is not None:
+        return pool.closeCachedConnections()
+    return None
@@ -0,0 +1,372 @@
+# pylint: disable=too-many-instance-attributes
+"""
+A caching DNS resolver and a Happy Eyeballs endpoint for the agents.
+See: BasicAgent(resolver=...)
+
+By default the reactor resolves each new connection with a blocking lookup
+in its thread pool and keeps nothing. CachingResolver queries the A and AAAA
+records of a hostname concurrently with twisted.names, caches the answer for
+its TTL and shares one lookup between concurrent connections to a host.
+HappyEyeballsEndpoint races connections to the addresses of a host so an
+unreachable address family only delays a connection by attemptDelay.
+"""
+import socket
+from collections import OrderedDict
+
+from zope.interface import implementer
+
+from twisted.internet import defer, error
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.internet.endpoints import TCP4ClientEndpoint, TCP6ClientEndpoint, wrapClientTLS
+from twisted.internet.interfaces import IStreamClientEndpoint
+from twisted.names import dns
+from twisted.names.error import DNSNameError
+from twisted.python import failure
+from twisted.web.client import SchemeNotSupported
+
+from tx_clients.clients.metrics import Histogram
+
+
+class _Entry(object):
+    __slots__ = ('addresses', 'failure', 'expires')
+
+    def __init__(self, addresses, reason, expires):
+        self.addresses = addresses
+        self.failure = reason
+        self.expires = expires
+
+
+def _interleave(first, second):
+    """ Alternate the items of first and second starting with first. See: RFC 8305 """
+    ordered = []
+    for i in xrange(max(len(first), len(second))):
+        ordered.extend(first[i:i + 1])
+        ordered.extend(second[i:i + 1])
+    return ordered
+
+
+class CachingResolver(object):
+    """
+    Resolves hostnames to their IPv6 and IPv4 addresses with asynchronous DNS
+    queries.
+
+    - Answers are cached for their TTL, at most maxTTL seconds
+    - Hostnames which do not exist or have no address are cached for
+      negativeTTL seconds. Failed queries, such as timeouts, are not cached.
+    - Concurrent lookups of a hostname share one query
+    - Up to maxEntries hostnames are cached, the oldest are evicted first
+
+    The hit rate and lookup latency can be inspected with stats()
+
+    Usage:
+        resolver = CachingResolver()
+        agent = BasicAgent(reactor, resolver=resolver)
+        print resolver.stats()
+    """
+    maxTTL = 300
+    negativeTTL = 30
+    maxEntries = 10000
+
+    def __init__(self, clock=None, resolver=None, maxTTL=None, negativeTTL=None, maxEntries=None):
+        """
+        clock: See: twisted.internet.interfaces.IReactorTime
+        resolver: The twisted.internet.interfaces.IResolver which is queried.
+            By default twisted.names.client.createResolver() which reads
+            /etc/hosts and /etc/resolv.conf.
+        maxTTL: Maximum seconds an answer is cached
+        negativeTTL: Seconds a hostname without addresses is cached
+        maxEntries: Maximum number of cached hostnames
+        Options which are None use the class defaults.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+        self._resolver = resolver
+        if maxTTL is not None:
+            self.maxTTL = maxTTL
+        if negativeTTL is not None:
+            self.negativeTTL = negativeTTL
+        if maxEntries is not None:
+            self.maxEntries = maxEntries
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self.latency = Histogram()
+        self.lookups = 0
+        self.hits = 0
+        self.negativeHits = 0
+        self.joined = 0
+        self.misses = 0
+        self.failures = 0
+
+    def resolve(self, host):
+        """
+        Returns a Deferred which fires with a list of the (family, address)
+        of host, alternating IPv6 and IPv4 addresses starting with IPv6. Fails
+        with twisted.internet.error.DNSLookupError when host has no address.
+        IP addresses are returned as is.
+        """
+        if isIPAddress(host):
+            return defer.succeed([(socket.AF_INET, host)])
+        if isIPv6Address(host):
+            return defer.succeed([(socket.AF_INET6, host)])
+        self.lookups += 1
+        entry = self._cache.get(host)
+        if entry is not None:
+            if entry.expires > self._clock.seconds():
+                if entry.failure is not None:
+                    self.negativeHits += 1
+                    return defer.fail(entry.failure)
+                self.hits += 1
+                return defer.succeed(list(entry.addresses))
+            del self._cache[host]
+        waiting = self._inflight.get(host)
+        query = waiting is None
+        if query:
+            self.misses += 1
+            waiting = self._inflight[host] = []
+        else:
+            self.joined += 1
+        d = defer.Deferred(waiting.remove)
+        waiting.append(d)
+        if query:
+            self._query(host)
+        return d
+
+    def _query(self, host):
+        if self._resolver is None:
+            from twisted.names.client import createResolver
+            self._resolver = createResolver()
+        started = self._clock.seconds()
+        d = defer.DeferredList([
+            self._resolver.lookupIPV6Address(host), self._resolver.lookupAddress(host)
+        ], consumeErrors=True)
+        d.addCallback(self._cbQuery, host, started)
+
+    def _cbQuery(self, results, host, started):
+        now = self._clock.seconds()
+        self.latency.record(now - started)
+        found = {socket.AF_INET6: [], socket.AF_INET: []}
+        ttls = []
+        missing = True
+        for (success, result), family, recordType in zip(
+                results, (socket.AF_INET6, socket.AF_INET), (dns.AAAA, dns.A)):
+            if not success:
+                missing = missing and result.check(DNSNameError) is not None
+                continue
+            for record in result[0]:
+                if record.type == recordType:
+                    found[family].append((family, socket.inet_ntop(family, record.payload.address)))
+                    ttls.append(record.ttl)
+        addresses = _interleave(found[socket.AF_INET6], found[socket.AF_INET])
+        reason = None
+        if addresses:
+            self._store(host, _Entry(addresses, None, now + min(min(ttls), self.maxTTL)))
+        else:
+            self.failures += 1
+            reason = failure.Failure(error.DNSLookupError(host))
+            if missing:
+                self._store(host, _Entry(None, reason, now + self.negativeTTL))
+        for d in self._inflight.pop(host):
+            if reason is None:
+                d.callback(list(addresses))
+            else:
+                d.errback(reason)
+
+    def _store(self, host, entry):
+        self._cache[host] = entry
+        while len(self._cache) > self.maxEntries:
+            self._cache.popitem(False)
+
+    def clear(self):
+        """ Forget every cached answer """
+        self._cache.clear()
+
+    def stats(self):
+        """
+        Returns a dictionary describing the resolver.
+
+        lookups: Hostnames resolved. IP addresses are not counted.
+        hits: Lookups answered from the cache
+        negative_hits: Lookups failed from the cache
+        joined: Lookups which shared a query in flight
+        misses: Lookups which sent a query
+        failures: Queries which found no address
+        hit_rate: The fraction of lookups which did not send a query
+        entries: Cached hostnames
+        latency: Seconds per query. See: Histogram.stats
+        """
+        answered = self.hits + self.negativeHits + self.joined
+        return {
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'negative_hits': self.negativeHits,
+            'joined': self.joined,
+            'misses': self.misses,
+            'failures': self.failures,
+            'hit_rate': float(answered) / self.lookups if self.lookups else None,
+            'entries': len(self._cache),
+            'latency': self.latency.stats(),
+        }
+
+
+class _Race(object):
+    """ One connect() of a HappyEyeballsEndpoint """
+    def __init__(self, endpoint, protocolFactory):
+        self.endpoint = endpoint
+        self.protocolFactory = protocolFactory
+        self.deferred = defer.Deferred(self.cancel)
+        self.addresses = []
+        self.attempts = []
+        self.resolving = None
+        self.delayed = None
+        self.failure = None
+        self.done = False
+
+    def start(self):
+        self.resolving = self.endpoint._resolver.resolve(self.endpoint._host)
+        self.resolving.addCallbacks(self.cbResolved, self.ebResolved)
+
+    def cbResolved(self, addresses):
+        self.resolving = None
+        self.addresses = list(addresses)
+        self.attempt()
+
+    def ebResolved(self, reason):
+        self.resolving = None
+        if not self.done:
+            self.done = True
+            self.deferred.errback(reason)
+
+    def attempt(self):
+        """ Start a connection to the next address """
+        self.delayed = None
+        if self.done:
+            return
+        if not self.addresses:
+            if not self.attempts:
+                self.done = True
+                self.deferred.errback(self.failure or failure.Failure(
+                    error.ConnectError(string='No address to connect to')
+                ))
+            return
+        family, address = self.addresses.pop(0)
+        d = self.endpoint._endpointFor(family, address).connect(self.protocolFactory)
+        self.attempts.append(d)
+        d.addCallbacks(self.cbConnected, self.ebConnected, callbackArgs=(d,), errbackArgs=(d,))
+        if self.addresses and self.delayed is None and not self.done:
+            self.delayed = self.endpoint._reactor.callLater(
+                self.endpoint._attemptDelay, self.attempt
+            )
+
+    def cbConnected(self, protocol, d):
+        self.attempts.remove(d)
+        if self.done:
+            # Another address won the race.
+            protocol.transport.loseConnection()
+            return
+        self.done = True
+        self._stop()
+        self.deferred.callback(protocol)
+
+    def ebConnected(self, reason, d):
+        self.attempts.remove(d)
+        if self.done:
+            return
+        self.failure = reason
+        if self.delayed is not None:
+            self.delayed.cancel()
+        self.attempt()
+
+    def _stop(self):
+        if self.delayed is not None:
+            self.delayed.cancel()
+            self.delayed = None
+        for d in list(self.attempts):
+            d.cancel()
+
+    def cancel(self, _):
+        self.done = True
+        if self.resolving is not None:
+            self.resolving.cancel()
+        self._stop()
+
+
+@implementer(IStreamClientEndpoint)
+class HappyEyeballsEndpoint(object):
+    """
+    Connects to the first address of host which accepts a connection.
+    Addresses are tried in the order of the resolver. The next attempt starts
+    after attemptDelay seconds, or as soon as the previous one fails, and the
+    other attempts are cancelled once one succeeds. See: RFC 8305
+    """
+    attemptDelay = 0.25
+
+    def __init__(self, reactor, resolver, host, port, timeout=30, bindAddress=None,
+                 attemptDelay=None):
+        """
+        resolver: A CachingResolver
+        timeout: Seconds each connection attempt may take
+        bindAddress: The (host, port) the connection is made from
+        attemptDelay: Seconds between connection attempts
+        """
+        self._reactor = reactor
+        self._resolver = resolver
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._bindAddress = bindAddress
+        self._attemptDelay = attemptDelay if attemptDelay is not None else self.attemptDelay
+
+    def connect(self, protocolFactory):
+        race = _Race(self, protocolFactory)
+        race.start()
+        return race.deferred
+
+    def _endpointFor(self, family, address):
+        endpoint = TCP6ClientEndpoint if family == socket.AF_INET6 else TCP4ClientEndpoint
+        return endpoint(self._reactor, address, self._port, self._timeout, self._bindAddress)
+
+
+class ResolvingEndpointFactory(object):
+    """
+    A twisted.web.iweb.IAgentEndpointFactory which connects with a
+    HappyEyeballsEndpoint and adds TLS for https.
+    """
+    def __init__(self, reactor, resolver, contextFactory, connectTimeout=None,
+                 bindAddress=None):
+        """
+        resolver: A CachingResolver
+        contextFactory: A twisted.web.iweb.IPolicyForHTTPS
+        See: twisted.web.client.Agent
+        """
+        self._reactor = reactor
+        self._resolver = resolver
+        self._policyForHTTPS = contextFactory
+        self._connectTimeout = connectTimeout if connectTimeout is not None else 30
+        self._bindAddress = bindAddress
+
+    def endpointForURI(self, uri):
+        endpoint = HappyEyeballsEndpoint(
+            self._reactor, self._resolver, uri.host, uri.port, self._connectTimeout,
+            self._bindAddress
+        )
+        if uri.scheme == 'http':
+            return endpoint
+        if uri.scheme == 'https':
+            return wrapClientTLS(self._policyForHTTPS.creatorForNetloc(uri.host, uri.port),
+                                 endpoint)
+        raise SchemeNotSupported('Unsupported scheme: {!r}'.format(uri.scheme))
+
+
+_shared_resolvers = {}
+
+
+def shared_resolver(reactor):
+    """
+    Returns the CachingResolver shared by every agent using the reactor.
+    The resolver is created on first use.
+    """
+    resolver = _shared_resolvers.get(reactor)
+    if resolver is None:
+        resolver = _shared_resolvers[reactor] = CachingResolver(reactor)
+    return resolver
@@ -0,0 +1,213 @@
+import heapq
+import itertools
+
+from twisted.internet import defer
+from twisted.web.client import URI
+
+from tx_clients.clients.http import AgentWrapper
+
+
+def host_key(uri):
+    """ Returns the (scheme, host, port) a request for uri connects to """
+    parsed = URI.fromBytes(uri)
+    return (parsed.scheme, parsed.host, parsed.port)
+
+
+class _QueuedCall(object):
+    def __init__(self, key, priority, sequence, queued, fn, args, kwargs):
+        self.key = key
+        self.priority = priority
+        self.sequence = sequence
+        self.queued = queued
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.deferred = None
+        self.running = None
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class RequestScheduler(object):
+    """
+    Limits the number of calls in flight globally and per key. Calls which can
+    not run yet wait in a queue per key. Lower priorities run first and calls
+    with the same priority run in the order they were submitted.
+
+    Cancelling the Deferred of a queued call removes it from the queue.
+    Cancelling a running call cancels the Deferred returned by the call.
+    """
+    def __init__(self, maxConcurrent=100, maxPerKey=10, clock=None):
+        """
+        maxConcurrent: Maximum number of calls in flight. None is unbounded.
+        maxPerKey: Maximum number of calls in flight per key. None is unbounded.
+        clock: See: twisted.internet.interfaces.IReactorTime
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.maxConcurrent = maxConcurrent
+        self.maxPerKey = maxPerKey
+        self._clock = clock
+        self._queues = {}
+        self._active = {}
+        self._sequence = itertools.count()
+        self._dispatching = False
+        self.active = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.submitted = 0
+        self.cancelled = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def submit(self, key, priority, fn, *args, **kwargs):
+        """
+        Returns a Deferred which fires with the result of fn(*args, **kwargs)
+        once the call has been allowed to run.
+
+        key: Calls with the same key share the maxPerKey limit.
+        priority: Calls with a lower priority run first.
+        """
+        self.submitted += 1
+        call = _QueuedCall(
+            key, priority, next(self._sequence), self._clock.seconds(), fn, args, kwargs
+        )
+        call.deferred = defer.Deferred(lambda _: self._cancel(call))
+        heapq.heappush(self._queues.setdefault(key, []), call)
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        self._dispatch()
+        return call.deferred
+
+    def stats(self):
+        """
+        Returns a dictionary describing the scheduler.
+
+        active: Calls in flight
+        queued: Calls waiting to run
+        max_queued: The deepest the queue has been
+        submitted: Total calls submitted
+        cancelled: Calls cancelled while waiting
+        wait_seconds: Total seconds calls have waited to run
+        max_wait_seconds: The longest a call has waited to run
+        queued_per_key: Calls waiting to run for each key
+        """
+        return {
+            'active': self.active,
+            'queued': self.queued,
+            'max_queued': self.max_queued,
+            'submitted': self.submitted,
+            'cancelled': self.cancelled,
+            'wait_seconds': self.wait_seconds,
+            'max_wait_seconds': self.max_wait_seconds,
+            'queued_per_key': dict(
+                (key, len(queue)) for key, queue in self._queues.iteritems() if queue
+            ),
+        }
+
+    def _runnable(self, key):
+        return self.maxPerKey is None or self._active.get(key, 0) < self.maxPerKey
+
+    def _next(self):
+        """ Returns the queued call which should run next or None """
+        best = None
+        for key, queue in self._queues.iteritems():
+            if queue and self._runnable(key) and (best is None or queue[0] < best):
+                best = queue[0]
+        return best
+
+    def _dispatch(self):
+        if self._dispatching:
+            # Calls which finish synchronously during the loop are picked up by
+            # the loop instead of recursing.
+            return
+        self._dispatching = True
+        try:
+            while self.maxConcurrent is None or self.active < self.maxConcurrent:
+                call = self._next()
+                if call is None:
+                    return
+                self._pop(call)
+                self._run(call)
+        finally:
+            self._dispatching = False
+
+    def _pop(self, call):
+        queue = self._queues[call.key]
+        heapq.heappop(queue)
+        if not queue:
+            del self._queues[call.key]
+        self.queued -= 1
+
+    def _run(self, call):
+        waited = self._clock.seconds() - call.queued
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        self.active += 1
+        self._active[call.key] = self._active.get(call.key, 0) + 1
+        call.running = defer.maybeDeferred(call.fn, *call.args, **call.kwargs)
+        call.running.addBoth(self._finished, call)
+
+    def _finished(self, result, call):
+        self.active -= 1
+        self._active[call.key] -= 1
+        if not self._active[call.key]:
+            del self._active[call.key]
+        if not call.cancelled:
+            call.deferred.callback(result)
+        self._dispatch()
+
+    def _cancel(self, call):
+        call.cancelled = True
+        if call.running is not None:
+            call.running.cancel()
+            return
+        queue = self._queues[call.key]
+        queue.remove(call)
+        heapq.heapify(queue)
+        if not queue:
+            del self._queues[call.key]
+        self.queued -= 1
+        self.cancelled += 1
+
+
+class SchedulingAgent(AgentWrapper):
+    """
+    See: AgentWrapper
+
+    Limits the number of requests in flight globally and per host:port.
+    Requests which can not be sent yet wait in a queue for their host.
+    See: RequestScheduler
+
+    A request is in flight until the Deferred returned by the wrapped agent
+    fires. For streamed responses that is when the headers arrive.
+
+    Usage:
+        agent = SchedulingAgent(BasicAgent(reactor), maxConcurrent=50, maxPerHost=10)
+        d = agent.get(url, priority=-1)
+        # Queued requests may be cancelled before they are sent.
+        d.cancel()
+    """
+    def __init__(self, agent, maxConcurrent=100, maxPerHost=10, scheduler=None, clock=None):
+        """
+        agent: The BasicAgent or AgentWrapper which performs the requests
+        maxConcurrent: Maximum number of requests in flight
+        maxPerHost: Maximum number of requests in flight per host:port
+        scheduler: A RequestScheduler which may be shared between agents. When
+            given maxConcurrent, maxPerHost and clock are ignored.
+        """
+        AgentWrapper.__init__(self, agent)
+        if scheduler is None:
+            scheduler = RequestScheduler(maxConcurrent, maxPerHost, clock)
+        self.scheduler = scheduler
+
+    def request(self, method, uri, headers=None, data=None, priority=0, **kwargs):
+        """
+        See: BasicAgent.request
+        priority: Requests with a lower priority are sent first
+        """
+        return self.scheduler.submit(
+            host_key(uri), priority, self.agent.request, method, uri, headers, data, **kwargs
+        )
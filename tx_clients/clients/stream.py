@@ -0,0 +1,455 @@
+import zlib
+from collections import deque
+
+from twisted.internet import defer, protocol
+from twisted.python import failure
+from twisted.web.client import ResponseDone, ResponseFailed
+
+from tx_clients.exceptions import ResponseTooLarge, TimeoutError
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class BodyStream(protocol.Protocol):
+    """
+    A protocol which exposes the body of a twisted.web.iweb.IResponse
+    incrementally as it arrives instead of buffering the whole body.
+    See: twisted.web.iweb.IResponse.deliverBody
+
+    Chunks may be pulled one at a time with read() or pushed to a callable with
+    each(). Only one style may be used per stream.
+
+    Backpressure is applied to the transport. When more than bufferSize bytes
+    are waiting to be consumed, or a callable passed to each() returns an
+    unfired Deferred, the transport is paused until the consumer catches up.
+
+    When maxBodySize is exceeded the connection is dropped and the consumer
+    receives a tx_clients.exceptions.ResponseTooLarge failure.
+
+    When no data arrives for idleTimeout seconds the connection is dropped
+    and the consumer receives a tx_clients.exceptions.TimeoutError failure.
+    Time spent paused by the consumer does not count.
+
+    Usage:
+        response = yield agent.get(url, stream=True)
+        chunk = yield response.stream.read()
+        while chunk:
+            process(chunk)
+            chunk = yield response.stream.read()
+    """
+    bufferSize = 2 ** 20
+
+    def __init__(self, maxBodySize=None, bufferSize=None, idleTimeout=None, clock=None):
+        """
+        maxBodySize: Maximum number of bytes accepted. None is unbounded.
+        bufferSize: Number of unconsumed bytes at which the transport pauses.
+        idleTimeout: Maximum seconds between chunks. None is unbounded.
+        clock: See: twisted.internet.interfaces.IReactorTime
+        """
+        self.maxBodySize = maxBodySize
+        if bufferSize is not None:
+            self.bufferSize = bufferSize
+        self.idleTimeout = idleTimeout
+        if clock is None and idleTimeout is not None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+        self._idleCall = None
+        self.received = 0
+        self.finished = False
+        self._buffer = deque()
+        self._buffered = 0
+        self._readers = deque()
+        self._sink = None
+        self._sinkDone = None
+        self._waiting = None
+        self._reason = None
+        self._paused = False
+        self._finishNotifications = []
+
+    def connectionMade(self):
+        self._resetIdle()
+
+    def dataReceived(self, data):
+        if self.finished:
+            return
+        self._resetIdle()
+        self.received += len(data)
+        if self.maxBodySize is not None and self.received > self.maxBodySize:
+            self.transport.stopProducing()
+            self._finish(ResponseTooLarge(
+                'Response body exceeded {} bytes'.format(self.maxBodySize)
+            ))
+            return
+        if self._readers:
+            self._readers.popleft().callback(data)
+        elif self._sink is not None and self._waiting is None:
+            self._push(data)
+        else:
+            self._buffer.append(data)
+            self._buffered += len(data)
+            if self._buffered > self.bufferSize:
+                self._pause()
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        if reason.check(ResponseDone):
+            self._finish(None)
+        else:
+            self._finish(reason)
+
+    def read(self):
+        """
+        Returns a Deferred which fires with the next chunk of the body or an
+        empty string when the body is complete.
+        """
+        if self._buffer:
+            data = self._buffer.popleft()
+            self._buffered -= len(data)
+            if self._paused and self._buffered <= self.bufferSize:
+                self._resume()
+            return defer.succeed(data)
+        if self.finished:
+            if self._reason is not None:
+                return defer.fail(self._reason)
+            return defer.succeed('')
+        d = defer.Deferred()
+        self._readers.append(d)
+        return d
+
+    def each(self, fn):
+        """
+        Calls fn with every chunk of the body as it arrives. If fn returns a
+        Deferred no more chunks are delivered until it fires.
+
+        Returns a Deferred which fires with the number of bytes received.
+        Cancelling it stops the stream.
+        """
+        self._sink = fn
+        self._sinkDone = defer.Deferred(lambda _: self.stop())
+        d = self._sinkDone
+        self._drain()
+        return d
+
+    def notifyFinish(self):
+        """
+        Returns a Deferred which fires with None once the whole body has been
+        received or fails with the reason the body is incomplete.
+        """
+        if self.finished:
+            if self._reason is not None:
+                return defer.fail(self._reason)
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._finishNotifications.append(d)
+        return d
+
+    def stop(self):
+        """ Stop receiving the body and close the connection. """
+        if not self.finished:
+            self.transport.stopProducing()
+            self._finish(defer.CancelledError())
+
+    def _push(self, data):
+        try:
+            result = self._sink(data)
+        except Exception:  # pylint: disable=broad-except
+            self._fireSink(failure.Failure())
+            self.stop()
+            return
+        if isinstance(result, defer.Deferred):
+            self._waiting = result
+            self._pause()
+            result.addCallbacks(self._cbSinkReady, self._ebSinkFailed)
+
+    def _cbSinkReady(self, _):
+        self._waiting = None
+        self._drain()
+
+    def _ebSinkFailed(self, reason):
+        self._waiting = None
+        self._fireSink(reason)
+        self.stop()
+
+    def _drain(self):
+        while self._buffer and self._waiting is None and self._sinkDone is not None:
+            data = self._buffer.popleft()
+            self._buffered -= len(data)
+            self._push(data)
+        if self._waiting is not None or self._sinkDone is None:
+            return
+        if self.finished:
+            if self._reason is not None:
+                self._fireSink(self._reason)
+            else:
+                self._fireSink(self.received)
+        elif self._paused:
+            self._resume()
+
+    def _fireSink(self, result):
+        d, self._sinkDone = self._sinkDone, None
+        if d is None:
+            return
+        if isinstance(result, (Exception, failure.Failure)):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def _resetIdle(self):
+        if self.idleTimeout is None or self.finished or self._paused:
+            return
+        if self._idleCall is not None and self._idleCall.active():
+            self._idleCall.reset(self.idleTimeout)
+        else:
+            self._idleCall = self._clock.callLater(self.idleTimeout, self._idle)
+
+    def _cancelIdle(self):
+        if self._idleCall is not None and self._idleCall.active():
+            self._idleCall.cancel()
+        self._idleCall = None
+
+    def _idle(self):
+        self._idleCall = None
+        self.transport.stopProducing()
+        self._finish(TimeoutError(
+            'No body data received for {} seconds'.format(self.idleTimeout)
+        ))
+
+    def _finish(self, reason):
+        if self.finished:
+            return
+        self.finished = True
+        self._cancelIdle()
+        self._reason = reason
+        while self._readers:
+            d = self._readers.popleft()
+            if reason is None:
+                d.callback('')
+            else:
+                d.errback(reason)
+        if self._sink is not None:
+            if reason is not None:
+                self._buffer.clear()
+                self._buffered = 0
+                if self._waiting is None:
+                    self._fireSink(reason)
+            else:
+                self._drain()
+        notifications, self._finishNotifications = self._finishNotifications, []
+        for d in notifications:
+            if reason is None:
+                d.callback(None)
+            else:
+                d.errback(reason)
+
+    def _pause(self):
+        if not self._paused and not self.finished:
+            self._paused = True
+            self._cancelIdle()
+            self.transport.pauseProducing()
+
+    def _resume(self):
+        if self._paused:
+            self._paused = False
+            if not self.finished:
+                self._resetIdle()
+                self.transport.resumeProducing()
+
+
+class _ZlibDecoder(object):
+    """ Decompresses zlib, gzip or raw deflate data in bounded steps """
+    def __init__(self, wbits):
+        self._zlib = zlib.decompressobj(wbits)
+        self.tail = ''
+
+    def decompress(self, data, maxLength):
+        """ Returns up to maxLength decoded bytes. The rest is kept in tail """
+        out = self._zlib.decompress(self.tail + data, maxLength)
+        self.tail = self._zlib.unconsumed_tail
+        return out
+
+    @property
+    def pending(self):
+        """ More decoded bytes may be returned without more input """
+        return bool(self.tail)
+
+    def flush(self):
+        return self._zlib.flush()
+
+
+class _DeflateDecoder(_ZlibDecoder):
+    """ The deflate content-coding is zlib wrapped but some servers send raw deflate """
+    def __init__(self):
+        _ZlibDecoder.__init__(self, zlib.MAX_WBITS)
+        self._started = False
+
+    def decompress(self, data, maxLength):
+        if self._started:
+            return _ZlibDecoder.decompress(self, data, maxLength)
+        self._started = True
+        try:
+            return _ZlibDecoder.decompress(self, data, maxLength)
+        except zlib.error:
+            self._zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+            return _ZlibDecoder.decompress(self, data, maxLength)
+
+
+class _BrotliDecoder(object):
+    """ Decompresses brotli data in bounded steps """
+    def __init__(self):
+        self._brotli = brotli.Decompressor()
+        self._full = False
+        self.tail = ''
+
+    def decompress(self, data, maxLength):
+        """
+        Returns about maxLength decoded bytes. brotli grows its output in
+        steps of at least 32 KiB. Input is kept in tail until the output of
+        the previous input has been returned.
+        """
+        self.tail += data
+        if self._full or not self._brotli.can_accept_more_data():
+            data = ''
+        else:
+            data, self.tail = self.tail, ''
+        out = self._brotli.process(data, output_buffer_limit=maxLength)
+        self._full = len(out) >= maxLength
+        return out
+
+    @property
+    def pending(self):
+        """ More decoded bytes may be returned without more input """
+        return bool(self.tail) or self._full or not self._brotli.can_accept_more_data()
+
+    def flush(self):
+        return ''
+
+
+DECODERS = {
+    'gzip': lambda: _ZlibDecoder(16 + zlib.MAX_WBITS),
+    'x-gzip': lambda: _ZlibDecoder(16 + zlib.MAX_WBITS),
+    'deflate': _DeflateDecoder,
+}
+# Releases of brotli before 1.2 can not bound the output of a step, so a small
+# chunk could expand without limit. They are not used.
+if brotli is not None and hasattr(brotli.Decompressor, 'can_accept_more_data'):
+    DECODERS['br'] = _BrotliDecoder
+
+# The value sent in the Accept-Encoding header of requests which decompress
+ACCEPT_ENCODING = ', '.join(name for name in ('gzip', 'deflate', 'br') if name in DECODERS)
+
+
+class DecodingProtocol(protocol.Protocol):
+    """
+    Decompresses a gzip, deflate or brotli (when the brotli package is
+    installed) response body before delivering it to another protocol.
+    See: DECODERS
+
+    Data is decompressed in chunkSize steps. The wrapped protocol receives this
+    object as its transport so pausing it stops decompression as well as the
+    connection.
+
+    When more than maxDecodedSize bytes are decoded the connection is dropped
+    and the wrapped protocol fails with tx_clients.exceptions.ResponseTooLarge.
+    This guards against decompression bombs.
+
+    received: Compressed bytes received on the wire
+    decoded: Decompressed bytes delivered
+
+    Usage:
+        stream = BodyStream()
+        response.deliverBody(DecodingProtocol(stream, 'gzip'))
+    """
+    chunkSize = 2 ** 16
+
+    def __init__(self, protocol, encoding, maxDecodedSize=None):
+        """
+        protocol: The protocol which receives the decoded body
+        encoding: The content-coding of the body. See: DECODERS
+        maxDecodedSize: Maximum number of decoded bytes. None is unbounded.
+        """
+        self.protocol = protocol
+        self.encoding = encoding
+        self.maxDecodedSize = maxDecodedSize
+        self.received = 0
+        self.decoded = 0
+        self._decoder = DECODERS[encoding]()
+        self._paused = False
+        self._stopped = False
+        self._finished = False
+        self._reason = None
+
+    def makeConnection(self, transport):
+        protocol.Protocol.makeConnection(self, transport)
+        self.protocol.makeConnection(self)
+
+    def dataReceived(self, data):
+        if self._finished:
+            return
+        self.received += len(data)
+        self._drain(data)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self._reason = reason
+        if not (self._paused and self._decoder.pending):
+            self._finish(reason)
+
+    def pauseProducing(self):
+        self._paused = True
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self._paused = False
+        self._drain('')
+        if self._paused or self._finished:
+            return
+        if self._reason is not None:
+            self._finish(self._reason)
+        else:
+            self.transport.resumeProducing()
+
+    def stopProducing(self):
+        self._stopped = True
+        self.transport.stopProducing()
+
+    def _drain(self, data):
+        if self._paused or self._stopped:
+            self._decoder.tail += data
+            return
+        try:
+            while not (self._paused or self._stopped):
+                self._deliver(self._decoder.decompress(data, self.chunkSize))
+                data = ''
+                if not self._decoder.pending:
+                    break
+        except Exception:  # pylint: disable=broad-except
+            self._fail(failure.Failure(ResponseFailed([failure.Failure()])))
+
+    def _deliver(self, data):
+        if not data or self._finished:
+            return
+        self.decoded += len(data)
+        if self.maxDecodedSize is not None and self.decoded > self.maxDecodedSize:
+            self._fail(failure.Failure(ResponseTooLarge(
+                'Decoded response body exceeded {} bytes'.format(self.maxDecodedSize)
+            )))
+            return
+        self.protocol.dataReceived(data)
+
+    def _fail(self, reason):
+        self.stopProducing()
+        self._finish(reason)
+
+    def _finish(self, reason):
+        if self._finished:
+            return
+        if reason.check(ResponseDone) and not self._stopped:
+            try:
+                self._deliver(self._decoder.flush())
+            except Exception:  # pylint: disable=broad-except
+                reason = failure.Failure(ResponseFailed([failure.Failure()]))
+            if self._finished:
+                return
+        self._finished = True
+        self.protocol.connectionLost(reason)
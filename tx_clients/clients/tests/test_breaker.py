@@ -0,0 +1,125 @@
+from twisted.trial import unittest
+
+from twisted.internet import defer, task
+
+from tx_clients.clients import breaker
+from tx_clients.clients.tests.test_scheduler import StubAgent
+from tx_clients.exceptions import CircuitOpenError, ServerError
+
+
+class Response(object):
+    def __init__(self, code):
+        self.code = code
+
+
+class TestCircuitBreakerAgent(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stub = StubAgent()
+        self.agent = breaker.CircuitBreakerAgent(
+            self.stub, failureRate=0.5, minRequests=4, windowSize=4, resetTimeout=10,
+            clock=self.clock
+        )
+        self.changes = []
+        self.agent.addStateChangeHook(lambda *args: self.changes.append(args))
+        self.url = 'http://example.com/'
+        self.key = ('http', 'example.com', 80)
+
+    def request(self, result, url=None):
+        d = self.agent.get(url or self.url)
+        if isinstance(result, Exception):
+            self.stub.requests[-1][1].errback(result)
+        else:
+            self.stub.requests[-1][1].callback(result)
+        return d
+
+    def trip(self):
+        for result in (Response(200), Response(200), Response(503), ValueError()):
+            self.request(result).addErrback(lambda _: None)
+
+    def test_open(self):
+        self.trip()
+        self.assertEqual(self.changes, [(self.key, breaker.CLOSED, breaker.OPEN)])
+        d = self.agent.get(self.url)
+        failure = self.failureResultOf(d, CircuitOpenError)
+        self.assertIsInstance(failure.value, ServerError)
+        self.assertEqual(len(self.stub.requests), 4)
+        self.assertEqual(self.agent.stats(), {
+            'rejected': 1, 'opened': 1, 'states': {self.key: breaker.OPEN}
+        })
+
+    def test_per_host(self):
+        self.trip()
+        self.request(Response(200), 'http://other.example.com/')
+        self.assertEqual(len(self.stub.requests), 5)
+
+    def test_below_threshold(self):
+        for result in (Response(200), Response(200), Response(200), Response(500)):
+            self.request(result)
+        self.assertEqual(self.agent.breaker(self.url).state, breaker.CLOSED)
+
+    def test_half_open(self):
+        self.trip()
+        self.clock.advance(10)
+        trial = self.agent.get(self.url)
+        self.assertEqual(self.changes[-1], (self.key, breaker.OPEN, breaker.HALF_OPEN))
+        self.failureResultOf(self.agent.get(self.url), CircuitOpenError)
+        self.stub.requests[-1][1].callback(Response(200))
+        self.successResultOf(trial)
+        self.assertEqual(self.changes[-1], (self.key, breaker.HALF_OPEN, breaker.CLOSED))
+        self.request(Response(500))
+        self.assertEqual(self.agent.breaker(self.url).state, breaker.CLOSED)
+
+    def test_half_open_failure(self):
+        self.trip()
+        self.clock.advance(10)
+        self.request(Response(502))
+        self.assertEqual(self.changes[-1], (self.key, breaker.HALF_OPEN, breaker.OPEN))
+        self.clock.advance(9)
+        self.failureResultOf(self.agent.get(self.url), CircuitOpenError)
+
+    def test_half_open_cancelled(self):
+        self.trip()
+        self.clock.advance(10)
+        d = self.agent.get(self.url)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.agent.get(self.url)
+        self.assertEqual(len(self.stub.requests), 6)
+
+    def test_stale_outcome_ignored(self):
+        slow = self.agent.get(self.url)
+        self.trip()
+        self.clock.advance(10)
+        trial = self.agent.get(self.url)
+        self.stub.requests[0][1].callback(Response(200))
+        self.successResultOf(slow)
+        self.assertEqual(self.agent.breaker(self.url).state, breaker.HALF_OPEN)
+        self.stub.requests[-1][1].callback(Response(500))
+        self.successResultOf(trial)
+        self.assertEqual(self.agent.breaker(self.url).state, breaker.OPEN)
+
+    def test_half_open_raises(self):
+        self.trip()
+        self.clock.advance(10)
+        self.patch(self.stub, 'request', lambda *args, **kwargs: 1 / 0)
+        self.failureResultOf(self.agent.get(self.url), ZeroDivisionError)
+        self.assertEqual(self.changes[-1], (self.key, breaker.HALF_OPEN, breaker.OPEN))
+        self.clock.advance(10)
+        self.assertTrue(self.agent.breaker(self.url).allow())
+
+    def test_slow_requests(self):
+        self.agent.slowRequestDuration = 1
+        for _ in range(4):
+            d = self.agent.get(self.url)
+            self.clock.advance(2)
+            self.stub.requests[-1][1].callback(Response(200))
+            self.successResultOf(d)
+        self.assertEqual(self.agent.breaker(self.url).state, breaker.OPEN)
+
+    def test_cancelled_not_recorded(self):
+        for _ in range(4):
+            d = self.agent.get(self.url)
+            d.cancel()
+            self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.agent.breaker(self.url).failures(), 0)
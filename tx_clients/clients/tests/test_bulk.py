@@ -0,0 +1,118 @@
+from twisted.trial import unittest
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from tx_clients.clients import bulk
+from tx_clients.clients.http import AgentWrapper
+from tx_clients.clients.tests.test_hedge import CancellableStubAgent
+from tx_clients.clients.tests.test_scheduler import StubAgent
+
+
+class TestImap(unittest.TestCase):
+    def setUp(self):
+        self.stub = CancellableStubAgent()
+        self.agent = AgentWrapper(self.stub)
+        self.results = []
+
+    def callback(self, index, result):
+        self.results.append((index, result))
+
+    def requests(self, count):
+        for i in xrange(count):
+            self.pulled = i + 1
+            yield ('GET', str(i))
+
+    def test_lazy_window(self):
+        d = self.agent.imap(self.requests(5), self.callback, concurrency=2, stream=True)
+        self.assertEqual(self.pulled, 2)
+        self.assertEqual(self.stub.uris(), ['0', '1'])
+        self.assertEqual(self.stub.requests[0][0], ('GET', '0', None, None, {'stream': True}))
+        self.stub.requests[1][1].callback('r1')
+        self.assertEqual(self.results, [(1, 'r1')])
+        self.assertEqual(self.stub.uris(), ['0', '1', '2'])
+        for i in xrange(2, 5):
+            self.stub.requests[i][1].callback('r')
+        self.assertNoResult(d)
+        self.stub.requests[0][1].callback('r0')
+        self.assertEqual(self.successResultOf(d), 5)
+        self.assertEqual([index for index, _ in self.results], [1, 2, 3, 4, 0])
+
+    def test_ordered(self):
+        d = self.agent.imap(self.requests(4), self.callback, concurrency=2, ordered=True)
+        self.stub.requests[1][1].callback('r1')
+        self.assertEqual(self.results, [])
+        # The held result keeps its slot.
+        self.assertEqual(self.stub.uris(), ['0', '1'])
+        self.stub.requests[0][1].callback('r0')
+        self.assertEqual(self.results, [(0, 'r0'), (1, 'r1')])
+        self.stub.requests[3][1].callback('r3')
+        self.stub.requests[2][1].callback('r2')
+        self.assertEqual([index for index, _ in self.results], [0, 1, 2, 3])
+        self.assertEqual(self.successResultOf(d), 4)
+
+    def test_failures(self):
+        d = self.agent.imap([('GET', 'a'), ('POST', 'b', None, 'data')], self.callback)
+        self.assertEqual(self.stub.requests[1][0][:4], ('POST', 'b', None, 'data'))
+        self.stub.requests[0][1].errback(ValueError())
+        self.stub.requests[1][1].callback('b')
+        self.assertEqual(self.successResultOf(d), 2)
+        index, result = self.results[0]
+        self.assertEqual(index, 0)
+        self.assertTrue(result.check(ValueError))
+        self.assertEqual(self.results[1], (1, 'b'))
+
+    def test_synchronous(self):
+        class Immediate(object):
+            def request(self, method, uri, headers=None, data=None):
+                return defer.succeed(uri)
+        d = bulk.imap(Immediate(), self.requests(5000), self.callback, concurrency=3)
+        self.assertEqual(self.successResultOf(d), 5000)
+        self.assertEqual(len(self.results), 5000)
+
+    def test_callback_backpressure(self):
+        pending = []
+
+        def callback(index, result):
+            pending.append(defer.Deferred())
+            return pending[-1]
+        d = self.agent.imap(self.requests(3), callback, concurrency=1)
+        self.stub.requests[0][1].callback('r0')
+        self.assertEqual(self.stub.uris(), ['0'])
+        pending[0].callback(None)
+        self.assertEqual(self.stub.uris(), ['0', '1'])
+        self.stub.requests[1][1].callback('r1')
+        pending[1].callback(None)
+        self.stub.requests[2][1].callback('r2')
+        self.assertNoResult(d)
+        pending[2].callback(None)
+        self.assertEqual(self.successResultOf(d), 3)
+
+    def test_callback_failure(self):
+        def callback(index, result):
+            raise ValueError()
+        d = self.agent.imap(self.requests(5), callback, concurrency=2)
+        self.stub.requests[0][1].callback('r0')
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(self.stub.cancelled, [1])
+        self.assertEqual(self.pulled, 2)
+
+    def test_cancel(self):
+        d = self.agent.imap(self.requests(5), self.callback, concurrency=2, ordered=True)
+        self.stub.requests[1][1].callback('r1')
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.stub.cancelled, [0])
+        self.assertEqual(self.results, [])
+
+
+class TestMap(unittest.TestCase):
+    def test_map(self):
+        stub = StubAgent()
+        d = AgentWrapper(stub).map([('GET', 'a'), ('GET', 'b'), ('GET', 'c')], concurrency=2)
+        stub.requests[1][1].callback('b')
+        stub.requests[0][1].errback(ValueError())
+        stub.requests[2][1].callback('c')
+        results = self.successResultOf(d)
+        self.assertIsInstance(results[0], failure.Failure)
+        self.assertEqual(results[1:], ['b', 'c'])
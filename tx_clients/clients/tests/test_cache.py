@@ -0,0 +1,138 @@
+from twisted.trial import unittest
+
+from twisted.internet import task
+from twisted.web.http_headers import Headers
+
+from tx_clients.clients import cache, http
+from tx_clients.clients.tests.test_scheduler import StubAgent
+
+
+def basic_response(code=200, body='foo', **headers):
+    response = http.BasicResponse()
+    response.code = code
+    response.headers = Headers(dict(
+        (name.replace('_', '-'), [value]) for name, value in headers.iteritems()
+    ))
+    response.body = body
+    return response
+
+
+class TestCachingAgent(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stub = StubAgent()
+        self.agent = cache.CachingAgent(self.stub, clock=self.clock)
+        self.url = 'http://example.com/'
+
+    def respond(self, response, index=-1):
+        self.stub.requests[index][1].callback(response)
+
+    def test_fresh(self):
+        first = self.agent.get(self.url)
+        self.respond(basic_response(Cache_Control='max-age=10'))
+        self.assertEqual(self.successResultOf(first).body, 'foo')
+        self.clock.advance(5)
+        second = self.successResultOf(self.agent.get(self.url))
+        self.assertEqual(second.body, 'foo')
+        self.assertIsNot(second, self.successResultOf(first))
+        self.assertEqual(len(self.stub.requests), 1)
+        stats = self.agent.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stored']), (1, 1, 1))
+        self.assertEqual(stats['entries'], 1)
+
+    def test_expired(self):
+        self.agent.get(self.url)
+        self.respond(basic_response(Cache_Control='max-age=10'))
+        self.clock.advance(10)
+        self.agent.get(self.url)
+        self.assertEqual(len(self.stub.requests), 2)
+        self.assertEqual(self.agent.stats()['misses'], 2)
+
+    def test_not_cached(self):
+        for response in (basic_response(Cache_Control='no-store, max-age=10'),
+                         basic_response(),
+                         basic_response(code=500, Cache_Control='max-age=10')):
+            self.agent.get(self.url)
+            self.respond(response)
+        self.agent.post(self.url)
+        self.agent.get(self.url, stream=True)
+        self.agent.get(self.url)
+        self.assertEqual(len(self.stub.requests), 6)
+        self.assertEqual(self.agent.stats()['entries'], 0)
+
+    def test_revalidate(self):
+        self.agent.get(self.url)
+        self.respond(basic_response(ETag='"v1"', Last_Modified='Mon, 01 Jan 2024 00:00:00 GMT',
+                                    Cache_Control='max-age=10'))
+        self.clock.advance(20)
+        # The request headers are part of the cache key.
+        self.agent.get(self.url, Headers({'Accept': ['text/plain']}))
+        self.assertEqual(self.stub.requests[-1][0][2].getRawHeaders('If-None-Match'), None)
+
+        d = self.agent.get(self.url)
+        headers = self.stub.requests[-1][0][2]
+        self.assertEqual(headers.getRawHeaders('If-None-Match'), ['"v1"'])
+        self.assertEqual(headers.getRawHeaders('If-Modified-Since'),
+                         ['Mon, 01 Jan 2024 00:00:00 GMT'])
+        self.respond(basic_response(code=304, body=None, ETag='"v2"', Cache_Control='max-age=10'))
+        response = self.successResultOf(d)
+        self.assertEqual((response.code, response.body), (200, 'foo'))
+        self.assertEqual(response.headers.getRawHeaders('ETag'), ['"v2"'])
+        self.assertEqual(self.agent.stats()['revalidated'], 1)
+        self.successResultOf(self.agent.get(self.url))
+        self.assertEqual(self.agent.stats()['hits'], 1)
+
+    def test_no_cache_revalidates(self):
+        self.agent.get(self.url)
+        self.respond(basic_response(ETag='"v1"', Cache_Control='no-cache, max-age=10'))
+        d = self.agent.get(self.url)
+        self.assertEqual(self.stub.requests[-1][0][2].getRawHeaders('If-None-Match'), ['"v1"'])
+        self.respond(basic_response(body='bar', ETag='"v2"'))
+        self.assertEqual(self.successResultOf(d).body, 'bar')
+        self.agent.get(self.url)
+        self.assertEqual(self.stub.requests[-1][0][2].getRawHeaders('If-None-Match'), ['"v2"'])
+
+    def test_revalidate_size(self):
+        self.agent.get(self.url)
+        self.respond(basic_response(ETag='"v1"'))
+        self.assertEqual(self.agent.stats()['bytes'], len('foo' 'ETag' '"v1"'))
+        self.agent.get(self.url)
+        self.respond(basic_response(code=304, body=None, ETag='"v2"', Vary='Accept-Encoding'))
+        self.assertEqual(self.agent.stats()['bytes'],
+                         len('foo' 'ETag' '"v2"' 'Vary' 'Accept-Encoding'))
+
+    def test_revalidate_no_store(self):
+        self.agent.get(self.url)
+        self.respond(basic_response(ETag='"v1"'))
+        self.agent.get(self.url)
+        self.respond(basic_response(code=304, body=None, Cache_Control='no-store'))
+        self.assertEqual(self.agent.stats()['entries'], 0)
+
+
+class TestResponseCache(unittest.TestCase):
+    def entry(self, size):
+        return cache._CacheEntry(basic_response(), 0, size)
+
+    def test_lru_bytes(self):
+        responses = cache.ResponseCache(maxBytes=10)
+        responses.put('a', self.entry(4))
+        responses.put('b', self.entry(4))
+        responses.get('a')
+        responses.put('c', self.entry(4))
+        self.assertIsNone(responses.get('b'))
+        self.assertIsNotNone(responses.get('a'))
+        self.assertEqual((len(responses), responses.bytes, responses.evicted), (2, 8, 1))
+        responses.put('d', self.entry(11))
+        self.assertIsNone(responses.get('d'))
+
+    def test_max_entries(self):
+        responses = cache.ResponseCache(maxEntries=1)
+        responses.put('a', self.entry(1))
+        responses.put('b', self.entry(1))
+        self.assertEqual(len(responses), 1)
+        self.assertIsNotNone(responses.get('b'))
+
+    def test_cache_control(self):
+        headers = Headers({'Cache-Control': ['public, max-age="60"', 'No-Cache']})
+        self.assertEqual(cache.cache_control(headers),
+                         {'public': None, 'max-age': '60', 'no-cache': None})
@@ -0,0 +1,104 @@
+from twisted.trial import unittest
+
+from twisted.internet import defer
+from twisted.web.http_headers import Headers
+
+from tx_clients.clients import coalesce, http
+from tx_clients.clients.tests.test_scheduler import StubAgent
+
+
+def basic_response(body):
+    response = http.BasicResponse()
+    response.code = 200
+    response.headers = Headers({'etag': ['"1"']})
+    response.body = body
+    return response
+
+
+class TestCoalescingAgent(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubAgent()
+        self.agent = coalesce.CoalescingAgent(self.stub)
+
+    def test_coalesce(self):
+        first = self.agent.get('http://example.com/')
+        second = self.agent.get('http://example.com/')
+        self.assertEqual(len(self.stub.requests), 1)
+        response = basic_response('foo')
+        self.stub.requests[0][1].callback(response)
+        first, second = self.successResultOf(first), self.successResultOf(second)
+        self.assertEqual(first.body, 'foo')
+        self.assertEqual(second.body, 'foo')
+        self.assertIsNot(first, second)
+        self.assertIsNot(first.headers, second.headers)
+        self.assertEqual(self.agent.stats(), {'requests': 2, 'deduplicated': 1, 'inflight': 0})
+
+    def test_completed_requests_are_not_shared(self):
+        first = self.agent.get('http://example.com/')
+        self.stub.requests[0][1].callback(basic_response('foo'))
+        self.successResultOf(first)
+        self.agent.get('http://example.com/')
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_synchronous_result(self):
+        class SynchronousAgent(object):
+            def request(self, *args, **kwargs):
+                return defer.succeed(basic_response('foo'))
+        agent = coalesce.CoalescingAgent(SynchronousAgent())
+        self.assertEqual(self.successResultOf(agent.get('http://example.com/')).body, 'foo')
+
+    def test_failure(self):
+        first = self.agent.get('http://example.com/')
+        second = self.agent.get('http://example.com/')
+        self.stub.requests[0][1].errback(ValueError())
+        self.failureResultOf(first, ValueError)
+        self.failureResultOf(second, ValueError)
+
+    def test_distinct_requests(self):
+        headers = Headers({'Accept': ['application/json']})
+        self.agent.get('http://example.com/')
+        self.agent.get('http://example.com/other')
+        self.agent.get('http://example.com/', headers)
+        self.agent.get('http://example.com/', Headers({'accept': ['application/json']}))
+        self.agent.get('http://example.com/', maxBodySize=10)
+        self.agent.head('http://example.com/')
+        self.assertEqual(len(self.stub.requests), 5)
+
+    def test_not_coalesced(self):
+        self.agent.post('http://example.com/')
+        self.agent.post('http://example.com/')
+        self.agent.get('http://example.com/', data='foo')
+        self.agent.get('http://example.com/', data='foo')
+        self.agent.get('http://example.com/', stream=True)
+        self.agent.get('http://example.com/', stream=True)
+        self.assertEqual(len(self.stub.requests), 6)
+        self.assertEqual(self.agent.deduplicated, 0)
+
+    def test_cancel(self):
+        cancelled = []
+        class CancellableAgent(object):
+            def request(self, *args, **kwargs):
+                return defer.Deferred(cancelled.append)
+        agent = coalesce.CoalescingAgent(CancellableAgent())
+        first = agent.get('http://example.com/')
+        second = agent.get('http://example.com/')
+        first.cancel()
+        self.failureResultOf(first, defer.CancelledError)
+        self.assertEqual(cancelled, [])
+        second.cancel()
+        self.failureResultOf(second, defer.CancelledError)
+        self.assertEqual(len(cancelled), 1)
+        self.assertEqual(agent.stats()['inflight'], 0)
+
+
+class TestBasicResponseClone(unittest.TestCase):
+    def test_clone(self):
+        response = basic_response('foo')
+        response.json = {'a': [1]}
+        clone = response.clone()
+        self.assertEqual(clone.body, 'foo')
+        self.assertEqual(clone.json, response.json)
+        self.assertIsNot(clone.json, response.json)
+        self.assertEqual(list(clone.headers.getAllRawHeaders()),
+                         list(response.headers.getAllRawHeaders()))
+        self.assertIsNot(clone.headers, response.headers)
@@ -0,0 +1,253 @@
+import cStringIO
+import os
+
+from twisted.trial import unittest
+
+from twisted.internet import task
+
+from twisted.python import failure
+from twisted.web.client import ResponseDone, ResponseFailed, UNKNOWN_LENGTH
+from twisted.web.http_headers import Headers
+from twisted.test.proto_helpers import StringTransport
+
+from tx_clients.clients import http
+from tx_clients.clients import download
+from tx_clients.clients.download import PART_SUFFIX
+from tx_clients.clients.stream import BodyStream
+from tx_clients.clients.tests.test_scheduler import StubAgent
+from tx_clients.exceptions import ClientError, ResponseError
+from tx_clients.utils.retry import Retry
+
+
+def stream_response(code=200, length=UNKNOWN_LENGTH, **headers):
+    response = http.BasicResponse(stream=True)
+    response.code = code
+    response.length = length
+    response.headers = Headers(dict(
+        (name.replace('_', '-'), [value]) for name, value in headers.iteritems()
+    ))
+    response.stream = BodyStream()
+    response.stream.makeConnection(StringTransport())
+    return response
+
+
+def finish(response, *chunks):
+    for chunk in chunks:
+        response.stream.dataReceived(chunk)
+    response.stream.connectionLost(failure.Failure(ResponseDone()))
+
+
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubAgent()
+        self.agent = http.AgentWrapper(self.stub)
+        self.path = self.mktemp()
+        self.part = self.path + PART_SUFFIX
+
+    def respond(self, response):
+        self.stub.requests[-1][1].callback(response)
+        return response
+
+    def read(self, path):
+        with open(path, 'rb') as fd:
+            return fd.read()
+
+    def test_download(self):
+        d = self.agent.download('http://example.com/', self.path)
+        args = self.stub.requests[0][0]
+        self.assertEqual(args[:2], ('GET', 'http://example.com/'))
+        self.assertEqual(args[4], {'stream': True})
+        response = self.respond(stream_response(length=6))
+        response.stream.dataReceived('foo')
+        self.assertTrue(os.path.exists(self.part))
+        self.assertFalse(os.path.exists(self.path))
+        finish(response, 'bar')
+        response = self.successResultOf(d)
+        self.assertEqual((response.path, response.length, response.body), (self.path, 6, None))
+        self.assertEqual(self.read(self.path), 'foobar')
+        self.assertFalse(os.path.exists(self.part))
+
+    def test_file_object(self):
+        path = self.mktemp()
+        with open(path, 'wb') as fd:
+            d = self.agent.download('http://example.com/', fd, fsync=False)
+            finish(self.respond(stream_response()), 'foo')
+            response = self.successResultOf(d)
+            self.assertFalse(fd.closed)
+        self.assertEqual((response.path, response.length), (None, 3))
+        self.assertEqual(self.read(path), 'foo')
+
+    def test_file_object_not_synced(self):
+        fd = cStringIO.StringIO()
+        d = self.agent.download('http://example.com/', fd)
+        finish(self.respond(stream_response()), 'foo')
+        self.assertEqual(self.successResultOf(d).length, 3)
+        self.assertEqual(fd.getvalue(), 'foo')
+
+    def test_length_mismatch(self):
+        d = self.agent.download('http://example.com/', self.path)
+        finish(self.respond(stream_response(length=10)), 'foo')
+        self.failureResultOf(d, ResponseError)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self.read(self.part), 'foo')
+
+    def test_failure_keeps_part(self):
+        d = self.agent.download('http://example.com/', self.path)
+        response = self.respond(stream_response())
+        response.stream.dataReceived('foo')
+        response.stream.connectionLost(failure.Failure(ResponseFailed([])))
+        self.failureResultOf(d, ResponseFailed)
+        self.assertEqual(self.read(self.part), 'foo')
+
+    def test_resume(self):
+        with open(self.part, 'wb') as fd:
+            fd.write('foo')
+        d = self.agent.download('http://example.com/', self.path, resume=True)
+        self.assertEqual(self.stub.requests[0][0][2].getRawHeaders('Range'), ['bytes=3-'])
+        finish(self.respond(stream_response(206, 3, Content_Range='bytes 3-5/6')), 'bar')
+        self.assertEqual(self.successResultOf(d).length, 6)
+        self.assertEqual(self.read(self.path), 'foobar')
+
+    def test_resume_ignored(self):
+        with open(self.part, 'wb') as fd:
+            fd.write('foo')
+        d = self.agent.download('http://example.com/', self.path, resume=True)
+        finish(self.respond(stream_response(200, 6)), 'foobar')
+        self.assertEqual(self.successResultOf(d).length, 6)
+        self.assertEqual(self.read(self.path), 'foobar')
+
+    def test_resume_misaligned(self):
+        with open(self.part, 'wb') as fd:
+            fd.write('foo')
+        d = self.agent.download('http://example.com/', self.path, resume=True)
+        response = self.respond(stream_response(206, 4, Content_Range='bytes 2-5/6'))
+        self.assertTrue(response.stream.finished)
+        self.assertEqual(len(self.stub.requests), 2)
+        self.assertFalse(self.stub.requests[1][0][2].hasHeader('Range'))
+        finish(self.respond(stream_response(200, 6)), 'foobar')
+        self.assertEqual(self.successResultOf(d).length, 6)
+        self.assertEqual(self.read(self.path), 'foobar')
+
+    def test_resume_complete(self):
+        with open(self.part, 'wb') as fd:
+            fd.write('foobar')
+        d = self.agent.download('http://example.com/', self.path, resume=True)
+        self.respond(stream_response(416, Content_Range='bytes */6'))
+        self.assertEqual(self.successResultOf(d).length, 6)
+        self.assertEqual(self.read(self.path), 'foobar')
+
+    def test_not_resumed(self):
+        with open(self.part, 'wb') as fd:
+            fd.write('foo')
+        self.agent.download('http://example.com/', self.path)
+        self.assertFalse(self.stub.requests[0][0][2].hasHeader('Range'))
+
+    def test_error_response(self):
+        d = self.agent.download('http://example.com/', self.path)
+        finish(self.respond(stream_response(404)), 'not found')
+        response = self.successResultOf(d)
+        self.assertEqual((response.code, response.body, response.path), (404, 'not found', None))
+        self.assertFalse(os.path.exists(self.part))
+
+
+class TestSegmentedDownload(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubAgent()
+        self.agent = http.AgentWrapper(self.stub)
+        self.path = self.mktemp()
+        self.body = 'foobarbaz!'
+        self.retry = Retry(2, download.SEGMENT_FAILURES)
+        self.retry.noisy = False
+        self.retry.clock = task.Clock()
+
+    def read(self, path):
+        with open(path, 'rb') as fd:
+            return fd.read()
+
+    def start(self, **headers):
+        d = self.agent.segmented_download('http://example.com/', self.path, segments=3,
+                                          minSegmentSize=3, retry=self.retry)
+        self.assertEqual(self.stub.requests[0][0][0], 'HEAD')
+        head = http.BasicResponse()
+        head.code = 200
+        head.headers = Headers(dict((name.replace('_', '-'), [value])
+                                    for name, value in headers.iteritems()))
+        self.stub.requests[0][1].callback(head)
+        return d
+
+    def ranges(self):
+        return [args[2].getRawHeaders('Range', [None])[0] for args, _ in self.stub.requests[1:]]
+
+    def respond_range(self, index, start, end, body=None):
+        if body is None:
+            body = self.body[start:end + 1]
+        response = stream_response(206, Content_Range='bytes {}-{}/{}'.format(
+            start, end, len(self.body)
+        ))
+        self.stub.requests[index][1].callback(response)
+        finish(response, body)
+
+    def test_segmented(self):
+        d = self.start(Content_Length='10', Accept_Ranges='bytes')
+        self.assertEqual(self.ranges(), ['bytes=0-3', 'bytes=4-7', 'bytes=8-9'])
+        self.assertTrue(all(args[4] == {'stream': True} for args, _ in self.stub.requests[1:]))
+        self.respond_range(3, 8, 9)
+        self.respond_range(1, 0, 3)
+        self.assertNoResult(d)
+        self.respond_range(2, 4, 7)
+        response = self.successResultOf(d)
+        self.assertEqual((response.path, response.length), (self.path, 10))
+        self.assertEqual(self.read(self.path), self.body)
+        self.assertFalse(os.path.exists(self.path + PART_SUFFIX))
+
+    def test_segment_retry(self):
+        d = self.start(Content_Length='10', Accept_Ranges='bytes')
+        self.respond_range(1, 0, 3)
+        self.respond_range(3, 8, 9)
+        response = stream_response(206, Content_Range='bytes 4-7/10')
+        self.stub.requests[2][1].callback(response)
+        response.stream.dataReceived('ar')
+        response.stream.connectionLost(failure.Failure(ResponseFailed([])))
+        self.retry.clock.advance(60)
+        # The retry continues from where the segment failed.
+        self.assertEqual(self.ranges()[-1], 'bytes=6-7')
+        self.respond_range(4, 6, 7)
+        self.successResultOf(d)
+        self.assertEqual(self.read(self.path), self.body)
+
+    def test_segment_failure(self):
+        d = self.start(Content_Length='10', Accept_Ranges='bytes')
+        self.respond_range(1, 0, 3)
+        for _ in range(3):
+            self.stub.requests[-1][1].errback(ResponseFailed([]))
+            self.retry.clock.advance(60)
+        self.failureResultOf(d, ResponseFailed)
+        self.assertFalse(os.path.exists(self.path + PART_SUFFIX))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_range_ignored(self):
+        d = self.start(Content_Length='10', Accept_Ranges='bytes')
+        self.stub.requests[1][1].callback(stream_response(200))
+        self.assertEqual(self.ranges()[-1], None)
+        finish(self.respond_single(), self.body)
+        self.assertEqual(self.successResultOf(d).length, 10)
+        self.assertEqual(self.read(self.path), self.body)
+
+    def respond_single(self):
+        response = stream_response(200, 10)
+        self.stub.requests[-1][1].callback(response)
+        return response
+
+    def test_fallback(self):
+        for headers in ({'Content_Length': '10'},
+                        {'Accept_Ranges': 'bytes'},
+                        {'Content_Length': '5', 'Accept_Ranges': 'bytes'}):
+            self.stub.requests = []
+            d = self.start(**headers)
+            self.assertEqual(len(self.stub.requests), 2)
+            self.assertEqual(self.ranges(), [None])
+            finish(self.respond_single(), self.body)
+            self.assertEqual(self.successResultOf(d).length, 10)
+
+    def test_path_required(self):
+        self.assertRaises(ClientError, self.agent.segmented_download, 'http://example.com/', None)
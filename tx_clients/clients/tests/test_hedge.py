@@ -0,0 +1,122 @@
+from twisted.trial import unittest
+
+from twisted.internet import defer, task
+
+from tx_clients.clients import hedge
+from tx_clients.clients.tests.test_scheduler import StubAgent
+
+
+class CancellableStubAgent(StubAgent):
+    """ Records which requests were cancelled """
+    def __init__(self):
+        StubAgent.__init__(self)
+        self.cancelled = []
+
+    def request(self, method, uri, headers=None, data=None, **kwargs):
+        index = len(self.requests)
+        d = defer.Deferred(lambda _: self.cancelled.append(index))
+        self.requests.append(((method, uri, headers, data, kwargs), d))
+        return d
+
+
+class TestHedgingAgent(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stub = CancellableStubAgent()
+        self.agent = hedge.HedgingAgent(self.stub, delay=1, maxHedgeRate=1, clock=self.clock)
+        self.url = 'http://example.com/'
+
+    def test_fast_response(self):
+        d = self.agent.get(self.url)
+        self.stub.requests[0][1].callback('first')
+        self.assertEqual(self.successResultOf(d), 'first')
+        self.clock.advance(1)
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertFalse(self.clock.calls)
+
+    def test_hedge_wins(self):
+        d = self.agent.get(self.url, stream=True)
+        self.clock.advance(1)
+        self.assertEqual(len(self.stub.requests), 2)
+        self.assertEqual(self.stub.requests[1][0], self.stub.requests[0][0])
+        self.stub.requests[1][1].callback('hedge')
+        self.assertEqual(self.successResultOf(d), 'hedge')
+        self.assertEqual(self.stub.cancelled, [0])
+        self.assertEqual(self.agent.stats(),
+                         {'requests': 1, 'hedged': 1, 'won': 1, 'delay': 1})
+
+    def test_hedge_wins_latency(self):
+        self.agent.get(self.url)
+        self.clock.advance(1)
+        self.clock.advance(0.5)
+        self.stub.requests[1][1].callback('hedge')
+        self.assertEqual(list(self.agent._latencies), [1.5])
+
+    def test_primary_wins(self):
+        d = self.agent.get(self.url)
+        self.clock.advance(1)
+        self.stub.requests[0][1].callback('first')
+        self.assertEqual(self.successResultOf(d), 'first')
+        self.assertEqual(self.stub.cancelled, [1])
+        self.assertEqual(self.agent.won, 0)
+
+    def test_failure_waits_for_other(self):
+        d = self.agent.get(self.url)
+        self.clock.advance(1)
+        self.stub.requests[0][1].errback(ValueError())
+        self.assertNoResult(d)
+        self.stub.requests[1][1].callback('hedge')
+        self.assertEqual(self.successResultOf(d), 'hedge')
+
+    def test_both_fail(self):
+        d = self.agent.get(self.url)
+        self.clock.advance(1)
+        self.stub.requests[0][1].errback(ValueError())
+        self.stub.requests[1][1].errback(KeyError())
+        self.failureResultOf(d, KeyError)
+
+    def test_failure_before_hedge(self):
+        d = self.agent.get(self.url)
+        self.stub.requests[0][1].errback(ValueError())
+        self.failureResultOf(d, ValueError)
+        self.assertFalse(self.clock.calls)
+
+    def test_cancel(self):
+        d = self.agent.get(self.url)
+        self.clock.advance(1)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.stub.cancelled, [0, 1])
+
+    def test_not_hedged(self):
+        self.agent.post(self.url)
+        self.agent.get(self.url, data='foo')
+        self.clock.advance(1)
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_max_hedge_rate(self):
+        self.agent.maxHedgeRate = 0.5
+        for _ in range(4):
+            self.agent.get(self.url)
+        self.clock.advance(1)
+        self.assertEqual(self.agent.hedged, 2)
+        self.assertEqual(len(self.stub.requests), 6)
+
+    def test_percentile(self):
+        agent = hedge.HedgingAgent(self.stub, percentile=0.5, minSamples=3, clock=self.clock)
+        self.assertEqual(agent.hedgeDelay(), None)
+        for latency in (1, 3, 2):
+            d = agent.get(self.url)
+            self.clock.advance(latency)
+            self.stub.requests[-1][1].callback(None)
+            self.successResultOf(d)
+        self.assertEqual(len(self.stub.requests), 3)
+        self.assertEqual(agent.hedgeDelay(), 2)
+
+    def test_percentile_window(self):
+        agent = hedge.HedgingAgent(self.stub, percentile=1, windowSize=3, minSamples=1,
+                                   clock=self.clock)
+        for latency in (5, 1, 3, 2, 4):
+            agent._record(latency)
+        self.assertEqual(agent._sorted, [2, 3, 4])
+        self.assertEqual(agent.hedgeDelay(), 4)
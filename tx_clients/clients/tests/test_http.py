@@ -1,14 +1,21 @@
 import cPickle
+import json
+import zlib
 
 from mock import patch, MagicMock
 from twisted.trial import unittest
 
-from twisted.internet import reactor
+from twisted.internet import defer, reactor, task
 from twisted.web import client
 from twisted.web.http_headers import Headers
 from twisted.test.proto_helpers import StringTransport
 
 from tx_clients.clients import http
+from tx_clients.exceptions import ResponseTooLarge, TimeoutError
+from tx_clients.utils.codecs import JSONCodec
+from tx_clients.utils.web import GzipBodyProducer
+from tx_clients.utils.tests.test_codecs import dumps
+from tx_clients.utils.tests.test_threads import codec_pool
 
 class Matcher(object):
     """ General purpose matcher for comparing objects """
@@ -241,3 +248,249 @@ class TestBasicResponse(unittest.TestCase):
         self.assertEquals(wrapped_response.length, self.stub_response.length)
         self.assertEquals(wrapped_response.body, self.body)
 
+
+    def test_basic_response_stream(self):
+        response_wrapper = http.BasicResponse(stream=True)
+        self.stub_response.code = 200
+        wrapped_response = response_wrapper(self.stub_response, 'GET').result
+
+        self.assertEquals(wrapped_response, response_wrapper)
+        self.assertEquals(wrapped_response.length, self.stub_response.length)
+        self.assertEquals(wrapped_response.body, None)
+        self.assertEquals(self.successResultOf(wrapped_response.stream.read()), self.body)
+        self.assertEquals(self.successResultOf(wrapped_response.stream.read()), '')
+
+    def test_basic_response_max_body_size(self):
+        self.stub_response.code = 200
+        response_wrapper = http.BasicResponse(maxBodySize=len(self.body))
+        wrapped_response = response_wrapper(self.stub_response, 'GET').result
+        self.assertEquals(wrapped_response.body, self.body)
+
+    def test_basic_response_too_large(self):
+        self.stub_response.code = 200
+        response_wrapper = http.BasicResponse(maxBodySize=len(self.body) - 1)
+        self.failureResultOf(response_wrapper(self.stub_response, 'GET'), ResponseTooLarge)
+
+    def gzip_response(self, body):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        encoded = compressor.compress(body) + compressor.flush()
+        headers = Headers({'Content-Encoding': ['gzip']})
+        response = client.Response(self.version, 200, self.phrase, headers, self.transport)
+        response._bodyDataReceived(encoded)
+        response._bodyDataFinished()
+        return response, encoded
+
+    def test_basic_response_decompress(self):
+        stub_response, encoded = self.gzip_response(self.body * 100)
+        wrapped_response = http.BasicResponse(decompress=True)(stub_response, 'GET').result
+        self.assertEquals(wrapped_response.body, self.body * 100)
+        self.assertEquals(wrapped_response.length, len(self.body) * 100)
+        self.assertEquals(wrapped_response.contentEncoding, 'gzip')
+        self.assertEquals(wrapped_response.wireLength, len(encoded))
+
+    def test_basic_response_decompress_stream(self):
+        stub_response, _ = self.gzip_response(self.body)
+        wrapped_response = http.BasicResponse(stream=True, decompress=True)(stub_response, 'GET')
+        stream = self.successResultOf(wrapped_response).stream
+        self.assertEquals(self.successResultOf(stream.read()), self.body)
+
+    def test_basic_response_decompress_disabled(self):
+        stub_response, encoded = self.gzip_response(self.body)
+        wrapped_response = http.BasicResponse()(stub_response, 'GET').result
+        self.assertEquals(wrapped_response.body, encoded)
+        self.assertEquals(wrapped_response.contentEncoding, None)
+
+    def test_basic_response_decompress_too_large(self):
+        stub_response, _ = self.gzip_response('\0' * 2 ** 20)
+        response_wrapper = http.BasicResponse(decompress=True, maxDecodedSize=2 ** 16)
+        self.failureResultOf(response_wrapper(stub_response, 'GET'), ResponseTooLarge)
+
+
+class TestBasicAgentDecompress(unittest.TestCase):
+    @patch('twisted.web.client.Agent.request')
+    def test_accept_encoding(self, mock_request):
+        agent = http.BasicAgent(reactor)
+        headers = Headers({'Accept': ['text/plain']})
+        agent.get('foo', headers, decompress=True)
+        sent = mock_request.call_args[0][3]
+        self.assertEqual(sent.getRawHeaders('Accept-Encoding'), [http.ACCEPT_ENCODING])
+        self.assertEqual(sent.getRawHeaders('Accept'), ['text/plain'])
+        self.assertFalse(headers.hasHeader('Accept-Encoding'))
+
+        agent.decompress = True
+        agent.get('foo', Headers({'Accept-Encoding': ['identity']}))
+        sent = mock_request.call_args[0][3]
+        self.assertEqual(sent.getRawHeaders('Accept-Encoding'), ['identity'])
+
+
+class TestBasicAgentCompress(unittest.TestCase):
+    @patch('twisted.web.client.Agent.request')
+    def test_compress(self, mock_request):
+        agent = http.BasicAgent(reactor)
+        agent.post('foo', data='a' * agent.compressThreshold, compress=True)
+        _, _, _, headers, producer = mock_request.call_args[0]
+        self.assertEqual(headers.getRawHeaders('Content-Encoding'), ['gzip'])
+        self.assertIsInstance(producer, GzipBodyProducer)
+        self.assertEqual(producer.level, agent.compressLevel)
+
+    @patch('twisted.web.client.Agent.request')
+    def test_compress_threshold(self, mock_request):
+        agent = http.BasicAgent(reactor)
+        agent.compress = True
+        agent.post('foo', data='a' * (agent.compressThreshold - 1))
+        _, _, _, headers, producer = mock_request.call_args[0]
+        self.assertIsNone(headers)
+        self.assertNotIsInstance(producer, GzipBodyProducer)
+        agent.get('foo')
+        self.assertEqual(mock_request.call_args[0][3:], (None, None))
+
+    @patch('twisted.web.client.Agent.request')
+    def test_compress_unknown_length(self, mock_request):
+        agent = http.BasicJSONAgent(reactor)
+        agent.post('foo', data=range(10000), compress=True)
+        _, _, _, headers, producer = mock_request.call_args[0]
+        self.assertEqual(headers.getRawHeaders('Content-Type'), ['application/json; charset=utf-8'])
+        self.assertEqual(headers.getRawHeaders('Content-Encoding'), ['gzip'])
+        self.assertIsInstance(producer.producer, http.JSONBodyProducer)
+
+
+class TestBasicAgentTimeouts(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.agent = http.BasicAgent(reactor)
+        self.agent._reactor = self.clock
+        self.cancelled = []
+        self.patch_request = patch('twisted.web.client.Agent.request')
+        self.mock_request = self.patch_request.start()
+        self.addCleanup(self.patch_request.stop)
+        self.mock_request.side_effect = lambda *a: defer.Deferred(self.cancelled.append)
+
+    def test_headers_timeout(self):
+        d = self.agent.get('foo', headersTimeout=5, timeout=10)
+        self.clock.advance(5)
+        failure = self.failureResultOf(d, TimeoutError)
+        self.assertIn('response headers', str(failure.value))
+        self.assertEqual(len(self.cancelled), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_timeout(self):
+        self.agent.timeout = 10
+        d = self.agent.get('foo')
+        self.clock.advance(9)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.failureResultOf(d, TimeoutError)
+        self.assertEqual(len(self.cancelled), 1)
+
+    def test_no_timeout(self):
+        d = self.agent.get('foo')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+
+    def test_response_in_time(self):
+        response = MagicMock(code=204, headers=Headers())
+        self.mock_request.side_effect = None
+        self.mock_request.return_value = defer.succeed(response)
+        d = self.agent.get('foo', timeout=10, headersTimeout=5, idleTimeout=1)
+        self.assertEqual(self.successResultOf(d).code, 204)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class TestBasicJSONAgentDecode(unittest.TestCase):
+    def setUp(self):
+        self.agent = http.BasicJSONAgent(reactor)
+        self.patch_request = patch('tx_clients.clients.http.BasicAgent.request')
+        self.mock_request = self.patch_request.start()
+        self.addCleanup(self.patch_request.stop)
+
+    def respond(self, body):
+        response = http.BasicResponse()
+        response.code = 200
+        response.body = body
+        self.mock_request.return_value = defer.succeed(response)
+        return response
+
+    def test_decode(self):
+        response = self.respond('{"a": [1, 2]}')
+        d = self.agent.request('GET', 'foo', decode=True)
+        self.assertEqual(self.successResultOf(d), response)
+        self.assertEqual(response.json, {u'a': [1, 2]})
+
+    def test_decode_empty(self):
+        response = self.respond('')
+        self.successResultOf(self.agent.request('GET', 'foo', decode=True))
+        self.assertEqual(response.json, None)
+
+    def test_decode_thread_pool(self):
+        codec, _, pool = codec_pool()
+        self.agent.threadPool = codec
+        self.agent.threadedBodySize = 4
+        response = self.respond('[1, 2, 3]')
+        d = self.agent.request('GET', 'foo', decode=True)
+        self.assertNoResult(d)
+        pool.runAll()
+        self.successResultOf(d)
+        self.assertEqual(response.json, [1, 2, 3])
+
+    def test_codec(self):
+        codec = JSONCodec('compact', dumps, json.loads)
+        self.agent.codec = codec
+        producer = self.agent._bodyProducerFor({'a': 1})
+        self.assertIs(producer.codec, codec)
+        response = self.respond('{"a": 1}')
+        self.successResultOf(self.agent.request('GET', 'foo', decode=True))
+        self.assertEqual(response.json, {u'a': 1})
+
+    def test_body_producer_thread_pool(self):
+        codec, _, _ = codec_pool()
+        self.agent.threadPool = codec
+        producer = self.agent._bodyProducerFor({'a': 1})
+        self.assertEqual(producer.threadPool, codec)
+        self.assertEqual(producer.length, client.UNKNOWN_LENGTH)
+
+    @patch('twisted.web.client.Agent.request')
+    def test_unserializable_body(self, mock_request):
+        self.patch_request.stop()
+        self.addCleanup(self.patch_request.start)
+        # The connection starts the body producer like HTTP11ClientProtocol.
+        mock_request.side_effect = lambda *args: args[-1].startProducing(StringTransport())
+        d = self.agent.post('foo', data={'a': object()})
+        self.failureResultOf(d, TypeError)
+
+
+class TestBasicJSONAgentStream(unittest.TestCase):
+    def setUp(self):
+        self.agent = http.BasicJSONAgent(reactor)
+        self.patch_request = patch('tx_clients.clients.http.BasicJSONAgent.request')
+        self.mock_request = self.patch_request.start()
+        self.addCleanup(self.patch_request.stop)
+
+    def stub_response(self, code, body):
+        response = client.Response(('HTTP', 1, 1), code, 'OK', Headers(), StringTransport())
+        response._bodyDataReceived(body)
+        response._bodyDataFinished()
+        return http.BasicResponse(stream=True)(response, 'GET').result
+
+    def test_stream_json(self):
+        records = []
+        response = self.stub_response(200, '[{"a": 1}, 2]')
+        self.mock_request.return_value = defer.succeed(response)
+        d = self.agent.stream_json('GET', 'foo', records.append)
+        self.assertEqual(self.successResultOf(d), response)
+        self.assertEqual(records, [{u'a': 1}, 2])
+        self.mock_request.assert_called_once_with('GET', 'foo', None, None, stream=True)
+
+    def test_stream_json_ndjson(self):
+        records = []
+        response = self.stub_response(200, '{"a": 1}\n2\n')
+        self.mock_request.return_value = defer.succeed(response)
+        d = self.agent.stream_json('GET', 'foo', records.append, ndjson=True)
+        self.successResultOf(d)
+        self.assertEqual(records, [{u'a': 1}, 2])
+
+    def test_stream_json_invalid(self):
+        response = self.stub_response(200, '[1, {]')
+        self.mock_request.return_value = defer.succeed(response)
+        d = self.agent.stream_json('GET', 'foo', lambda record: None)
+        self.failureResultOf(d, ValueError)
@@ -0,0 +1,435 @@
+from mock import patch
+from twisted.trial import unittest
+
+from twisted.internet import defer, error, protocol, reactor, ssl, task
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from twisted.python import failure
+from twisted.web import client
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+from twisted.test import iosim
+from twisted.test.proto_helpers import StringTransport
+
+from tx_clients.clients import http, http2, resolver, tls
+from tx_clients.clients.tests.test_pool import ShutdownClock
+from tx_clients.clients.tests.test_resolver import StubResolver
+from tx_clients.clients.tests.test_tls import certificate
+from tx_clients.exceptions import ClientError
+from tx_clients.utils.web import StringBodyProducer
+
+try:
+    from hyperframe.frame import GoAwayFrame
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.settings
+except ImportError:
+    h2 = None
+
+
+class TLSTransport(StringTransport):
+    negotiatedProtocol = b'h2'
+
+
+class BufferProducer(object):
+    """ Writes the whole body at once and records being paused """
+    def __init__(self, body):
+        self.body = body
+        self.length = len(body)
+        self.paused = 0
+        self.resumed = 0
+
+    def startProducing(self, consumer):
+        consumer.write(self.body)
+        return defer.succeed(None)
+
+    def pauseProducing(self):
+        self.paused += 1
+
+    def resumeProducing(self):
+        self.resumed += 1
+
+    def stopProducing(self):
+        pass
+
+
+class H2TestCase(unittest.TestCase):
+    """ A H2ClientProtocol connected to an in memory h2 server """
+    if h2 is None:
+        skip = 'h2 is not installed'
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client, self.transport = self.connect()
+        self.server = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False, header_encoding=None)
+        )
+        self.server.initiate_connection()
+        self.events = []
+        self.exchange()
+
+    def connect(self, negotiated=b'h2'):
+        protocol = http2.H2ClientProtocol(self.clock)
+        transport = TLSTransport()
+        transport.negotiatedProtocol = negotiated
+        protocol.makeConnection(transport)
+        protocol.handshakeCompleted()
+        return protocol, transport
+
+    def exchange(self):
+        """ Deliver frames in both directions until neither side has any """
+        while True:
+            sent = self.transport.value()
+            self.transport.clear()
+            if sent:
+                for event in self.server.receive_data(sent):
+                    self.events.append(event)
+                    if isinstance(event, h2.events.DataReceived):
+                        self.server.acknowledge_received_data(
+                            event.flow_controlled_length, event.stream_id
+                        )
+            received = self.server.data_to_send()
+            if received:
+                self.client.dataReceived(received)
+            if not sent and not received:
+                return
+
+    def received(self, eventType):
+        return [event for event in self.events if isinstance(event, eventType)]
+
+    def respond(self, streamId, body='', status='200', headers=(), end=True):
+        self.server.send_headers(streamId, [(':status', status)] + list(headers))
+        if body:
+            self.server.send_data(streamId, body)
+        if end:
+            self.server.end_stream(streamId)
+        self.exchange()
+
+
+class TestH2ClientProtocol(H2TestCase):
+    def test_multiplexed(self):
+        headers = Headers({'X-Foo': ['bar'], 'Connection': ['close']})
+        first = self.client.request('GET', 'example.com', '/a?b=1', headers)
+        second = self.client.request('GET', 'example.com', '/c')
+        self.exchange()
+        requests = self.received(h2.events.RequestReceived)
+        self.assertEqual([request.stream_id for request in requests], [1, 3])
+        self.assertEqual(requests[0].headers, [
+            (':method', 'GET'), (':scheme', 'https'), (':authority', 'example.com'),
+            (':path', '/a?b=1'), ('x-foo', 'bar')
+        ])
+        self.respond(3, 'second', headers=[('content-length', '6')])
+        self.assertNoResult(first)
+        response = self.successResultOf(second)
+        self.assertEqual((response.version, response.code, response.phrase),
+                         (('HTTP', 2, 0), 200, 'OK'))
+        self.assertEqual(response.length, 6)
+        self.assertEqual(response.headers.getRawHeaders('content-length'), ['6'])
+        self.assertEqual(self.successResultOf(client.readBody(response)), 'second')
+        self.respond(1, 'first', status='404')
+        response = self.successResultOf(first)
+        self.assertEqual(response.code, 404)
+        self.assertEqual(response.length, UNKNOWN_LENGTH)
+        self.assertEqual(self.successResultOf(client.readBody(response)), 'first')
+        self.assertEqual(self.client.streams, {})
+
+    def test_basic_response(self):
+        d = self.client.request('GET', 'example.com', '/')
+        self.exchange()
+        self.respond(1, 'foo', headers=[('content-length', '3')])
+        d.addCallback(http.BasicResponse(), 'GET')
+        response = self.successResultOf(d)
+        self.assertEqual((response.code, response.body), (200, 'foo'))
+        self.assertEqual(response.headers.getRawHeaders('content-length'), ['3'])
+
+    def test_upload_flow_control(self):
+        producer = BufferProducer('x' * 200000)
+        d = self.client.request('POST', 'example.com', '/', bodyProducer=producer)
+        # The server window is 65535 bytes, the rest waits for WINDOW_UPDATE.
+        self.assertEqual(producer.paused, 1)
+        self.exchange()
+        request = self.received(h2.events.RequestReceived)[0]
+        self.assertIn(('content-length', '200000'), request.headers)
+        received = sum(len(event.data) for event in self.received(h2.events.DataReceived))
+        self.assertEqual(received, 200000)
+        self.assertEqual(producer.resumed, 1)
+        self.assertEqual(len(self.received(h2.events.StreamEnded)), 1)
+        self.respond(1)
+        self.assertEqual(self.successResultOf(d).code, 200)
+
+    def test_string_body(self):
+        d = self.client.request('PUT', 'example.com', '/', bodyProducer=StringBodyProducer('abc'))
+        self.exchange()
+        self.assertEqual(''.join(event.data for event in self.received(h2.events.DataReceived)),
+                         'abc')
+        self.respond(1)
+        self.successResultOf(d)
+
+    def test_paused_body(self):
+        d = self.client.request('GET', 'example.com', '/')
+        self.exchange()
+        self.respond(1, 'foo', end=False)
+        response = self.successResultOf(d)
+        body = client.readBody(response)
+        response._stream.bodyProtocol.transport.pauseProducing()
+        self.server.send_data(1, 'bar', end_stream=True)
+        self.exchange()
+        self.assertNoResult(body)
+        response._stream.bodyProtocol.transport.resumeProducing()
+        self.assertEqual(self.successResultOf(body), 'foobar')
+
+    def test_cancel_request(self):
+        d = self.client.request('GET', 'example.com', '/')
+        self.exchange()
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.exchange()
+        [reset] = self.received(h2.events.StreamReset)
+        self.assertEqual(reset.stream_id, 1)
+        self.assertEqual(self.client.streams, {})
+
+    def test_stop_body(self):
+        d = self.client.request('GET', 'example.com', '/')
+        self.exchange()
+        self.respond(1, 'foo', end=False)
+        response = self.successResultOf(d)
+        body = client.readBody(response)
+        response._stream.bodyProtocol.transport.stopProducing()
+        self.failureResultOf(body, client.ResponseFailed)
+        self.exchange()
+        self.assertEqual(len(self.received(h2.events.StreamReset)), 1)
+
+    def test_stream_reset(self):
+        d = self.client.request('GET', 'example.com', '/')
+        self.exchange()
+        self.server.reset_stream(1)
+        self.exchange()
+        self.failureResultOf(d, client.ResponseNeverReceived)
+
+    def test_goaway(self):
+        first = self.client.request('GET', 'example.com', '/')
+        self.exchange()
+        self.client.dataReceived(GoAwayFrame(0, last_stream_id=1).serialize())
+        self.failureResultOf(first, client.ResponseNeverReceived)
+        self.assertFalse(self.client.available)
+        self.assertTrue(self.transport.disconnecting)
+        self.failureResultOf(self.client.request('GET', 'example.com', '/'),
+                             client.ResponseNeverReceived)
+
+    def test_max_concurrent_streams(self):
+        self.server.update_settings({h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: 1})
+        self.exchange()
+        first = self.client.request('GET', 'example.com', '/')
+        second = self.client.request('GET', 'example.com', '/')
+        self.exchange()
+        self.assertEqual(len(self.received(h2.events.RequestReceived)), 1)
+        self.assertEqual(len(self.client.pending), 1)
+        self.respond(1)
+        self.successResultOf(first)
+        self.assertEqual(len(self.received(h2.events.RequestReceived)), 2)
+        self.respond(3)
+        self.successResultOf(second)
+
+    def test_connection_lost(self):
+        streaming = self.client.request('GET', 'example.com', '/')
+        waiting = self.client.request('GET', 'example.com', '/')
+        self.exchange()
+        self.respond(1, 'foo', end=False)
+        body = client.readBody(self.successResultOf(streaming))
+        lost = []
+        self.client.onLost = lost.append
+        self.client.connectionLost(failure.Failure(error.ConnectionLost()))
+        self.failureResultOf(waiting, client.ResponseNeverReceived)
+        self.failureResultOf(body, client.ResponseFailed)
+        self.assertEqual(lost, [self.client])
+
+    def test_idle_timeout(self):
+        d = self.client.request('GET', 'example.com', '/')
+        self.clock.advance(self.client.idleTimeout)
+        self.assertFalse(self.transport.disconnecting)
+        self.exchange()
+        self.respond(1)
+        self.successResultOf(d)
+        self.clock.advance(self.client.idleTimeout)
+        self.assertTrue(self.transport.disconnecting)
+        self.exchange()
+        self.assertEqual(len(self.received(h2.events.ConnectionTerminated)), 1)
+
+    def test_not_negotiated(self):
+        protocol, transport = self.connect(b'http/1.1')
+        self.assertIsNone(self.successResultOf(protocol.whenReady()))
+        self.assertTrue(transport.disconnecting)
+        self.assertEqual(transport.value(), '')
+
+
+class StubEndpoint(object):
+    def __init__(self):
+        self.connecting = []
+
+    def connect(self, factory):
+        d = defer.Deferred()
+        self.connecting.append((factory, d))
+        return d
+
+    def connected(self, index=0, negotiated=b'h2'):
+        factory, d = self.connecting[index]
+        protocol = factory.buildProtocol(None)
+        transport = TLSTransport()
+        transport.negotiatedProtocol = negotiated
+        protocol.makeConnection(transport)
+        d.callback(protocol)
+        protocol.handshakeCompleted()
+        return protocol
+
+
+class TestH2ConnectionPool(unittest.TestCase):
+    if h2 is None:
+        skip = 'h2 is not installed'
+
+    def setUp(self):
+        self.pool = http2.H2ConnectionPool(task.Clock())
+        self.endpoint = StubEndpoint()
+        self.key = ('https', 'example.com', 443)
+
+    def test_shared_connection(self):
+        first = self.pool.getConnection(self.key, self.endpoint)
+        second = self.pool.getConnection(self.key, self.endpoint)
+        self.assertEqual(len(self.endpoint.connecting), 1)
+        protocol = self.endpoint.connected()
+        self.assertIs(self.successResultOf(first), protocol)
+        self.assertIs(self.successResultOf(second), protocol)
+        self.assertIs(self.successResultOf(self.pool.getConnection(self.key, self.endpoint)),
+                      protocol)
+        stats = self.pool.stats()
+        self.assertEqual((stats['connections'], stats['created'], stats['requests']), (1, 1, 3))
+
+    def test_http1_host(self):
+        d = self.pool.getConnection(self.key, self.endpoint)
+        self.endpoint.connected(negotiated=b'http/1.1')
+        self.assertIsNone(self.successResultOf(d))
+        self.assertIsNone(self.successResultOf(self.pool.getConnection(self.key, self.endpoint)))
+        self.assertEqual(len(self.endpoint.connecting), 1)
+        self.assertEqual(self.pool.stats()['http1_hosts'], 1)
+
+    def test_connect_failure(self):
+        d = self.pool.getConnection(self.key, self.endpoint)
+        self.endpoint.connecting[0][1].errback(error.ConnectionRefusedError())
+        self.failureResultOf(d, error.ConnectionRefusedError)
+        self.pool.getConnection(self.key, self.endpoint)
+        self.assertEqual(len(self.endpoint.connecting), 2)
+
+    def test_cancel_waiter(self):
+        first = self.pool.getConnection(self.key, self.endpoint)
+        second = self.pool.getConnection(self.key, self.endpoint)
+        first.cancel()
+        self.failureResultOf(first, defer.CancelledError)
+        protocol = self.endpoint.connected()
+        self.assertIs(self.successResultOf(second), protocol)
+
+    def test_connection_lost(self):
+        self.pool.getConnection(self.key, self.endpoint)
+        protocol = self.endpoint.connected()
+        protocol.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.assertEqual(self.pool.stats()['connections'], 0)
+        self.pool.getConnection(self.key, self.endpoint)
+        self.assertEqual(len(self.endpoint.connecting), 2)
+
+    def test_shared_pool_closed_on_shutdown(self):
+        clock = ShutdownClock()
+        shared = http2.shared_h2_pool(clock)
+        self.assertIs(http2.shared_h2_pool(clock), shared)
+        _, _, fn, args = clock.triggers[0]
+        self.successResultOf(fn(*args))
+        self.assertIsNot(http2.shared_h2_pool(clock), shared)
+
+
+class StubConnection(object):
+    def __init__(self):
+        self.requests = []
+
+    def request(self, *args):
+        self.requests.append(args)
+        return defer.succeed(client.Response(('HTTP', 2, 0), 204, 'No Content', Headers(),
+                                             StringTransport()))
+
+
+class TestBasicAgentHTTP2(unittest.TestCase):
+    if h2 is None:
+        skip = 'h2 is not installed'
+
+    def setUp(self):
+        self.agent = http.BasicAgent(reactor, http2=True)
+        self.connection = StubConnection()
+        self.patch_connection = patch.object(self.agent._h2Pool, 'getConnection')
+        self.getConnection = self.patch_connection.start()
+        self.addCleanup(self.patch_connection.stop)
+        self.patch_request = patch('twisted.web.client.Agent._requestWithEndpoint')
+        self.http1 = self.patch_request.start()
+        self.addCleanup(self.patch_request.stop)
+        self.http1.return_value = defer.Deferred()
+
+    def test_policy(self):
+        policy = self.agent._h2EndpointFactory._policyForHTTPS
+        self.assertIsInstance(policy, http2.H2PolicyForHTTPS)
+        self.assertIs(policy.policy, tls.shared_tls_policy(reactor))
+        self.assertIs(self.agent.http2Pool, http2.shared_h2_pool(reactor))
+        self.assertIsNone(http.BasicAgent(reactor).http2Pool)
+
+    def test_custom_policy(self):
+        custom = client.BrowserLikePolicyForHTTPS()
+        agent = http.BasicAgent(reactor, contextFactory=custom, http2=True)
+        self.assertIs(agent._h2EndpointFactory._policyForHTTPS.policy, custom)
+        self.assertIs(agent._endpointFactory._policyForHTTPS, custom)
+
+    def test_resolver(self):
+        caching = resolver.CachingResolver(task.Clock(), StubResolver())
+        agent = http.BasicAgent(reactor, connectTimeout=5, http2=True, resolver=caching)
+        endpoint = agent._h2EndpointFactory.endpointForURI(
+            client.URI.fromBytes('https://example.com/')
+        )
+        self.assertIsInstance(endpoint._wrappedEndpoint, resolver.HappyEyeballsEndpoint)
+        self.assertIsInstance(agent._h2EndpointFactory._policyForHTTPS, http2.H2PolicyForHTTPS)
+
+    def test_alpn(self):
+        cert = certificate()
+        policy = http2.H2PolicyForHTTPS(tls.CachingPolicyForHTTPS(
+            trustRoot=ssl.Certificate(cert.original), clock=task.Clock()
+        ))
+        server = ssl.CertificateOptions(
+            privateKey=cert.privateKey.original, certificate=cert.original,
+            acceptableProtocols=[b'h2']
+        )
+        clientProtocol, _, _ = iosim.connectedServerAndClient(
+            lambda: TLSMemoryBIOFactory(
+                server, False, protocol.Factory.forProtocol(protocol.Protocol)
+            ).buildProtocol(None),
+            lambda: TLSMemoryBIOFactory(
+                policy.creatorForNetloc('localhost', 443), True,
+                protocol.Factory.forProtocol(protocol.Protocol)
+            ).buildProtocol(None),
+        )
+        self.assertEqual(clientProtocol.negotiatedProtocol, b'h2')
+
+    def test_h2(self):
+        self.getConnection.return_value = defer.succeed(self.connection)
+        d = self.agent.get('https://example.com:8443/a?b=1')
+        self.assertEqual(self.successResultOf(d).code, 204)
+        [(method, authority, path, _, producer)] = self.connection.requests
+        self.assertEqual((method, authority, path, producer),
+                         ('GET', 'example.com:8443', '/a?b=1', None))
+        self.assertEqual(self.getConnection.call_args[0][0], ('https', 'example.com', 8443))
+        self.assertFalse(self.http1.called)
+
+    def test_fallback(self):
+        self.getConnection.return_value = defer.succeed(None)
+        self.agent.get('https://example.com/')
+        self.assertTrue(self.http1.called)
+
+    def test_http(self):
+        self.agent.get('http://example.com/')
+        self.assertFalse(self.getConnection.called)
+        self.assertTrue(self.http1.called)
+
+    def test_h2_not_installed(self):
+        with patch.object(http, 'h2', None):
+            self.assertRaises(ClientError, http.BasicAgent, reactor, http2=True)
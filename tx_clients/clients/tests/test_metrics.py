@@ -0,0 +1,197 @@
+from mock import patch
+from twisted.trial import unittest
+
+from twisted.internet import defer, reactor, task
+from twisted.web import client
+from twisted.web.http_headers import Headers
+from twisted.test.proto_helpers import StringTransport
+
+from tx_clients.clients import http, metrics
+
+
+class StubEndpoint(object):
+    def __init__(self):
+        self.connecting = []
+
+    def connect(self, factory):
+        d = defer.Deferred()
+        self.connecting.append(d)
+        return d
+
+
+class TestHistogram(unittest.TestCase):
+    def test_empty(self):
+        histogram = metrics.Histogram()
+        self.assertIsNone(histogram.percentile(0.5))
+        self.assertEqual(histogram.stats()['count'], 0)
+
+    def test_precision(self):
+        histogram = metrics.Histogram(significantFigures=2)
+        for value in xrange(1, 10001):
+            histogram.record(value / 1000.0)
+        self.assertEqual(histogram.count, 10000)
+        self.assertEqual(histogram.min, 0.001)
+        self.assertEqual(histogram.max, 10)
+        self.assertAlmostEqual(histogram.mean, 5.0005)
+        for percentile, expected in ((0.5, 5), (0.9, 9), (0.99, 9.9), (1, 10)):
+            self.assertTrue(abs(histogram.percentile(percentile) - expected) <= expected * 0.01)
+        self.assertEqual(histogram.stats()['p99'], histogram.percentile(0.99))
+
+    def test_bounded_memory(self):
+        histogram = metrics.Histogram(significantFigures=2)
+        for value in xrange(100000):
+            histogram.record(value * 1e-4)
+        self.assertLess(len(histogram._counts), 2000)
+
+    def test_small_values_exact(self):
+        histogram = metrics.Histogram(unit=1)
+        for value in (3, 3, 7):
+            histogram.record(value)
+        self.assertEqual(histogram.percentile(0.5), 3)
+        self.assertEqual(histogram.percentile(1), 7)
+
+
+class TestMetricsAggregator(unittest.TestCase):
+    def request(self, uri, method='GET', total=0.1, code=200, reused=True, failed=False):
+        request = metrics.RequestMetrics(method, uri, 0)
+        request.headers = total / 2
+        request.body = total / 2
+        request.total = total
+        request.code = code
+        request.reused = reused
+        request.bytesIn = 10
+        request.bytesOut = 5
+        if failed:
+            request.failure = ValueError()
+        return request
+
+    def test_aggregate(self):
+        aggregator = metrics.MetricsAggregator()
+        aggregator(self.request('http://a.example.com/1', total=0.1))
+        aggregator(self.request('http://a.example.com/2', total=0.3, code=500, reused=False))
+        aggregator(self.request('http://a.example.com:8080/', total=0.2, failed=True))
+        aggregator(self.request('http://a.example.com/', 'POST'))
+        stats = aggregator.stats()
+        self.assertEqual(sorted(stats), [
+            ('a.example.com', 'GET'), ('a.example.com', 'POST'), ('a.example.com:8080', 'GET')
+        ])
+        get = stats[('a.example.com', 'GET')]
+        self.assertEqual(get['requests'], 2)
+        self.assertEqual(get['failures'], 0)
+        self.assertEqual(get['reused'], 1)
+        self.assertEqual(get['codes'], {200: 1, 500: 1})
+        self.assertEqual(get['bytes_in'], 20)
+        self.assertEqual(get['bytes_out'], 10)
+        self.assertEqual(get['total']['count'], 2)
+        self.assertAlmostEqual(get['total']['max'], 0.3)
+        self.assertEqual(get['connect']['count'], 0)
+        self.assertEqual(stats[('a.example.com:8080', 'GET')]['failures'], 1)
+        histogram = aggregator.histogram('a.example.com', 'GET', 'headers')
+        self.assertAlmostEqual(histogram.max, 0.15)
+        aggregator.reset()
+        self.assertEqual(aggregator.stats(), {})
+
+
+class TestBasicAgentMetrics(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.agent = http.BasicAgent(reactor)
+        self.agent._reactor = self.clock
+        self.observed = []
+        self.agent.addObserver(self.observed.append)
+        self.endpoint = StubEndpoint()
+        self.responses = []
+        self.patch_request = patch('twisted.web.client.Agent._requestWithEndpoint')
+        self.mock_request = self.patch_request.start()
+        self.addCleanup(self.patch_request.stop)
+        self.mock_request.side_effect = self.requestWithEndpoint
+
+    def requestWithEndpoint(self, agent, key, endpoint, *args):
+        d = defer.Deferred()
+        self.responses.append(d)
+        if self.connect:
+            endpoint._endpoint = self.endpoint
+            connected = endpoint.connect(None)
+            connected.addCallback(lambda _: d)
+            return connected
+        return d
+
+    def response(self, body='foo', finished=True):
+        response = client.Response(('HTTP', 1, 1), 200, 'OK', Headers(), StringTransport())
+        response.length = len(body)
+        response._bodyDataReceived(body)
+        if finished:
+            response._bodyDataFinished()
+        return response
+
+    def test_timings(self):
+        self.connect = True
+        d = self.agent.post('http://example.com/', data='abc')
+        self.clock.advance(1)
+        self.endpoint.connecting[0].callback(None)
+        self.clock.advance(2)
+        self.responses[0].callback(self.response())
+        response = self.successResultOf(d)
+        self.assertEqual(response.body, 'foo')
+        [observed] = self.observed
+        self.assertEqual((observed.method, observed.host, observed.code), ('POST', 'example.com', 200))
+        self.assertEqual((observed.connect, observed.headers, observed.total), (1, 3, 3))
+        self.assertEqual(observed.body, 0)
+        self.assertFalse(observed.reused)
+        self.assertEqual((observed.bytesOut, observed.bytesIn), (3, 3))
+        self.assertIsNone(observed.failure)
+
+    def test_stream(self):
+        self.connect = False
+        d = self.agent.get('http://example.com/', stream=True)
+        self.clock.advance(1)
+        stub = self.response('foo', finished=False)
+        self.responses[0].callback(stub)
+        response = self.successResultOf(d)
+        self.assertEqual(self.observed, [])
+        self.clock.advance(2)
+        stub._bodyDataReceived('bar')
+        stub._bodyDataFinished()
+        [observed] = self.observed
+        self.assertTrue(observed.reused)
+        self.assertIsNone(observed.connect)
+        self.assertEqual((observed.headers, observed.body, observed.total), (1, 2, 3))
+        self.assertEqual(observed.bytesIn, 6)
+        self.assertEqual(observed.bytesOut, 0)
+        self.assertEqual(self.successResultOf(response.stream.read()), 'foo')
+
+    def test_failure(self):
+        self.connect = False
+        d = self.agent.get('http://example.com/')
+        self.clock.advance(1)
+        self.responses[0].errback(client.ResponseNeverReceived([]))
+        self.failureResultOf(d, client.ResponseNeverReceived)
+        [observed] = self.observed
+        self.assertEqual(observed.total, 1)
+        self.assertIsNone(observed.headers)
+        self.assertTrue(observed.failure.check(client.ResponseNeverReceived))
+
+    def test_observer_failure(self):
+        self.connect = False
+        self.agent.addObserver(lambda _: 1 / 0)
+        d = self.agent.get('http://example.com/')
+        self.responses[0].callback(self.response())
+        self.successResultOf(d)
+        self.assertEqual(len(self.observed), 1)
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+    def test_sample_rate(self):
+        self.connect = False
+        self.agent.metricsSampleRate = 0
+        self.agent.get('http://example.com/')
+        self.responses[0].callback(self.response())
+        self.assertEqual(self.observed, [])
+
+    def test_no_observers(self):
+        self.connect = False
+        self.agent.removeObserver(self.observed.append)
+        with patch.object(http, 'TimedEndpoint') as timed:
+            self.agent.get('http://example.com/')
+            self.assertFalse(timed.called)
+        self.responses[0].callback(self.response())
+        self.assertEqual(self.observed, [])
@@ -0,0 +1,148 @@
+from zope.interface import implementer
+
+from twisted.trial import unittest
+
+from twisted.internet import defer, task
+from twisted.internet.error import ConnectionDone
+from twisted.internet.interfaces import IReactorCore
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+
+from tx_clients.clients import http
+from tx_clients.clients import pool
+
+
+class StubEndpoint(object):
+    """ An endpoint which connects protocols to a StringTransport """
+    def __init__(self):
+        self.connected = []
+
+    def connect(self, factory):
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        self.connected.append(protocol)
+        return defer.succeed(protocol)
+
+
+@implementer(IReactorCore)
+class ShutdownClock(task.Clock):
+    """ Records the system event triggers """
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.triggers = []
+
+    def addSystemEventTrigger(self, phase, event, fn, *args):
+        self.triggers.append((phase, event, fn, args))
+
+
+class TestBasicConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pool = pool.BasicConnectionPool(self.clock)
+        self.endpoint = StubEndpoint()
+        self.key = ('http', 'example.com', 80)
+
+    def tearDown(self):
+        return self.pool.closeCachedConnections()
+
+    def test_defaults(self):
+        self.assertTrue(self.pool.persistent)
+        self.assertTrue(self.pool.retryAutomatically)
+        self.assertEqual(self.pool.maxPersistentPerHost, 10)
+        self.assertEqual(self.pool.cachedConnectionTimeout, 120)
+
+    def test_overrides(self):
+        tuned = pool.BasicConnectionPool(
+            self.clock,
+            maxPersistentPerHost=3,
+            cachedConnectionTimeout=30,
+            retryAutomatically=False
+        )
+        self.assertEqual(tuned.maxPersistentPerHost, 3)
+        self.assertEqual(tuned.cachedConnectionTimeout, 30)
+        self.assertFalse(tuned.retryAutomatically)
+        self.assertEqual(pool.BasicConnectionPool.maxPersistentPerHost, 10)
+
+    def test_stats_new_connection(self):
+        self.pool.getConnection(self.key, self.endpoint)
+        self.assertEqual(self.pool.stats(), {
+            'open': 1,
+            'idle': 0,
+            'in_use': 1,
+            'requests': 1,
+            'created': 1,
+            'reused': 0,
+        })
+
+    def test_stats_reused_connection(self):
+        self.pool.getConnection(self.key, self.endpoint)
+        protocol = self.endpoint.connected[0]
+        self.pool._putConnection(self.key, protocol)
+        self.assertEqual(self.pool.stats()['idle'], 1)
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+
+        self.pool.getConnection(self.key, self.endpoint)
+        self.assertEqual(len(self.endpoint.connected), 1)
+        self.assertEqual(self.pool.stats(), {
+            'open': 1,
+            'idle': 0,
+            'in_use': 1,
+            'requests': 2,
+            'created': 1,
+            'reused': 1,
+        })
+
+    def test_stats_idle_timeout(self):
+        self.pool.getConnection(self.key, self.endpoint)
+        protocol = self.endpoint.connected[0]
+        self.pool._putConnection(self.key, protocol)
+        self.clock.advance(self.pool.cachedConnectionTimeout)
+        self.assertTrue(protocol.transport.disconnecting)
+        self.assertEqual(self.pool.stats()['idle'], 0)
+
+    def test_stats_lost_connection(self):
+        self.pool.getConnection(self.key, self.endpoint)
+        protocol = self.endpoint.connected[0]
+        protocol._state = 'CONNECTION_LOST'
+        self.assertEqual(self.pool.stats()['open'], 0)
+        self.assertEqual(self.pool.stats()['in_use'], 0)
+
+    def test_lost_connection_forgotten(self):
+        self.pool.getConnection(self.key, self.endpoint)
+        self.pool.getConnection(self.key, self.endpoint)
+        self.assertEqual(len(self.pool._protocols), 2)
+        self.endpoint.connected[0].connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(self.pool._protocols, set(self.endpoint.connected[1:]))
+
+
+class TestSharedPool(unittest.TestCase):
+    def test_shared_pool(self):
+        clock = task.Clock()
+        shared = pool.shared_pool(clock)
+        self.assertIsInstance(shared, pool.BasicConnectionPool)
+        self.assertIs(pool.shared_pool(clock), shared)
+        self.assertIsNot(pool.shared_pool(task.Clock()), shared)
+
+    def test_closed_on_shutdown(self):
+        clock = ShutdownClock()
+        shared = pool.shared_pool(clock)
+        pool.shared_pool(clock)
+        self.assertEqual(len(clock.triggers), 1)
+        phase, event, fn, args = clock.triggers[0]
+        self.assertEqual((phase, event), ('before', 'shutdown'))
+        self.successResultOf(fn(*args))
+        self.assertNotIn(clock, pool._shared_pools)
+        self.assertIsNot(pool.shared_pool(clock), shared)
+
+    def test_agent_default_pool(self):
+        clock = task.Clock()
+        agent = http.BasicAgent(clock)
+        self.assertIs(agent.pool, pool.shared_pool(clock))
+        self.assertIs(http.BasicJSONAgent(clock).pool, agent.pool)
+        self.assertIs(http.BasicFileAgent(clock).pool, agent.pool)
+
+    def test_agent_pool(self):
+        clock = task.Clock()
+        custom = pool.BasicConnectionPool(clock)
+        agent = http.BasicAgent(clock, pool=custom)
+        self.assertIs(agent.pool, custom)
@@ -0,0 +1,276 @@
+import socket
+
+from twisted.trial import unittest
+
+from twisted.internet import defer, error, reactor, task
+from twisted.names import dns
+from twisted.names.error import DNSNameError, DNSQueryTimeoutError
+from twisted.test.proto_helpers import StringTransport
+from twisted.web.client import URI
+
+from tx_clients.clients import http, resolver
+
+
+def answer(*records):
+    """ The result of IResolver.lookupAddress for records """
+    return ([dns.RRHeader('example.com', record.TYPE, ttl=record.ttl, payload=record)
+             for record in records], [], [])
+
+
+class StubResolver(object):
+    """ An IResolver which records queries and answers them when told to """
+    def __init__(self):
+        self.queries = []
+
+    def lookupAddress(self, name):
+        return self._query('A', name)
+
+    def lookupIPV6Address(self, name):
+        return self._query('AAAA', name)
+
+    def _query(self, recordType, name):
+        d = defer.Deferred()
+        self.queries.append((recordType, name, d))
+        return d
+
+    def answer(self, a=(), aaaa=(), ttl=60):
+        """ Answer the queries in flight """
+        queries, self.queries = self.queries, []
+        for recordType, _, d in queries:
+            if recordType == 'A':
+                d.callback(answer(*[dns.Record_A(address, ttl) for address in a]))
+            else:
+                d.callback(answer(*[dns.Record_AAAA(address, ttl) for address in aaaa]))
+
+    def fail(self, exception):
+        queries, self.queries = self.queries, []
+        for _, _, d in queries:
+            d.errback(exception)
+
+
+class TestCachingResolver(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stub = StubResolver()
+        self.resolver = resolver.CachingResolver(self.clock, self.stub)
+
+    def test_ttl(self):
+        d = self.resolver.resolve('example.com')
+        self.assertEqual([query[:2] for query in self.stub.queries],
+                         [('AAAA', 'example.com'), ('A', 'example.com')])
+        self.clock.advance(0.5)
+        self.stub.answer(a=['10.0.0.1'], ttl=60)
+        self.assertEqual(self.successResultOf(d), [(socket.AF_INET, '10.0.0.1')])
+        self.clock.advance(59)
+        self.assertEqual(self.successResultOf(self.resolver.resolve('example.com')),
+                         [(socket.AF_INET, '10.0.0.1')])
+        self.assertEqual(self.stub.queries, [])
+        self.clock.advance(1)
+        self.resolver.resolve('example.com')
+        self.assertEqual(len(self.stub.queries), 2)
+        stats = self.resolver.stats()
+        self.assertEqual((stats['lookups'], stats['hits'], stats['misses']), (3, 1, 2))
+        self.assertEqual(stats['latency']['count'], 1)
+        self.assertAlmostEqual(stats['latency']['max'], 0.5, places=2)
+
+    def test_max_ttl(self):
+        self.resolver.maxTTL = 10
+        self.resolver.resolve('example.com')
+        self.stub.answer(a=['10.0.0.1'], ttl=3600)
+        self.clock.advance(10)
+        self.resolver.resolve('example.com')
+        self.assertEqual(len(self.stub.queries), 2)
+
+    def test_interleaved(self):
+        d = self.resolver.resolve('example.com')
+        self.stub.answer(a=['10.0.0.1', '10.0.0.2', '10.0.0.3'], aaaa=['::1', '::2'])
+        self.assertEqual(self.successResultOf(d), [
+            (socket.AF_INET6, '::1'), (socket.AF_INET, '10.0.0.1'),
+            (socket.AF_INET6, '::2'), (socket.AF_INET, '10.0.0.2'),
+            (socket.AF_INET, '10.0.0.3'),
+        ])
+
+    def test_one_family_fails(self):
+        d = self.resolver.resolve('example.com')
+        self.stub.queries[0][2].errback(DNSQueryTimeoutError('example.com'))
+        self.stub.queries[1][2].callback(answer(dns.Record_A('10.0.0.1', 60)))
+        self.assertEqual(self.successResultOf(d), [(socket.AF_INET, '10.0.0.1')])
+
+    def test_negative(self):
+        d = self.resolver.resolve('example.com')
+        self.stub.fail(DNSNameError())
+        self.failureResultOf(d, error.DNSLookupError)
+        self.failureResultOf(self.resolver.resolve('example.com'), error.DNSLookupError)
+        self.assertEqual(self.stub.queries, [])
+        self.clock.advance(self.resolver.negativeTTL)
+        self.resolver.resolve('example.com')
+        self.assertEqual(len(self.stub.queries), 2)
+        stats = self.resolver.stats()
+        self.assertEqual((stats['negative_hits'], stats['failures']), (1, 1))
+
+    def test_no_addresses(self):
+        d = self.resolver.resolve('example.com')
+        self.stub.answer()
+        self.failureResultOf(d, error.DNSLookupError)
+        self.failureResultOf(self.resolver.resolve('example.com'), error.DNSLookupError)
+        self.assertEqual(self.stub.queries, [])
+
+    def test_timeout_not_cached(self):
+        d = self.resolver.resolve('example.com')
+        self.stub.fail(DNSQueryTimeoutError('example.com'))
+        self.failureResultOf(d, error.DNSLookupError)
+        self.resolver.resolve('example.com')
+        self.assertEqual(len(self.stub.queries), 2)
+
+    def test_joined(self):
+        first = self.resolver.resolve('example.com')
+        second = self.resolver.resolve('example.com')
+        cancelled = self.resolver.resolve('example.com')
+        self.assertEqual(len(self.stub.queries), 2)
+        cancelled.cancel()
+        self.failureResultOf(cancelled, defer.CancelledError)
+        self.stub.answer(a=['10.0.0.1'])
+        self.assertEqual(self.successResultOf(first), self.successResultOf(second))
+        stats = self.resolver.stats()
+        self.assertEqual((stats['misses'], stats['joined']), (1, 2))
+        self.assertAlmostEqual(stats['hit_rate'], 2 / 3.0)
+
+    def test_ip_address(self):
+        self.assertEqual(self.successResultOf(self.resolver.resolve('10.0.0.1')),
+                         [(socket.AF_INET, '10.0.0.1')])
+        self.assertEqual(self.successResultOf(self.resolver.resolve('::1')),
+                         [(socket.AF_INET6, '::1')])
+        self.assertEqual(self.stub.queries, [])
+        self.assertEqual(self.resolver.stats()['lookups'], 0)
+
+    def test_max_entries(self):
+        self.resolver.maxEntries = 2
+        for host in ('a.example.com', 'b.example.com', 'c.example.com'):
+            self.resolver.resolve(host)
+            self.stub.answer(a=['10.0.0.1'])
+        self.assertEqual(self.resolver.stats()['entries'], 2)
+        self.resolver.resolve('a.example.com')
+        self.assertEqual(len(self.stub.queries), 2)
+
+
+class StubTCPEndpoint(object):
+    def __init__(self, address):
+        self.address = address
+        self.connecting = None
+        self.cancelled = False
+
+    def connect(self, factory):
+        self.connecting = defer.Deferred(lambda connecting: self.cancel(connecting))
+        return self.connecting
+
+    def cancel(self, _):
+        self.cancelled = True
+
+    def connected(self):
+        protocol = StubProtocol()
+        protocol.transport = StringTransport()
+        self.connecting.callback(protocol)
+        return protocol
+
+
+class StubProtocol(object):
+    transport = None
+
+
+class TestHappyEyeballsEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.addresses = defer.Deferred()
+        self.endpoint = resolver.HappyEyeballsEndpoint(self.clock, self, 'example.com', 80)
+        self.endpoints = []
+        self.endpoint._endpointFor = self.endpointFor
+
+    def resolve(self, host):
+        return self.addresses
+
+    def endpointFor(self, family, address):
+        endpoint = StubTCPEndpoint(address)
+        self.endpoints.append(endpoint)
+        return endpoint
+
+    def connect(self, *addresses):
+        d = self.endpoint.connect(None)
+        self.addresses.callback([
+            (socket.AF_INET6 if ':' in address else socket.AF_INET, address)
+            for address in addresses
+        ])
+        return d
+
+    def test_first_connects(self):
+        d = self.connect('::1', '10.0.0.1')
+        self.assertEqual([endpoint.address for endpoint in self.endpoints], ['::1'])
+        protocol = self.endpoints[0].connected()
+        self.assertIs(self.successResultOf(d), protocol)
+        self.clock.advance(1)
+        self.assertEqual(len(self.endpoints), 1)
+
+    def test_race(self):
+        d = self.connect('::1', '10.0.0.1', '10.0.0.2')
+        self.clock.advance(self.endpoint.attemptDelay)
+        self.assertEqual([endpoint.address for endpoint in self.endpoints], ['::1', '10.0.0.1'])
+        protocol = self.endpoints[1].connected()
+        self.assertIs(self.successResultOf(d), protocol)
+        self.assertTrue(self.endpoints[0].cancelled)
+        self.clock.advance(1)
+        self.assertEqual(len(self.endpoints), 2)
+
+    def test_failure_starts_next(self):
+        d = self.connect('::1', '10.0.0.1')
+        self.endpoints[0].connecting.errback(error.ConnectionRefusedError())
+        self.assertEqual(len(self.endpoints), 2)
+        self.endpoints[1].connected()
+        self.successResultOf(d)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_all_fail(self):
+        d = self.connect('::1', '10.0.0.1')
+        self.endpoints[0].connecting.errback(error.ConnectionRefusedError())
+        self.endpoints[1].connecting.errback(error.TimeoutError())
+        self.failureResultOf(d, error.TimeoutError)
+
+    def test_no_addresses(self):
+        self.failureResultOf(self.connect(), error.ConnectError)
+
+    def test_lookup_failure(self):
+        d = self.endpoint.connect(None)
+        self.addresses.errback(error.DNSLookupError('example.com'))
+        self.failureResultOf(d, error.DNSLookupError)
+
+    def test_loser_closed(self):
+        d = self.connect('::1', '10.0.0.1')
+        self.clock.advance(self.endpoint.attemptDelay)
+        loser = StubProtocol()
+        loser.transport = StringTransport()
+        # The connection is made as it is cancelled.
+        self.endpoints[1].cancel = lambda connecting: connecting.callback(loser)
+        self.endpoints[0].connected()
+        self.successResultOf(d)
+        self.assertTrue(loser.transport.disconnecting)
+
+    def test_cancel(self):
+        d = self.connect('::1', '10.0.0.1')
+        self.clock.advance(self.endpoint.attemptDelay)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertTrue(all(endpoint.cancelled for endpoint in self.endpoints))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class TestBasicAgentResolver(unittest.TestCase):
+    def test_endpoints(self):
+        caching = resolver.CachingResolver(task.Clock(), StubResolver())
+        agent = http.BasicAgent(reactor, connectTimeout=5, resolver=caching)
+        endpoint = agent._getEndpoint(URI.fromBytes('http://example.com/'))
+        self.assertIsInstance(endpoint, resolver.HappyEyeballsEndpoint)
+        self.assertEqual((endpoint._host, endpoint._port, endpoint._timeout),
+                         ('example.com', 80, 5))
+        endpoint = agent._getEndpoint(URI.fromBytes('https://example.com/'))
+        self.assertIsInstance(endpoint._wrappedEndpoint, resolver.HappyEyeballsEndpoint)
+
+    def test_shared_resolver(self):
+        self.assertIs(resolver.shared_resolver(reactor), resolver.shared_resolver(reactor))
@@ -0,0 +1,137 @@
+from twisted.trial import unittest
+
+from twisted.internet import defer, task
+
+from tx_clients.clients import scheduler
+
+
+class StubAgent(object):
+    """ Records requests and returns a Deferred for each which the test fires """
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, uri, headers=None, data=None, **kwargs):
+        d = defer.Deferred()
+        self.requests.append(((method, uri, headers, data, kwargs), d))
+        return d
+
+    def uris(self):
+        return [args[1] for args, _ in self.requests]
+
+
+class TestRequestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = scheduler.RequestScheduler(maxConcurrent=2, maxPerKey=1, clock=self.clock)
+        self.calls = []
+
+    def call(self, name):
+        d = defer.Deferred()
+        self.calls.append((name, d))
+        return d
+
+    def names(self):
+        return [name for name, _ in self.calls]
+
+    def test_global_limit(self):
+        results = [self.scheduler.submit(key, 0, self.call, key) for key in 'abc']
+        self.assertEqual(self.names(), ['a', 'b'])
+        self.assertEqual(self.scheduler.stats()['active'], 2)
+        self.assertEqual(self.scheduler.stats()['queued'], 1)
+        self.calls[0][1].callback('done')
+        self.assertEqual(self.successResultOf(results[0]), 'done')
+        self.assertEqual(self.names(), ['a', 'b', 'c'])
+
+    def test_per_key_limit(self):
+        self.scheduler.submit('a', 0, self.call, 'a1')
+        self.scheduler.submit('a', 0, self.call, 'a2')
+        self.scheduler.submit('b', 0, self.call, 'b1')
+        self.assertEqual(self.names(), ['a1', 'b1'])
+        self.assertEqual(self.scheduler.stats()['queued_per_key'], {'a': 1})
+        self.calls[0][1].callback(None)
+        self.assertEqual(self.names(), ['a1', 'b1', 'a2'])
+
+    def test_priority(self):
+        self.scheduler.maxPerKey = None
+        self.scheduler.maxConcurrent = 1
+        self.scheduler.submit('a', 0, self.call, 'first')
+        self.scheduler.submit('a', 5, self.call, 'low')
+        self.scheduler.submit('b', 0, self.call, 'fifo1')
+        self.scheduler.submit('a', 0, self.call, 'fifo2')
+        self.scheduler.submit('b', -1, self.call, 'high')
+        while len(self.calls) < 5:
+            self.calls[-1][1].callback(None)
+        self.assertEqual(self.names(), ['first', 'high', 'fifo1', 'fifo2', 'low'])
+
+    def test_synchronous_backlog(self):
+        self.scheduler.maxPerKey = None
+        self.scheduler.maxConcurrent = 1
+        self.scheduler.submit('a', 0, self.call, 'first')
+        results = [self.scheduler.submit('a', 0, defer.succeed, i) for i in xrange(5000)]
+        self.calls[0][1].callback(None)
+        self.assertEqual([self.successResultOf(d) for d in results], range(5000))
+        self.assertEqual(self.scheduler.stats()['active'], 0)
+        self.assertEqual(self.scheduler.stats()['queued'], 0)
+
+    def test_failure(self):
+        d = self.scheduler.submit('a', 0, self.call, 'a')
+        self.calls[0][1].errback(ValueError())
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(self.scheduler.stats()['active'], 0)
+
+    def test_cancel_queued(self):
+        self.scheduler.submit('a', 0, self.call, 'a1')
+        d = self.scheduler.submit('a', 0, self.call, 'a2')
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['cancelled'], 1)
+        self.calls[0][1].callback(None)
+        self.assertEqual(self.names(), ['a1'])
+
+    def test_cancel_running(self):
+        cancelled = []
+        d = self.scheduler.submit('a', 0, defer.Deferred, cancelled.append)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(len(cancelled), 1)
+        self.assertEqual(self.scheduler.stats()['active'], 0)
+
+    def test_wait_time(self):
+        self.scheduler.submit('a', 0, self.call, 'a1')
+        self.scheduler.submit('a', 0, self.call, 'a2')
+        self.clock.advance(3)
+        self.calls[0][1].callback(None)
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['wait_seconds'], 3)
+        self.assertEqual(stats['max_wait_seconds'], 3)
+        self.assertEqual(stats['max_queued'], 1)
+
+
+class TestSchedulingAgent(unittest.TestCase):
+    def test_request(self):
+        stub = StubAgent()
+        agent = scheduler.SchedulingAgent(stub, maxConcurrent=10, maxPerHost=1, clock=task.Clock())
+        first = agent.get('http://a.example.com/1', stream=True)
+        agent.get('http://a.example.com/2')
+        agent.get('https://a.example.com/3')
+        self.assertEqual(stub.uris(), ['http://a.example.com/1', 'https://a.example.com/3'])
+        self.assertEqual(stub.requests[0][0], ('GET', 'http://a.example.com/1', None, None,
+                                               {'stream': True}))
+        stub.requests[0][1].callback('response')
+        self.assertEqual(self.successResultOf(first), 'response')
+        self.assertEqual(stub.uris()[-1], 'http://a.example.com/2')
+
+    def test_shared_scheduler(self):
+        shared = scheduler.RequestScheduler(maxConcurrent=1, clock=task.Clock())
+        stub = StubAgent()
+        scheduler.SchedulingAgent(stub, scheduler=shared).get('http://a/')
+        scheduler.SchedulingAgent(stub, scheduler=shared).get('http://b/')
+        self.assertEqual(stub.uris(), ['http://a/'])
+
+    def test_host_key(self):
+        self.assertEqual(scheduler.host_key('http://example.com/path'),
+                         ('http', 'example.com', 80))
+        self.assertEqual(scheduler.host_key('https://example.com:8443/'),
+                         ('https', 'example.com', 8443))
@@ -0,0 +1,247 @@
+import zlib
+
+from twisted.trial import unittest
+
+from twisted.internet import defer, task
+from twisted.python import failure
+from twisted.web.client import ResponseDone, ResponseFailed
+from twisted.test.proto_helpers import StringTransport
+
+from tx_clients.clients import stream
+from tx_clients.exceptions import ResponseTooLarge, TimeoutError
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class TestBodyStream(unittest.TestCase):
+    def setUp(self):
+        self.transport = StringTransport()
+        self.stream = stream.BodyStream(bufferSize=4)
+        self.stream.makeConnection(self.transport)
+
+    def finish(self):
+        self.stream.connectionLost(failure.Failure(ResponseDone()))
+
+    def test_read_buffered(self):
+        self.stream.dataReceived('foo')
+        self.finish()
+        self.assertEqual(self.successResultOf(self.stream.read()), 'foo')
+        self.assertEqual(self.successResultOf(self.stream.read()), '')
+
+    def test_read_waiting(self):
+        d = self.stream.read()
+        self.assertNoResult(d)
+        self.stream.dataReceived('foo')
+        self.assertEqual(self.successResultOf(d), 'foo')
+        d = self.stream.read()
+        self.finish()
+        self.assertEqual(self.successResultOf(d), '')
+
+    def test_read_failure(self):
+        d = self.stream.read()
+        self.stream.connectionLost(failure.Failure(ResponseFailed([])))
+        self.failureResultOf(d, ResponseFailed)
+        self.failureResultOf(self.stream.read(), ResponseFailed)
+
+    def test_read_backpressure(self):
+        self.stream.dataReceived('foo')
+        self.assertEqual(self.transport.producerState, 'producing')
+        self.stream.dataReceived('bar')
+        self.assertEqual(self.transport.producerState, 'paused')
+        self.assertEqual(self.successResultOf(self.stream.read()), 'foo')
+        self.assertEqual(self.transport.producerState, 'producing')
+
+    def test_each(self):
+        chunks = []
+        self.stream.dataReceived('foo')
+        d = self.stream.each(chunks.append)
+        self.stream.dataReceived('bar')
+        self.assertNoResult(d)
+        self.finish()
+        self.assertEqual(self.successResultOf(d), 6)
+        self.assertEqual(chunks, ['foo', 'bar'])
+
+    def test_each_backpressure(self):
+        chunks = []
+        waiting = []
+        def consume(chunk):
+            chunks.append(chunk)
+            waiting.append(defer.Deferred())
+            return waiting[-1]
+        d = self.stream.each(consume)
+        self.stream.dataReceived('foo')
+        self.assertEqual(self.transport.producerState, 'paused')
+        self.stream.dataReceived('bar')
+        self.finish()
+        self.assertEqual(chunks, ['foo'])
+        waiting[0].callback(None)
+        self.assertEqual(chunks, ['foo', 'bar'])
+        self.assertNoResult(d)
+        waiting[1].callback(None)
+        self.assertEqual(self.successResultOf(d), 6)
+
+    def test_each_consumer_failure(self):
+        def consume(chunk):
+            raise ValueError(chunk)
+        d = self.stream.each(consume)
+        self.stream.dataReceived('foo')
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(self.transport.producerState, 'stopped')
+
+    def test_max_body_size(self):
+        body = stream.BodyStream(maxBodySize=5)
+        body.makeConnection(self.transport)
+        d = body.read()
+        body.dataReceived('foo')
+        self.assertEqual(self.successResultOf(d), 'foo')
+        body.dataReceived('bar')
+        self.assertEqual(self.transport.producerState, 'stopped')
+        self.failureResultOf(body.read(), ResponseTooLarge)
+
+    def test_stop(self):
+        d = self.stream.read()
+        self.stream.stop()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.transport.producerState, 'stopped')
+
+    def test_cancel_each(self):
+        d = self.stream.each(lambda data: None)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.transport.producerState, 'stopped')
+
+    def test_idle_timeout(self):
+        clock = task.Clock()
+        body = stream.BodyStream(idleTimeout=5, clock=clock)
+        body.makeConnection(self.transport)
+        clock.advance(4)
+        body.dataReceived('foo')
+        clock.advance(4)
+        self.assertEqual(self.successResultOf(body.read()), 'foo')
+        d = body.read()
+        self.assertNoResult(d)
+        clock.advance(1)
+        self.failureResultOf(d, TimeoutError)
+        self.assertEqual(self.transport.producerState, 'stopped')
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_idle_timeout_paused(self):
+        clock = task.Clock()
+        body = stream.BodyStream(bufferSize=2, idleTimeout=5, clock=clock)
+        body.makeConnection(self.transport)
+        body.dataReceived('foo')
+        self.assertEqual(self.transport.producerState, 'paused')
+        clock.advance(10)
+        self.assertEqual(self.successResultOf(body.read()), 'foo')
+        body.connectionLost(failure.Failure(ResponseDone()))
+        self.assertEqual(self.successResultOf(body.read()), '')
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+def compress(data, wbits):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+
+class TestDecodingProtocol(unittest.TestCase):
+    def setUp(self):
+        self.transport = StringTransport()
+        self.stream = stream.BodyStream(bufferSize=2 ** 20)
+
+    def decode(self, encoding, **kwargs):
+        decoder = stream.DecodingProtocol(self.stream, encoding, **kwargs)
+        decoder.makeConnection(self.transport)
+        return decoder
+
+    def body(self):
+        chunks = []
+        d = self.stream.each(chunks.append)
+        d.addCallback(lambda _: ''.join(chunks))
+        return d
+
+    def test_gzip(self):
+        encoded = compress('foo' * 1000, 16 + zlib.MAX_WBITS)
+        decoder = self.decode('gzip')
+        d = self.body()
+        for index in range(0, len(encoded), 7):
+            decoder.dataReceived(encoded[index:index + 7])
+        decoder.connectionLost(failure.Failure(ResponseDone()))
+        self.assertEqual(self.successResultOf(d), 'foo' * 1000)
+        self.assertEqual((decoder.received, decoder.decoded), (len(encoded), 3000))
+
+    def test_deflate(self):
+        for wbits in (zlib.MAX_WBITS, -zlib.MAX_WBITS):
+            self.stream = stream.BodyStream()
+            decoder = self.decode('deflate')
+            d = self.body()
+            decoder.dataReceived(compress('foo', wbits))
+            decoder.connectionLost(failure.Failure(ResponseDone()))
+            self.assertEqual(self.successResultOf(d), 'foo')
+
+    def test_chunked_decode(self):
+        decoder = self.decode('gzip')
+        decoder.chunkSize = 4
+        chunks = []
+        self.stream.each(chunks.append)
+        decoder.dataReceived(compress('foobarbaz', 16 + zlib.MAX_WBITS))
+        self.assertEqual(chunks, ['foob', 'arba', 'z'])
+
+    def test_backpressure(self):
+        self.stream = stream.BodyStream(bufferSize=4)
+        decoder = self.decode('gzip')
+        decoder.chunkSize = 4
+        decoder.dataReceived(compress('foobarbaz', 16 + zlib.MAX_WBITS))
+        decoder.connectionLost(failure.Failure(ResponseDone()))
+        # Decompression stops while the consumer is paused.
+        self.assertEqual(self.transport.producerState, 'paused')
+        self.assertEqual(decoder.decoded, 8)
+        self.assertFalse(self.stream.finished)
+        self.assertEqual(self.successResultOf(self.body()), 'foobarbaz')
+        self.assertTrue(self.stream.finished)
+
+    def test_too_large(self):
+        decoder = self.decode('gzip', maxDecodedSize=2 ** 16)
+        d = self.body()
+        decoder.dataReceived(compress('\0' * 2 ** 24, 16 + zlib.MAX_WBITS))
+        self.failureResultOf(d, ResponseTooLarge)
+        self.assertEqual(self.transport.producerState, 'stopped')
+        self.assertTrue(decoder.decoded <= 2 ** 17)
+
+    def test_brotli(self):
+        if 'br' not in stream.DECODERS:
+            raise unittest.SkipTest('brotli 1.2 or later is not installed')
+        encoded = brotli.compress('foo' * 100000)
+        decoder = self.decode('br')
+        decoder.chunkSize = 2 ** 12
+        chunks = []
+        d = self.stream.each(chunks.append)
+        for index in range(0, len(encoded), 7):
+            decoder.dataReceived(encoded[index:index + 7])
+        decoder.connectionLost(failure.Failure(ResponseDone()))
+        self.successResultOf(d)
+        self.assertEqual(''.join(chunks), 'foo' * 100000)
+        self.assertTrue(max(len(chunk) for chunk in chunks) <= 2 ** 15)
+
+    def test_brotli_too_large(self):
+        if 'br' not in stream.DECODERS:
+            raise unittest.SkipTest('brotli 1.2 or later is not installed')
+        # 64 MiB of zeros compress to a few bytes, delivered in a single chunk
+        encoded = brotli.compress('\0' * 2 ** 26, quality=5)
+        self.assertTrue(len(encoded) < 2 ** 12)
+        decoder = self.decode('br', maxDecodedSize=2 ** 16)
+        d = self.body()
+        decoder.dataReceived(encoded)
+        self.failureResultOf(d, ResponseTooLarge)
+        self.assertEqual(self.transport.producerState, 'stopped')
+        self.assertTrue(decoder.decoded <= 2 ** 16 + 2 ** 17)
+
+    def test_invalid(self):
+        decoder = self.decode('gzip')
+        d = self.body()
+        decoder.dataReceived('not gzip')
+        self.failureResultOf(d, ResponseFailed)
+        self.assertEqual(self.transport.producerState, 'stopped')
+
@@ -0,0 +1,139 @@
+import gc
+import weakref
+
+from OpenSSL import SSL, crypto
+
+from twisted.trial import unittest
+
+from twisted.internet import protocol, reactor, ssl, task
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from twisted.test import iosim
+
+from tx_clients.clients import http, tls
+
+
+_certificate = []
+
+
+def certificate():
+    """ A self-signed certificate for localhost, created once """
+    if not _certificate:
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, 2048)
+        cert = crypto.X509()
+        cert.get_subject().CN = 'localhost'
+        cert.add_extensions([crypto.X509Extension(b'subjectAltName', False, b'DNS:localhost')])
+        cert.set_serial_number(1)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(3600)
+        cert.set_issuer(cert.get_subject())
+        cert.set_pubkey(key)
+        cert.sign(key, 'sha256')
+        _certificate.append(ssl.PrivateCertificate.fromCertificateAndKeyPair(
+            ssl.Certificate(cert), ssl.KeyPair(key)
+        ))
+    return _certificate[0]
+
+
+class Recorder(protocol.Protocol):
+    def __init__(self):
+        self.lost = None
+
+    def connectionLost(self, reason):
+        self.lost = reason
+
+
+class TestCachingPolicy(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.certificate = certificate()
+        self.policy = tls.CachingPolicyForHTTPS(
+            trustRoot=ssl.Certificate(self.certificate.original), clock=self.clock
+        )
+        self.serverOptions = ssl.CertificateOptions(
+            privateKey=self.certificate.privateKey.original,
+            certificate=self.certificate.original
+        )
+
+    def connect(self, hostname='localhost'):
+        """ Handshake with the server in memory, returns the client protocol """
+        client = Recorder()
+        creator = self.policy.creatorForNetloc(hostname, 443)
+        iosim.connectedServerAndClient(
+            lambda: TLSMemoryBIOFactory(
+                self.serverOptions, False, protocol.Factory.forProtocol(protocol.Protocol)
+            ).buildProtocol(None),
+            lambda: TLSMemoryBIOFactory(
+                creator, True, protocol.Factory.forProtocol(lambda: client)
+            ).buildProtocol(None),
+        )
+        return client
+
+    def test_resumed(self):
+        self.assertIsNone(self.connect().lost)
+        self.assertIsNone(self.connect().lost)
+        stats = self.policy.stats()
+        self.assertEqual((stats['handshakes'], stats['resumed'], stats['resumption_rate']),
+                         (2, 1, 0.5))
+        self.assertEqual(stats['latency']['count'], 2)
+
+    def test_session_kept(self):
+        creator = self.policy.creatorForNetloc('localhost', 443)
+        connection = weakref.ref(self.connect().transport._tlsConnection)
+        self.assertIsInstance(creator.session, SSL.Session)
+        gc.collect()
+        self.assertIsNone(connection())
+
+    def test_session_reused_unavailable(self):
+        self.patch(tls, '_lib', None)
+        self.connect()
+        self.connect()
+        self.assertEqual(self.policy.stats()['resumed'], 0)
+
+    def test_shared_context(self):
+        first = self.policy.creatorForNetloc('localhost', 443).clientConnectionForTLS(None)
+        second = self.policy.creatorForNetloc('example.com', 443).clientConnectionForTLS(None)
+        self.assertIs(first.get_context(), second.get_context())
+
+    def test_verification_cached(self):
+        self.connect()
+        self.connect()
+        stats = self.policy.stats()
+        self.assertEqual((stats['verifications'], stats['verify_cache_hits']), (1, 1))
+        self.clock.advance(self.policy.verifyTTL)
+        self.connect()
+        self.assertEqual(self.policy.stats()['verifications'], 2)
+
+    def test_wrong_hostname(self):
+        self.assertIsNone(self.connect().lost)
+        client = self.connect('example.com')
+        self.assertIsNotNone(client.lost)
+        self.assertIsNone(self.policy.creatorForNetloc('example.com', 443).session)
+        self.assertEqual(self.policy.stats()['verify_cache_hits'], 0)
+
+    def test_ip_address(self):
+        self.assertIsNotNone(self.connect('127.0.0.1').lost)
+
+    def test_untrusted(self):
+        self.policy = tls.CachingPolicyForHTTPS(trustRoot=ssl.OpenSSLDefaultPaths(),
+                                                clock=self.clock)
+        self.assertIsNotNone(self.connect().lost)
+        self.assertEqual(self.policy.stats()['verifications'], 0)
+
+    def test_max_hosts(self):
+        self.policy.maxHosts = 2
+        first = self.policy.creatorForNetloc('a.example.com', 443)
+        self.policy.creatorForNetloc('b.example.com', 443)
+        self.assertIs(self.policy.creatorForNetloc('a.example.com', 443), first)
+        self.policy.creatorForNetloc('c.example.com', 443)
+        self.assertEqual(self.policy.stats()['hosts'], 2)
+        self.assertIs(self.policy.creatorForNetloc('a.example.com', 443), first)
+        self.assertEqual(list(self.policy._creators),
+                         [('c.example.com', 443), ('a.example.com', 443)])
+
+
+class TestBasicAgentTLS(unittest.TestCase):
+    def test_shared_policy(self):
+        self.assertIs(tls.shared_tls_policy(reactor), tls.shared_tls_policy(reactor))
+        agent = http.BasicAgent(reactor)
+        self.assertIs(agent._endpointFactory._policyForHTTPS, tls.shared_tls_policy(reactor))
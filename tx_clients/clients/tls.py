@@ -0,0 +1,243 @@
+# pylint: disable=protected-access, too-many-instance-attributes
+"""
+A caching TLS policy for the agents. See: CachingPolicyForHTTPS
+
+twisted.web.client.BrowserLikePolicyForHTTPS builds and loads the trust
+root into a new OpenSSL context for every connection and never resumes a
+session, so every connection pays for a full handshake and a full
+verification of the certificate.
+"""
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+
+from OpenSSL import SSL
+from service_identity import VerificationError
+from service_identity.pyopenssl import verify_hostname
+from zope.interface import implementer
+
+from twisted import logger
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from twisted.internet.ssl import CertificateOptions, platformTrust
+from twisted.python import failure
+from twisted.web import client
+
+from tx_clients.clients.metrics import Histogram
+
+
+log = logger.Logger()
+
+try:
+    from OpenSSL._util import lib as _lib
+except ImportError:
+    _lib = None
+
+
+def _session_reused(connection):
+    """
+    Returns True when the handshake of connection resumed a session.
+    pyOpenSSL has no public API for it so the binding is used when available.
+    """
+    try:
+        return bool(_lib.SSL_session_reused(connection._ssl))
+    except AttributeError:
+        return False
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class _ClientCreator(object):
+    """ Creates the TLS connections to one host:port of a CachingPolicyForHTTPS """
+    def __init__(self, policy, hostname):
+        self.policy = policy
+        self.hostname = hostname
+        self.hostnameASCII = hostname.decode('ascii')
+        self.indicateName = not (isIPAddress(hostname) or isIPv6Address(hostname))
+        # The SSL.Session of the most recent verified connection
+        self.session = None
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = SSL.Connection(self.policy._context(), None)
+        connection.set_app_data(tlsProtocol)
+        if self.indicateName:
+            connection.set_tlsext_host_name(self.hostname)
+        if self.session is not None:
+            connection.set_session(self.session)
+        self.policy._handshakeStarted(connection, self)
+        return connection
+
+
+class CachingPolicyForHTTPS(client.BrowserLikePolicyForHTTPS):
+    """ See: twisted.web.client.BrowserLikePolicyForHTTPS
+
+    Verifies certificates like BrowserLikePolicyForHTTPS and:
+
+    - Builds one OpenSSL context which every connection shares
+    - Resumes TLS sessions. The next connection to a host:port offers the
+      session of the previous one, with session tickets or a session id.
+      Resumed handshakes skip the key exchange and chain verification.
+    - Caches the hostname verification of a certificate for verifyTTL seconds
+    - Keeps sessions for up to maxHosts host:port, the oldest are evicted first
+
+    Handshakes, resumption rate and handshake latency can be inspected with
+    stats()
+
+    Usage:
+        policy = CachingPolicyForHTTPS()
+        agent = BasicAgent(reactor, contextFactory=policy)
+        print policy.stats()
+    """
+    acceptableProtocols = None
+    verifyTTL = 300
+    maxHosts = 1000
+
+    def __init__(self, trustRoot=None, clock=None, verifyTTL=None, maxHosts=None):
+        """
+        trustRoot: See: twisted.internet.ssl.optionsForClientTLS. By default
+            the trust store of the platform.
+        clock: See: twisted.internet.interfaces.IReactorTime
+        verifyTTL: Seconds the hostname verification of a certificate is cached
+        maxHosts: Maximum number of host:port with a cached session
+        Options which are None use the class defaults.
+        """
+        client.BrowserLikePolicyForHTTPS.__init__(self, trustRoot)
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._clock = clock
+        if verifyTTL is not None:
+            self.verifyTTL = verifyTTL
+        if maxHosts is not None:
+            self.maxHosts = maxHosts
+        self._options = None
+        self._creators = OrderedDict()
+        self._verified = OrderedDict()
+        self._started = WeakKeyDictionary()
+        self.latency = Histogram()
+        self.handshakes = 0
+        self.resumed = 0
+        self.verifications = 0
+        self.verifyHits = 0
+
+    def creatorForNetloc(self, hostname, port):
+        key = (hostname, port)
+        creator = self._creators.pop(key, None)
+        if creator is None:
+            creator = _ClientCreator(self, hostname)
+        self._creators[key] = creator
+        while len(self._creators) > self.maxHosts:
+            self._creators.popitem(False)
+        return creator
+
+    def _context(self):
+        if self._options is None:
+            trustRoot = self._trustRoot if self._trustRoot is not None else platformTrust()
+            self._options = CertificateOptions(
+                trustRoot=trustRoot, enableSessionTickets=True,
+                acceptableProtocols=self.acceptableProtocols
+            )
+            self._options.getContext().set_info_callback(self._infoCallback)
+        return self._options.getContext()
+
+    def _handshakeStarted(self, connection, creator):
+        self._started[connection] = [creator, self._clock.seconds()]
+
+    def _infoCallback(self, connection, where, ret):
+        if where == SSL.SSL_CB_CONNECT_EXIT:
+            self._sessionChanged(connection)
+            return
+        if not where & SSL.SSL_CB_HANDSHAKE_DONE:
+            return
+        try:
+            self._handshakeDone(connection)
+        except Exception:  # pylint: disable=broad-except
+            reason = failure.Failure()
+            log.failure('Failed to complete the TLS handshake', reason)
+            self._failVerification(connection, reason)
+
+    def _failVerification(self, connection, reason):
+        # The session of the connection is never offered.
+        self._started.pop(connection, None)
+        connection.get_app_data().failVerification(reason)
+
+    def _sessionChanged(self, connection):
+        """
+        Keep the session of a verified connection for the next connection to
+        the host. TLS 1.3 tickets arrive after the handshake so the session is
+        read again each time the client state machine exits.
+        """
+        entry = self._started.get(connection)
+        if entry is None or entry[1] is not None:
+            return
+        session = connection.get_session()
+        if session is not None:
+            entry[0].session = session
+
+    def _handshakeDone(self, connection):
+        entry = self._started[connection]
+        creator, started = entry
+        now = self._clock.seconds()
+        self.handshakes += 1
+        if started is not None:
+            # A renegotiation is counted but not timed.
+            entry[1] = None
+            self.latency.record(now - started)
+        if _session_reused(connection):
+            self.resumed += 1
+        certificate = connection.get_peer_certificate()
+        key = None
+        if certificate is not None:
+            key = (creator.hostname, certificate.digest('sha256'))
+            expires = self._verified.get(key)
+            if expires is not None and expires > now:
+                self.verifyHits += 1
+                return
+        self.verifications += 1
+        try:
+            verify_hostname(connection, creator.hostnameASCII)
+        except (VerificationError, ValueError):
+            # ValueError: The hostname is not a valid DNS name, such as an IP
+            self._failVerification(connection, failure.Failure())
+            return
+        if key is None:
+            return
+        self._verified.pop(key, None)
+        self._verified[key] = now + self.verifyTTL
+        while len(self._verified) > self.maxHosts:
+            self._verified.popitem(False)
+
+    def stats(self):
+        """
+        Returns a dictionary describing the TLS handshakes of the policy.
+
+        handshakes: Completed handshakes
+        resumed: Handshakes which resumed a session
+        resumption_rate: The fraction of handshakes which resumed a session
+        verifications: Hostname verifications of a certificate
+        verify_cache_hits: Handshakes which reused a cached verification
+        hosts: host:port with a cached session
+        latency: Seconds per handshake. See: Histogram.stats
+        """
+        return {
+            'handshakes': self.handshakes,
+            'resumed': self.resumed,
+            'resumption_rate': (
+                float(self.resumed) / self.handshakes if self.handshakes else None
+            ),
+            'verifications': self.verifications,
+            'verify_cache_hits': self.verifyHits,
+            'hosts': len(self._creators),
+            'latency': self.latency.stats(),
+        }
+
+
+_shared_policies = {}
+
+
+def shared_tls_policy(reactor):
+    """
+    Returns the CachingPolicyForHTTPS shared by every agent using the reactor.
+    The policy is created on first use.
+    """
+    policy = _shared_policies.get(reactor)
+    if policy is None:
+        policy = _shared_policies[reactor] = CachingPolicyForHTTPS(clock=reactor)
+    return policy
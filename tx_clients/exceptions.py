@@ -19,3 +19,20 @@ class ServerError(Exception):
     Problem happening on the server.
     """
 
+
+class ResponseTooLarge(ResponseError):
+    """
+    The response body exceeded the maximum size accepted by the client.
+    """
+
+
+class CircuitOpenError(ServerError):
+    """
+    The request was not sent because the circuit breaker for the host is open.
+    """
+
+
+class QueueFull(ClientError):
+    """
+    The work was not queued because too many calls are waiting for a thread.
+    """
@@ -0,0 +1,110 @@
+"""
+A registry of json codecs.
+
+The stdlib json module is always available and is the default codec. Faster
+serializers are registered when they are installed and may be selected by
+name or made the default with set_default_codec. They do not produce the same
+bytes as json, ujson escapes "/" for instance, and can not encode
+incrementally, so they are only used when asked for.
+
+Codecs which provide iterencode can encode a document incrementally. Codecs
+without it encode the whole document in a single call to dumps.
+
+Usage:
+    codec = get_codec()
+    codec = get_codec('json')
+    encoded = codec.dumps(value)
+"""
+import json
+from collections import OrderedDict
+
+
+class JSONCodec(object):
+    """
+    A json serializer.
+
+    name: The name the codec is registered under
+    dumps: Callable which encodes a value to a str
+    loads: Callable which decodes a str
+    iterencode: Callable which returns an iterable of encoded fragments or None
+    """
+    def __init__(self, name, dumps, loads, iterencode=None):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+        self.iterencode = iterencode
+
+    def __repr__(self):
+        return '<JSONCodec {}>'.format(self.name)
+
+
+def _json_iterencode(value):
+    return json.JSONEncoder().iterencode(value)
+
+
+def _simplejson_iterencode(value):
+    import simplejson
+    return simplejson.JSONEncoder().iterencode(value)
+
+
+_codecs = OrderedDict()
+_default = []
+
+
+def register_codec(codec, default=False):
+    """ Register a JSONCodec. A codec registered with default=True becomes the default """
+    _codecs[codec.name] = codec
+    if default:
+        set_default_codec(codec.name)
+
+
+def set_default_codec(name):
+    """ Set the codec returned by get_codec() when no codec is requested """
+    _default[:] = [get_codec(name)]
+
+
+def available_codecs():
+    """ Returns the names of the registered codecs """
+    return _codecs.keys()
+
+
+def get_codec(codec=None):
+    """
+    Returns a JSONCodec.
+
+    codec: The name of a registered codec, a JSONCodec or None for the default
+    codec. Raises KeyError for a codec which is not registered.
+    """
+    if isinstance(codec, JSONCodec):
+        return codec
+    if codec is None:
+        return _default[0]
+    return _codecs[codec]
+
+
+def _register_installed_codecs():
+    """ Register the installed serializers. The stdlib json is the default """
+    register_codec(JSONCodec('json', json.dumps, json.loads, _json_iterencode), default=True)
+    try:
+        import simplejson
+    except ImportError:
+        pass
+    else:
+        register_codec(
+            JSONCodec('simplejson', simplejson.dumps, simplejson.loads, _simplejson_iterencode)
+        )
+    try:
+        import ujson
+    except ImportError:
+        pass
+    else:
+        register_codec(JSONCodec('ujson', ujson.dumps, ujson.loads))
+    try:
+        import orjson
+    except ImportError:
+        pass
+    else:
+        register_codec(JSONCodec('orjson', orjson.dumps, orjson.loads))
+
+
+_register_installed_codecs()
@@ -3,15 +3,95 @@ import wrapt
 
 from twisted import logger
 from twisted.internet import task
+from twisted.web.http import stringToDatetime
 
 log = logger.Logger()
 
 
+class RetryBudget(object):
+    """
+    A token bucket which limits how often calls may be retried. A retry spends
+    a token and tokens are refilled at refillRate per second up to capacity.
+    Share a budget between the Retry decorators of every call to a service so
+    an outage can not multiply the load on the service.
+
+    Usage:
+        budget = RetryBudget(capacity=20, refillRate=2)
+        get = Retry(3, (TimeoutError,), budget=budget)(agent.get)
+        post = Retry(3, (TimeoutError,), budget=budget)(agent.post)
+    """
+    clock = None
+
+    def __init__(self, capacity=10, refillRate=1.0, clock=None):
+        """
+        capacity: Maximum number of tokens, the largest burst of retries
+        refillRate: Tokens added per second
+        clock: See: twisted.internet.interfaces.IReactorTime
+        """
+        self.capacity = capacity
+        self.refillRate = refillRate
+        if clock is not None:
+            self.clock = clock
+        self.tokens = float(capacity)
+        self.withdrawn = 0
+        self.exhausted = 0
+        self._updated = None
+
+    def withdraw(self):
+        """ Spend a token. Returns False when the budget is exhausted """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.withdrawn += 1
+            return True
+        self.exhausted += 1
+        return False
+
+    def stats(self):
+        """
+        Returns a dictionary describing the budget.
+
+        tokens: Retries currently available
+        withdrawn: Retries allowed
+        exhausted: Retries refused because the budget was empty
+        """
+        self._refill()
+        return {
+            'tokens': self.tokens,
+            'withdrawn': self.withdrawn,
+            'exhausted': self.exhausted,
+        }
+
+    def _refill(self):
+        if self.clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+        now = self.clock.seconds()
+        if self._updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.refillRate)
+        self._updated = now
+
+
+class RetryableResponse(Exception):
+    """ A response with a status code which is retried. See: Retry.retryCodes """
+    def __init__(self, response):
+        Exception.__init__(self, response.code)
+        self.response = response
+
+
 class Retry(object):
     """
     A general purpose class decorator to retry a function which returns a
     deferred. Retry attempts use an exponential backoff algorithm.
 
+    Responses with a status code in retryCodes are retried like a handled
+    exception. The delay before retrying such a response is at least the
+    delay requested by its Retry-After header. When no attempts remain the
+    last response is returned.
+
+    Retries stop early once the deadline would be exceeded or when the budget
+    has no tokens left.
+
     @ivar factor: A multiplicitive factor by which the delay grows
     @ivar jitter: Percentage of randomness to introduce into the delay length
         to prevent stampeding.
@@ -34,7 +114,8 @@ class Retry(object):
     clock = None
     _wrapped = None
 
-    def __init__(self, maxRetries, handled_exceptions, maxDelay=300, initialDelay=0.5):
+    def __init__(self, maxRetries, handled_exceptions, maxDelay=300, initialDelay=0.5,
+                 deadline=None, budget=None, retryCodes=()):
         """
         Creates Retry object
 
@@ -46,12 +127,24 @@ class Retry(object):
         maxRetries: Maximum number of consecutive unsuccessful connection
             attempts, after which no further connection attempts will be made. If
             this is not explicitly set, no maximum is applied.
+        deadline: Maximum number of seconds from the first attempt to the
+            start of the last retry. None is unbounded.
+        budget: A RetryBudget which every retry spends a token from
+        retryCodes: Status codes of responses which are retried, e.g. (429, 502, 503)
         """
 
         self.maxRetries = maxRetries
         self.handled_exceptions = handled_exceptions
         self.maxDelay = maxDelay
         self.initialDelay = initialDelay
+        self.deadline = deadline
+        self.budget = budget
+        self.retryCodes = frozenset(retryCodes)
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.budget_exhausted = 0
+        self.deadline_exceeded = 0
 
     @wrapt.decorator()
     def __call__(self, wrapped, instance, args, kwargs):
@@ -60,41 +153,118 @@ class Retry(object):
         """
 
         self._wrapped = wrapped
-        d = wrapped(*args, **kwargs)
+        self.calls += 1
+        started = self._clock().seconds()
+        d = self._attempt(wrapped, args, kwargs)
 
         delay = random.normalvariate(
             self.initialDelay,
             self.initialDelay * self.jitter
         )
-        d.addErrback(self.retry, 1, delay, *args, **kwargs)
+        d.addErrback(self._retry, wrapped, started, 1, delay, args, kwargs)
+        d.addErrback(self._ebRetryableResponse)
         return d
 
     def retry(self, failure, iteration, delay, *args, **kwargs):
         """
         Have this command connect again, after a suitable delay.
         """
+        started = self._clock().seconds()
+        return self._retry(failure, self._wrapped, started, iteration, delay, args, kwargs)
 
+    def stats(self):
+        """
+        Returns a dictionary describing the work done by the decorator.
+
+        calls: Calls of the decorated function
+        attempts: Attempts including retries
+        retries: Attempts which were retries
+        budget_exhausted: Retries skipped because the budget was empty
+        deadline_exceeded: Retries skipped because of the deadline
+        """
+        return {
+            'calls': self.calls,
+            'attempts': self.attempts,
+            'retries': self.retries,
+            'budget_exhausted': self.budget_exhausted,
+            'deadline_exceeded': self.deadline_exceeded,
+        }
+
+    def _clock(self):
+        if self.clock is None:
+            from twisted.internet import reactor
+            self.clock = reactor
+        return self.clock
+
+    def _attempt(self, wrapped, args, kwargs):
+        self.attempts += 1
+        d = wrapped(*args, **kwargs)
+        if self.retryCodes:
+            d.addCallback(self._cbCheckCode)
+        return d
+
+    def _cbCheckCode(self, response):
+        if getattr(response, 'code', None) in self.retryCodes:
+            raise RetryableResponse(response)
+        return response
+
+    def _ebRetryableResponse(self, failure):
+        """ Returns the last response when it could not be retried """
+        failure.trap(RetryableResponse)
+        return failure.value.response
+
+    def _retryAfter(self, failure):
+        """ Returns the seconds requested by a Retry-After header or None """
+        if not failure.check(RetryableResponse):
+            return None
+        headers = failure.value.response.headers
+        value = headers.getRawHeaders('Retry-After', [None])[0] if headers else None
+        if value is None:
+            return None
+        try:
+            return max(int(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max(stringToDatetime(value) - self._clock().seconds(), 0)
+        except ValueError:
+            return None
+
+    def _retry(self, failure, wrapped, started, iteration, delay, args, kwargs):
         # Trap hanlded exceptions
-        t = failure.trap(*self.handled_exceptions)
+        t = failure.trap(RetryableResponse, *self.handled_exceptions)
 
-        if t not in self.handled_exceptions:
+        if t is not RetryableResponse and t not in self.handled_exceptions:
             # Short circuit when the failure is not handled.
             return failure
 
+        retryAfter = self._retryAfter(failure)
+        if retryAfter is not None:
+            delay = max(delay, retryAfter)
+
+        clock = self._clock()
+        if self.deadline is not None and clock.seconds() + delay - started > self.deadline:
+            self.deadline_exceeded += 1
+            log.warn("Not retrying function {} the deadline would be exceeded".format(wrapped))
+            return failure
+
+        if self.budget is not None and not self.budget.withdraw():
+            self.budget_exhausted += 1
+            log.warn("Not retrying function {} the retry budget is exhausted".format(wrapped))
+            return failure
+
+        self.retries += 1
         if self.noisy:
             log.info(
                 "Retrying function {} in {} seconds {}/{}".format(
-                    self._wrapped,
+                    wrapped,
                     delay,
                     iteration,
                     self.maxRetries
                 )
             )
 
-        if self.clock is None:
-            from twisted.internet import reactor
-            self.clock = reactor
-        _new_attempt = task.deferLater(self.clock, delay, self._wrapped, *args, **kwargs)
+        _new_attempt = task.deferLater(clock, delay, self._attempt, wrapped, args, kwargs)
 
         if iteration < self.maxRetries:
             delay = min(delay * self.factor, self.maxDelay)
@@ -103,7 +273,8 @@ class Retry(object):
                     delay,
                     delay * self.jitter
                 )
-            _new_attempt.addErrback(self.retry, iteration + 1, delay, *args, **kwargs)
+            _new_attempt.addErrback(
+                self._retry, wrapped, started, iteration + 1, delay, args, kwargs
+            )
 
         return _new_attempt
-
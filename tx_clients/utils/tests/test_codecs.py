@@ -0,0 +1,43 @@
+import json
+
+from twisted.trial import unittest
+
+from tx_clients.utils import codecs
+
+
+def dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+class TestCodecs(unittest.TestCase):
+    def setUp(self):
+        self.patch(codecs, '_codecs', codecs._codecs.copy())
+        self.patch(codecs, '_default', list(codecs._default))
+        self.codec = codecs.JSONCodec('compact', dumps, json.loads)
+
+    def test_stdlib_codec(self):
+        codec = codecs.get_codec('json')
+        self.assertEqual(codec.dumps({'a': 1}), '{"a": 1}')
+        self.assertEqual(codec.loads('{"a": 1}'), {u'a': 1})
+        self.assertEqual(''.join(codec.iterencode([1, 2])), '[1, 2]')
+
+    def test_default_codec(self):
+        self.assertIn('json', codecs.available_codecs())
+        self.assertEqual(codecs.get_codec().name, 'json')
+
+    def test_register_codec(self):
+        codecs.register_codec(self.codec)
+        self.assertIs(codecs.get_codec('compact'), self.codec)
+        self.assertIsNot(codecs.get_codec(), self.codec)
+
+    def test_register_default_codec(self):
+        codecs.register_codec(self.codec, default=True)
+        self.assertIs(codecs.get_codec(), self.codec)
+        codecs.set_default_codec('json')
+        self.assertEqual(codecs.get_codec().name, 'json')
+
+    def test_get_codec_instance(self):
+        self.assertIs(codecs.get_codec(self.codec), self.codec)
+
+    def test_unknown_codec(self):
+        self.assertRaises(KeyError, codecs.get_codec, 'unknown')
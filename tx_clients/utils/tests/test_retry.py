@@ -1,6 +1,7 @@
 from twisted.trial import unittest
 from twisted.internet import defer
 from twisted.internet import task
+from twisted.web.http_headers import Headers
 
 from tx_clients.utils import retry
 from tx_clients.exceptions import TimeoutError
@@ -57,3 +58,116 @@ for succeed_after in xrange(MAX_RETRIES+1, MAX_RETRIES+2):
         _fail_after_test_case_factory(succeed_after)
     )
 
+
+
+class Response(object):
+    def __init__(self, code, retryAfter=None):
+        self.code = code
+        self.headers = Headers()
+        if retryAfter is not None:
+            self.headers.addRawHeader('Retry-After', retryAfter)
+
+
+class RetryPolicyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.results = []
+        self.called = []
+
+    def function(self, *args):
+        self.called.append((self.clock.seconds(), args))
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            return defer.fail(result)
+        return defer.succeed(result)
+
+    def decorate(self, **kwargs):
+        decorator = retry.Retry(MAX_RETRIES, (TimeoutError,), **kwargs)
+        decorator.clock = self.clock
+        decorator.jitter = 0
+        decorator.noisy = False
+        return decorator
+
+    def test_retry_codes(self):
+        decorator = self.decorate(retryCodes=(503,))
+        self.results = [Response(503), Response(200)]
+        d = decorator(self.function)('a')
+        self.clock.advance(1)
+        self.assertEqual(self.successResultOf(d).code, 200)
+        self.assertEqual([args for _, args in self.called], [('a',), ('a',)])
+        self.assertEqual(decorator.stats(), {
+            'calls': 1, 'attempts': 2, 'retries': 1, 'budget_exhausted': 0, 'deadline_exceeded': 0
+        })
+
+    def test_retry_codes_exhausted(self):
+        decorator = self.decorate(retryCodes=(503,))
+        decorator.maxRetries = 1
+        self.results = [Response(503), Response(503)]
+        d = decorator(self.function)()
+        self.clock.advance(1)
+        self.assertEqual(self.successResultOf(d).code, 503)
+        self.assertEqual(len(self.called), 2)
+
+    def test_retry_after(self):
+        decorator = self.decorate(retryCodes=(429,))
+        self.results = [Response(429, '10'), Response(200)]
+        d = decorator(self.function)()
+        self.clock.advance(9)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.assertEqual(self.successResultOf(d).code, 200)
+
+    def test_retry_after_date(self):
+        decorator = self.decorate(retryCodes=(503,))
+        self.clock.advance(1000000000)
+        self.results = [Response(503, 'Sun, 09 Sep 2001 01:47:00 GMT'), Response(200)]
+        d = decorator(self.function)()
+        self.clock.advance(19)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.successResultOf(d)
+
+    def test_deadline(self):
+        decorator = self.decorate(deadline=2, initialDelay=1)
+        decorator.factor = 2
+        self.results = [TimeoutError(), TimeoutError(), TimeoutError()]
+        d = decorator(self.function)()
+        self.clock.advance(1)
+        self.failureResultOf(d, TimeoutError)
+        self.assertEqual(len(self.called), 2)
+        self.assertEqual(decorator.deadline_exceeded, 1)
+        self.assertFalse(self.clock.calls)
+
+    def test_deadline_retry_after(self):
+        decorator = self.decorate(deadline=5, retryCodes=(503,))
+        self.results = [Response(503, '60')]
+        d = decorator(self.function)()
+        self.assertEqual(self.successResultOf(d).code, 503)
+        self.assertEqual(decorator.deadline_exceeded, 1)
+
+    def test_budget(self):
+        budget = retry.RetryBudget(capacity=1, refillRate=0.1, clock=self.clock)
+        first = self.decorate(budget=budget)
+        second = self.decorate(budget=budget)
+        self.results = [TimeoutError(), 'ok', TimeoutError()]
+        d = first(self.function)()
+        self.clock.advance(1)
+        self.assertEqual(self.successResultOf(d), 'ok')
+        d = second(self.function)()
+        self.failureResultOf(d, TimeoutError)
+        self.assertEqual(second.budget_exhausted, 1)
+        self.assertEqual(budget.stats()['exhausted'], 1)
+        self.clock.advance(10)
+        self.assertEqual(budget.stats()['tokens'], 1)
+
+    def test_shared_decorator(self):
+        decorator = self.decorate()
+        def other():
+            self.called.append('other')
+            return defer.succeed('other')
+        self.results = [TimeoutError(), 'ok']
+        d = decorator(self.function)('a')
+        decorator(other)()
+        self.clock.advance(1)
+        self.assertEqual(self.successResultOf(d), 'ok')
+        self.assertEqual(self.called[1:], ['other', (1, ('a',))])
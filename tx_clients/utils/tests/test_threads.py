@@ -0,0 +1,88 @@
+from twisted.trial import unittest
+
+from tx_clients.exceptions import QueueFull
+from tx_clients.utils import threads
+
+
+class SynchronousReactor(object):
+    """ Delivers results from the thread pool immediately """
+    def __init__(self):
+        self.triggers = []
+
+    def callFromThread(self, fn, *args, **kwargs):
+        fn(*args, **kwargs)
+
+    def addSystemEventTrigger(self, phase, event, fn):
+        self.triggers.append((phase, event, fn))
+
+
+class ManualThreadPool(object):
+    """ A thread pool which runs calls when told to. See: twisted.python.threadpool.ThreadPool """
+    def __init__(self):
+        self.started = False
+        self.calls = []
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+    def callInThreadWithCallback(self, onResult, fn, *args, **kwargs):
+        self.calls.append((onResult, fn, args, kwargs))
+
+    def runAll(self):
+        while self.calls:
+            onResult, fn, args, kwargs = self.calls.pop(0)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:  # pylint: disable=broad-except
+                onResult(False, e)
+            else:
+                onResult(True, result)
+
+
+def codec_pool(**kwargs):
+    reactor = SynchronousReactor()
+    pool = ManualThreadPool()
+    return threads.CodecThreadPool(reactor, pool=pool, **kwargs), reactor, pool
+
+
+class TestCodecThreadPool(unittest.TestCase):
+    def test_run(self):
+        codec, reactor, pool = codec_pool()
+        d = codec.run(lambda x: x * 2, 21)
+        self.assertTrue(pool.started)
+        self.assertEqual(reactor.triggers, [('during', 'shutdown', codec.stop)])
+        self.assertNoResult(d)
+        pool.runAll()
+        self.assertEqual(self.successResultOf(d), 42)
+        stats = codec.stats()
+        self.assertEqual(stats['submitted'], 1)
+        self.assertEqual(stats['completed'], 1)
+        self.assertEqual(stats['pending'], 0)
+        self.assertTrue(stats['seconds'] >= stats['max_seconds'] >= 0)
+        codec.stop()
+        self.assertFalse(pool.started)
+
+    def test_run_failure(self):
+        codec, _, pool = codec_pool()
+        d = codec.run(int, 'foo')
+        pool.runAll()
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(codec.stats()['failed'], 1)
+
+    def test_bounded_queue(self):
+        codec, _, pool = codec_pool(maxThreads=1, maxPending=1)
+        first = codec.run(str, 1)
+        second = codec.run(str, 2)
+        third = codec.run(str, 3)
+        self.failureResultOf(third, QueueFull)
+        stats = codec.stats()
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(stats['pending'], 1)
+        pool.runAll()
+        pool.runAll()
+        self.assertEqual(self.successResultOf(first), '1')
+        self.assertEqual(self.successResultOf(second), '2')
+        self.assertEqual(codec.stats()['completed'], 2)
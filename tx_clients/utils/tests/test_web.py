@@ -0,0 +1,453 @@
+import cStringIO
+import json
+import zlib
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.web import client
+from twisted.test.proto_helpers import StringTransport
+
+from tx_clients.utils import codecs, web
+from tx_clients.utils.codecs import JSONCodec
+from tx_clients.utils.tests.test_codecs import dumps
+from tx_clients.utils.tests.test_threads import codec_pool
+
+
+class ManualCooperator(task.Cooperator):
+    """ A cooperator which runs one iteration of each task per tick """
+    def __init__(self):
+        self.scheduled = []
+        task.Cooperator.__init__(
+            self,
+            terminationPredicateFactory=lambda: lambda: True,
+            scheduler=self.scheduled.append
+        )
+
+    def tick(self):
+        self.scheduled.pop(0)()
+
+    def run(self):
+        while self.scheduled:
+            self.tick()
+
+
+class CountingTransport(StringTransport):
+    def __init__(self):
+        StringTransport.__init__(self)
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        StringTransport.write(self, data)
+
+
+class TestStringBodyProducer(unittest.TestCase):
+    def test_small_body(self):
+        consumer = CountingTransport()
+        producer = web.StringBodyProducer('foo')
+        self.assertEqual(producer.length, 3)
+        self.successResultOf(producer.startProducing(consumer))
+        self.assertEqual(consumer.value(), 'foo')
+        self.assertEqual(consumer.writes, 1)
+
+    def test_large_body(self):
+        cooperator = ManualCooperator()
+        consumer = CountingTransport()
+        body = 'a' * (web.StringBodyProducer.smallBodySize + 1)
+        producer = web.StringBodyProducer(body, cooperator=cooperator, readSize=2 ** 15)
+        self.assertEqual(producer.length, len(body))
+        d = producer.startProducing(consumer)
+        cooperator.run()
+        self.successResultOf(d)
+        self.assertEqual(consumer.value(), body)
+        self.assertEqual(consumer.writes, 3)
+
+
+class TestLargeFileBodyProducer(unittest.TestCase):
+    def setUp(self):
+        self.cooperator = ManualCooperator()
+        self.consumer = CountingTransport()
+        self.body = ''.join(chr(i % 256) for i in range(10000))
+        self.path = self.mktemp()
+        with open(self.path, 'wb') as fd:
+            fd.write(self.body)
+
+    def producer(self, inputFile, readSize=4096):
+        return web.LargeFileBodyProducer(inputFile, cooperator=self.cooperator, readSize=readSize)
+
+    def produce(self, producer):
+        d = producer.startProducing(self.consumer)
+        self.cooperator.run()
+        self.successResultOf(d)
+
+    def test_file(self):
+        inputFile = open(self.path, 'rb')
+        producer = self.producer(inputFile)
+        self.assertEqual(producer.length, len(self.body))
+        self.produce(producer)
+        self.assertEqual(self.consumer.value(), self.body)
+        self.assertEqual(self.consumer.writes, 3)
+        self.assertTrue(inputFile.closed)
+
+    def test_file_position(self):
+        inputFile = open(self.path, 'rb')
+        inputFile.seek(5000)
+        producer = self.producer(inputFile)
+        self.assertEqual(producer.length, 5000)
+        self.produce(producer)
+        self.assertEqual(self.consumer.value(), self.body[5000:])
+
+    def test_empty_file(self):
+        path = self.mktemp()
+        open(path, 'wb').close()
+        producer = self.producer(open(path, 'rb'))
+        self.assertEqual(producer.length, 0)
+        self.produce(producer)
+        self.assertEqual(self.consumer.value(), '')
+
+    def test_file_like(self):
+        producer = self.producer(cStringIO.StringIO(self.body))
+        self.assertEqual(producer.length, len(self.body))
+        self.produce(producer)
+        self.assertEqual(self.consumer.value(), self.body)
+
+    def test_pause_stop(self):
+        inputFile = open(self.path, 'rb')
+        producer = self.producer(inputFile)
+        d = producer.startProducing(self.consumer)
+        self.cooperator.tick()
+        producer.pauseProducing()
+        self.cooperator.tick()
+        self.assertEqual(self.consumer.writes, 1)
+        producer.stopProducing()
+        self.cooperator.run()
+        self.assertNoResult(d)
+        self.assertEqual(self.consumer.writes, 1)
+        self.assertTrue(inputFile.closed)
+
+
+class TestJSONBodyProducer(unittest.TestCase):
+    def setUp(self):
+        self.patch(codecs, '_default', [codecs.get_codec('json')])
+        self.body = {'items': [{'id': i, 'name': 'item %d' % i} for i in range(100)]}
+        self.cooperator = ManualCooperator()
+        self.consumer = CountingTransport()
+
+    def producer(self, **kwargs):
+        kwargs.setdefault('smallBodySize', 0)
+        return web.JSONBodyProducer(self.body, cooperator=self.cooperator, **kwargs)
+
+    def test_produce(self):
+        producer = self.producer()
+        self.assertEqual(producer.length, client.UNKNOWN_LENGTH)
+        d = producer.startProducing(self.consumer)
+        self.cooperator.run()
+        self.successResultOf(d)
+        self.assertEqual(json.loads(self.consumer.value()), self.body)
+        self.assertEqual(self.consumer.writes, 1)
+
+    def test_small_body(self):
+        producer = self.producer(smallBodySize=2 ** 14)
+        encoded = json.dumps(self.body)
+        self.assertEqual(producer.length, len(encoded))
+        d = producer.startProducing(self.consumer)
+        self.successResultOf(d)
+        self.assertFalse(self.cooperator.scheduled)
+        self.assertEqual(self.consumer.value(), encoded)
+        self.assertEqual(self.consumer.writes, 1)
+        producer.pauseProducing()
+        producer.resumeProducing()
+        producer.stopProducing()
+
+    def test_unserializable_body(self):
+        self.body = {'items': [object()]}
+        for smallBodySize in (0, 2 ** 14):
+            producer = self.producer(smallBodySize=smallBodySize)
+            d = producer.startProducing(self.consumer)
+            self.cooperator.run()
+            self.failureResultOf(d, TypeError)
+
+    def test_small_body_threshold(self):
+        size = len(json.dumps(self.body))
+        self.assertEqual(self.producer(smallBodySize=size).length, size)
+        self.assertEqual(self.producer(smallBodySize=size - 1).length, client.UNKNOWN_LENGTH)
+
+    def test_codec(self):
+        codec = JSONCodec('compact', dumps, json.loads)
+        producer = self.producer(codec=codec, smallBodySize=2 ** 14)
+        self.assertEqual(producer.length, len(dumps(self.body)))
+        self.successResultOf(producer.startProducing(self.consumer))
+        self.assertEqual(self.consumer.value(), dumps(self.body))
+
+    def test_codec_large_body(self):
+        codec = JSONCodec('compact', dumps, json.loads)
+        producer = self.producer(codec=codec, chunkSize=100)
+        self.assertEqual(producer.length, len(dumps(self.body)))
+        d = producer.startProducing(self.consumer)
+        self.assertEqual(self.consumer.writes, 0)
+        self.cooperator.tick()
+        self.assertEqual(self.consumer.writes, 1)
+        self.cooperator.run()
+        self.successResultOf(d)
+        self.assertEqual(self.consumer.value(), dumps(self.body))
+        self.assertEqual(self.consumer.writes, (len(dumps(self.body)) + 99) / 100)
+
+    def test_codec_thread_pool(self):
+        codec, _, pool = codec_pool()
+        producer = self.producer(codec=JSONCodec('compact', dumps, json.loads), threadPool=codec)
+        self.assertEqual(producer.length, client.UNKNOWN_LENGTH)
+        d = producer.startProducing(self.consumer)
+        pool.runAll()
+        self.cooperator.run()
+        self.successResultOf(d)
+        self.assertEqual(self.consumer.value(), dumps(self.body))
+
+    def test_chunk_size(self):
+        producer = self.producer(chunkSize=100)
+        d = producer.startProducing(self.consumer)
+        self.cooperator.run()
+        self.successResultOf(d)
+        value = self.consumer.value()
+        self.assertEqual(json.loads(value), self.body)
+        self.assertTrue(self.consumer.writes > 1)
+        self.assertTrue(self.consumer.writes <= len(value) / 100 + 1)
+
+    def test_chunks_per_slice(self):
+        producer = self.producer(chunkSize=100, chunksPerSlice=5)
+        producer.startProducing(self.consumer)
+        self.cooperator.tick()
+        self.assertEqual(self.consumer.writes, 5)
+
+    def test_pause_resume(self):
+        producer = self.producer(chunkSize=100)
+        d = producer.startProducing(self.consumer)
+        self.cooperator.tick()
+        writes = self.consumer.writes
+        producer.pauseProducing()
+        self.cooperator.run()
+        self.assertEqual(self.consumer.writes, writes)
+        producer.resumeProducing()
+        self.cooperator.run()
+        self.successResultOf(d)
+        self.assertEqual(json.loads(self.consumer.value()), self.body)
+
+    def test_thread_pool(self):
+        codec, _, pool = codec_pool()
+        producer = self.producer(chunkSize=100, threadPool=codec)
+        d = producer.startProducing(self.consumer)
+        self.assertEqual(self.consumer.writes, 0)
+        pool.runAll()
+        self.cooperator.run()
+        self.successResultOf(d)
+        self.assertEqual(json.loads(self.consumer.value()), self.body)
+        self.assertEqual(codec.stats()['completed'], 1)
+
+    def test_thread_pool_paused(self):
+        codec, _, pool = codec_pool()
+        producer = self.producer(chunkSize=100, threadPool=codec)
+        d = producer.startProducing(self.consumer)
+        producer.pauseProducing()
+        pool.runAll()
+        self.cooperator.run()
+        self.assertEqual(self.consumer.writes, 0)
+        producer.resumeProducing()
+        self.cooperator.run()
+        self.successResultOf(d)
+
+    def test_thread_pool_stopped(self):
+        codec, _, pool = codec_pool()
+        producer = self.producer(threadPool=codec)
+        d = producer.startProducing(self.consumer)
+        producer.stopProducing()
+        pool.runAll()
+        self.assertNoResult(d)
+        self.assertEqual(self.consumer.value(), '')
+
+    def test_thread_pool_not_encoded_eagerly(self):
+        codec, _, pool = codec_pool()
+        producer = self.producer(smallBodySize=2 ** 14, threadPool=codec)
+        self.assertEqual(producer.length, client.UNKNOWN_LENGTH)
+        self.assertIsNone(producer._prefix)
+        d = producer.startProducing(self.consumer)
+        self.assertEqual(len(pool.calls), 1)
+        pool.runAll()
+        self.cooperator.run()
+        self.successResultOf(d)
+        self.assertEqual(json.loads(self.consumer.value()), self.body)
+
+
+class TestAsyncJSON(unittest.TestCase):
+    def setUp(self):
+        self.patch(codecs, '_default', [codecs.get_codec('json')])
+
+    def test_produce(self):
+        body = [{'id': i} for i in range(100)]
+        cooperator = ManualCooperator()
+        consumer = CountingTransport()
+        producer = web.AsyncJSON(body, cooperator=cooperator, chunkSize=64)
+        d = producer.beginProducing(consumer)
+        self.assertEqual(consumer.producer, producer)
+        cooperator.run()
+        self.successResultOf(d)
+        self.assertEqual(consumer.producer, None)
+        self.assertEqual(json.loads(consumer.value()), body)
+        self.assertTrue(consumer.writes > 1)
+
+    def test_thread_pool(self):
+        body = [{'id': i} for i in range(100)]
+        codec, _, pool = codec_pool()
+        cooperator = ManualCooperator()
+        consumer = CountingTransport()
+        producer = web.AsyncJSON(body, cooperator=cooperator, smallBodySize=100, threadPool=codec)
+        d = producer.beginProducing(consumer)
+        pool.runAll()
+        cooperator.run()
+        self.successResultOf(d)
+        self.assertEqual(consumer.producer, None)
+        self.assertEqual(json.loads(consumer.value()), body)
+        self.assertEqual(codec.stats()['completed'], 1)
+
+    def test_codec(self):
+        body = [{'id': i} for i in range(100)]
+        cooperator = ManualCooperator()
+        consumer = CountingTransport()
+        codec = JSONCodec('compact', dumps, json.loads)
+        producer = web.AsyncJSON(body, cooperator=cooperator, chunkSize=64, codec=codec)
+        d = producer.beginProducing(consumer)
+        cooperator.run()
+        self.successResultOf(d)
+        self.assertEqual(consumer.value(), dumps(body))
+        self.assertTrue(consumer.writes > 1)
+
+    def test_thread_pool_small_value(self):
+        codec, _, pool = codec_pool()
+        cooperator = ManualCooperator()
+        consumer = CountingTransport()
+        producer = web.AsyncJSON({'a': 1}, cooperator=cooperator, threadPool=codec)
+        d = producer.beginProducing(consumer)
+        cooperator.run()
+        self.successResultOf(d)
+        self.assertFalse(pool.calls)
+        self.assertEqual(consumer.value(), '{"a": 1}')
+
+
+class TestGzipBodyProducer(unittest.TestCase):
+    def setUp(self):
+        self.cooperator = ManualCooperator()
+        self.consumer = CountingTransport()
+        self.body = ''.join('line %d\n' % i for i in range(20000))
+        self.inner = web.StringBodyProducer(self.body, cooperator=self.cooperator, readSize=2 ** 15)
+        self.producer = web.GzipBodyProducer(self.inner, level=1)
+
+    def decompress(self, data):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+    def test_produce(self):
+        self.assertEqual(self.producer.length, client.UNKNOWN_LENGTH)
+        d = self.producer.startProducing(self.consumer)
+        self.cooperator.run()
+        self.successResultOf(d)
+        self.assertEqual(self.decompress(self.consumer.value()), self.body)
+        self.assertEqual(self.producer.received, len(self.body))
+        self.assertEqual(self.producer.sent, len(self.consumer.value()))
+        self.assertTrue(self.producer.sent < len(self.body) / 4)
+
+    def test_small_body(self):
+        producer = web.GzipBodyProducer(web.StringBodyProducer('foo'))
+        self.successResultOf(producer.startProducing(self.consumer))
+        self.assertEqual(self.decompress(self.consumer.value()), 'foo')
+
+    def test_pause_resume(self):
+        d = self.producer.startProducing(self.consumer)
+        self.cooperator.tick()
+        received = self.producer.received
+        self.producer.pauseProducing()
+        self.cooperator.tick()
+        self.assertEqual(self.producer.received, received)
+        self.producer.resumeProducing()
+        self.cooperator.run()
+        self.successResultOf(d)
+        self.assertEqual(self.decompress(self.consumer.value()), self.body)
+
+    def test_stop(self):
+        d = self.producer.startProducing(self.consumer)
+        self.cooperator.tick()
+        self.producer.stopProducing()
+        sent = self.producer.sent
+        self.cooperator.run()
+        # See: twisted.web.client.FileBodyProducer.stopProducing
+        self.assertNoResult(d)
+        self.assertEqual(self.producer.sent, sent)
+        self.assertTrue(self.producer.received < len(self.body))
+
+
+class TestJSONStreamDecoder(unittest.TestCase):
+    def setUp(self):
+        self.records = []
+
+    def decode(self, chunks, ndjson=False):
+        decoder = web.JSONStreamDecoder(self.records.append, ndjson)
+        for chunk in chunks:
+            decoder.feed(chunk)
+        decoder.close()
+        return decoder
+
+    def test_array(self):
+        self.decode(['[1, "a", {"b": [2, 3]}, null]'])
+        self.assertEqual(self.records, [1, u'a', {u'b': [2, 3]}, None])
+
+    def test_array_chunked_bytewise(self):
+        document = ' [ {"a": "x,]}\\" y"}, [1, [2]], 12345 , true ] '
+        decoder = self.decode(list(document))
+        self.assertEqual(self.records, [{u'a': u'x,]}" y'}, [1, [2]], 12345, True])
+        self.assertEqual(decoder.records, 4)
+
+    def test_array_records_fire_when_complete(self):
+        decoder = web.JSONStreamDecoder(self.records.append)
+        decoder.feed('[{"a": 1}, {"b"')
+        self.assertEqual(self.records, [{u'a': 1}])
+        decoder.feed(': 2}')
+        self.assertEqual(self.records, [{u'a': 1}])
+        decoder.feed(']')
+        self.assertEqual(self.records, [{u'a': 1}, {u'b': 2}])
+
+    def test_array_discards_decoded_records(self):
+        decoder = web.JSONStreamDecoder(self.records.append)
+        decoder.feed('[' + '"aaaaaaaa",' * 100 + '"b')
+        self.assertEqual(len(self.records), 100)
+        self.assertTrue(len(decoder._buffer) < 10)
+
+    def test_empty_array(self):
+        self.decode(['[', ' ]'])
+        self.assertEqual(self.records, [])
+
+    def test_incomplete_array(self):
+        decoder = web.JSONStreamDecoder(self.records.append)
+        decoder.feed('[1, 2')
+        self.assertRaises(ValueError, decoder.close)
+
+    def test_value(self):
+        self.decode(['{"a": ', '[1, 2]}'])
+        self.assertEqual(self.records, [{u'a': [1, 2]}])
+
+    def test_ndjson(self):
+        self.decode(['{"a": 1}\n{"b"', ': 2}\n\n3'], ndjson=True)
+        self.assertEqual(self.records, [{u'a': 1}, {u'b': 2}, 3])
+
+    def test_codec(self):
+        loaded = []
+        def loads(data):
+            loaded.append(data)
+            return json.loads(data)
+        decoder = web.JSONStreamDecoder(self.records.append, codec=JSONCodec('x', dumps, loads))
+        decoder.feed('[1, 2]')
+        self.assertEqual(loaded, ['1', ' 2'])
+
+    def test_invalid(self):
+        decoder = web.JSONStreamDecoder(self.records.append)
+        self.assertRaises(ValueError, decoder.feed, '[1, {"a" 2}]')
+
+    def test_empty_element(self):
+        for data in ('[1,,2]', '[,1]', '[1, ]', '[,]'):
+            decoder = web.JSONStreamDecoder(self.records.append)
+            self.assertRaises(ValueError, decoder.feed, data)
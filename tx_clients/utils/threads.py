@@ -0,0 +1,124 @@
+import time
+
+from twisted.internet import defer, threads
+from twisted.python import failure, threadpool
+
+from tx_clients.exceptions import QueueFull
+
+
+class CodecThreadPool(object):
+    """
+    Runs cpu bound work such as encoding or decoding large json documents in a
+    thread pool instead of on the reactor thread.
+
+    At most maxPending calls wait for a thread. Once the queue is full calls
+    fail with QueueFull, the work is never run on the reactor thread.
+
+    The work MUST NOT touch objects which may be modified by the reactor thread
+    while it runs.
+
+    Usage:
+        pool = CodecThreadPool(reactor)
+        d = pool.run(json.dumps, document)
+    """
+    def __init__(self, reactor=None, minThreads=1, maxThreads=4, maxPending=16, pool=None):
+        """
+        reactor: The reactor which results are delivered to
+        minThreads: See: twisted.python.threadpool.ThreadPool
+        maxThreads: See: twisted.python.threadpool.ThreadPool
+        maxPending: Maximum number of calls waiting for a thread
+        pool: A twisted.python.threadpool.ThreadPool. One is created by default.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.maxPending = maxPending
+        self._pool = pool
+        if self._pool is None:
+            self._pool = threadpool.ThreadPool(minThreads, maxThreads, 'tx_clients.codec')
+        self._semaphore = defer.DeferredSemaphore(maxThreads)
+        self._started = False
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Returns a Deferred which fires with the result of fn(*args, **kwargs),
+        or fails with QueueFull when maxPending calls are waiting for a thread.
+        """
+        if len(self._semaphore.waiting) >= self.maxPending:
+            self.rejected += 1
+            return defer.fail(QueueFull(
+                '%d calls are waiting for a thread' % len(self._semaphore.waiting)
+            ))
+        self.submitted += 1
+        self._start()
+        d = self._semaphore.run(
+            threads.deferToThreadPool, self._reactor, self._pool, self._timed, fn, *args, **kwargs
+        )
+        d.addCallbacks(self._cbCompleted, self._ebCompleted)
+        return d
+
+    def stats(self):
+        """
+        Returns a dictionary describing the work done by the pool.
+
+        submitted: Calls run in the thread pool
+        completed: Calls which returned a result
+        failed: Calls which raised an exception
+        rejected: Calls which failed with QueueFull
+        pending: Calls waiting for a thread
+        seconds: Total seconds spent running calls off the reactor thread
+        max_seconds: The longest single call
+        """
+        return {
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'pending': len(self._semaphore.waiting),
+            'seconds': self.seconds,
+            'max_seconds': self.max_seconds,
+        }
+
+    def stop(self):
+        """ Stop the thread pool. Called automatically when the reactor shuts down """
+        if self._started:
+            self._started = False
+            self._pool.stop()
+
+    def _start(self):
+        if not self._started:
+            self._started = True
+            self._pool.start()
+            self._reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def _timed(self, fn, *args, **kwargs):
+        start = time.time()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:  # pylint: disable=broad-except
+            result = failure.Failure()
+        return result, time.time() - start
+
+    def _record(self, elapsed):
+        self.seconds += elapsed
+        self.max_seconds = max(self.max_seconds, elapsed)
+
+    def _cbCompleted(self, timed):
+        result, elapsed = timed
+        self._record(elapsed)
+        if isinstance(result, failure.Failure):
+            self.failed += 1
+        else:
+            self.completed += 1
+        return result
+
+    def _ebCompleted(self, reason):
+        self.failed += 1
+        return reason
+
@@ -2,93 +2,565 @@
 
 import base64
 import cStringIO
-import json
+import itertools
+import mmap
+import os
+import re
+import stat
+import zlib
 
 from zope.interface import implements
 
 from twisted.web import client
 from twisted.web.iweb import IBodyProducer
-from twisted.internet.task import cooperate
+from twisted.internet import defer, task
+from twisted.python import failure
+
+from tx_clients.utils.codecs import get_codec
 
 
 class StringBodyProducer(client.FileBodyProducer):
-    """ See: twisted.web.client.FileBodyProducer """
+    """ See: twisted.web.client.FileBodyProducer
+
+    Strings of up to smallBodySize bytes are written to the consumer in a
+    single call instead of being read cooperatively.
+    """
+    smallBodySize = 2 ** 16
+    _task = None
+
     def __init__(self, string, *args, **kwargs):
         """ The FileBodyProducer accepts file like objects """
         client.FileBodyProducer.__init__(self, cStringIO.StringIO(string), *args, **kwargs)
 
+    def startProducing(self, consumer):
+        if self.length > self.smallBodySize:
+            return client.FileBodyProducer.startProducing(self, consumer)
+        consumer.write(self._inputFile.read())
+        self._inputFile.close()
+        return defer.succeed(None)
+
+    def stopProducing(self):
+        if self._task is None:
+            self._inputFile.close()
+            return
+        client.FileBodyProducer.stopProducing(self)
+
+    def pauseProducing(self):
+        if self._task is not None:
+            client.FileBodyProducer.pauseProducing(self)
+
+    def resumeProducing(self):
+        if self._task is not None:
+            client.FileBodyProducer.resumeProducing(self)
+
+
+class LargeFileBodyProducer(client.FileBodyProducer):
+    """ See: twisted.web.client.FileBodyProducer
+
+    Sends large files on disk in readSize blocks. Regular files are memory
+    mapped and written to the consumer in slices of the map which avoids the
+    read call and intermediate buffer per block. The length of the body is
+    the size of the file from fstat, less the current position, so the request
+    is sent with a content-length.
+
+    Objects which are not regular files, such as pipes or file like objects,
+    are read like twisted.web.client.FileBodyProducer reads them.
+    """
+    readSize = 2 ** 20
+
+    def __init__(self, inputFile, cooperator=task, readSize=None):
+        """
+        inputFile: A file or file like object
+        readSize: Number of bytes written to the consumer per cooperator iteration
+        """
+        if readSize is None:
+            readSize = self.readSize
+        client.FileBodyProducer.__init__(self, inputFile, cooperator, readSize)
+        self._map = None
+        self._offset = 0
+        try:
+            fileno = inputFile.fileno()
+        except (AttributeError, IOError, ValueError):
+            return
+        info = os.fstat(fileno)
+        if stat.S_ISREG(info.st_mode) and info.st_size:
+            self._offset = inputFile.tell()
+            self.length = max(info.st_size - self._offset, 0)
+            self._map = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+    def stopProducing(self):
+        self._closeMap()
+        client.FileBodyProducer.stopProducing(self)
+
+    def _closeMap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _writeloop(self, consumer):
+        if self._map is None:
+            for _ in client.FileBodyProducer._writeloop(self, consumer):
+                yield None
+            return
+        end = self._offset + self.length
+        for offset in xrange(self._offset, end, self._readSize):
+            if self._map is None:
+                return
+            consumer.write(self._map[offset:min(offset + self._readSize, end)])
+            yield None
+        self._closeMap()
+        self._inputFile.close()
+
+
+def _coalesce(fragments, size):
+    """ Joins an iterable of strings into chunks of at least size bytes """
+    buf = []
+    buffered = 0
+    for fragment in fragments:
+        buf.append(fragment)
+        buffered += len(fragment)
+        if buffered >= size:
+            yield ''.join(buf)
+            buf = []
+            buffered = 0
+    if buf:
+        yield ''.join(buf)
+
+
+def _slices(data, size):
+    """ Splits a string into chunks of size bytes """
+    for offset in xrange(0, len(data), size):
+        yield data[offset:offset + size]
+
+
+def _encode_prefix(codec, value, size):
+    """
+    Encode up to size bytes of value as json.
+
+    Returns a tuple of (encoded, prefix, fragments). When the whole document
+    fits encoded is the document and prefix and fragments are None. Otherwise
+    encoded is None, prefix is a list of the encoded fragments and fragments is
+    the iterator which produces the remainder of the document.
+
+    Codecs which can not encode incrementally always encode the whole document.
+    """
+    if codec.iterencode is None:
+        return codec.dumps(value), None, None
+    fragments = codec.iterencode(value)
+    prefix = []
+    encoded = 0
+    for fragment in fragments:
+        prefix.append(fragment)
+        encoded += len(fragment)
+        if encoded > size:
+            return None, prefix, fragments
+    return ''.join(prefix), None, None
+
+
+def _produce(chunks, consumer, chunksPerSlice):
+    """ Writes chunksPerSlice chunks to the consumer per cooperator iteration """
+    written = 0
+    for chunk in chunks:
+        consumer.write(chunk)
+        written += 1
+        if written % chunksPerSlice == 0:
+            yield None
+
 
 class JSONBodyProducer(object):
-    """ See: twisted.web.iweb.IBodyProducer """
+    """ See: twisted.web.iweb.IBodyProducer
+
+    Documents which encode to at most smallBodySize bytes are encoded when the
+    producer is created. Their length is known, which avoids chunked transfer
+    encoding, and they are written to the consumer in a single call.
+
+    Larger documents are encoded incrementally. The fragments produced by
+    json.JSONEncoder.iterencode are often only a few bytes long. They are
+    joined into chunks of chunkSize bytes before they are written to the
+    consumer. chunksPerSlice chunks are written each time the cooperator
+    schedules the producer.
+
+    When a threadPool is given documents are encoded by json.dumps in the
+    pool instead of on the reactor thread. They are not encoded eagerly so
+    their length is unknown. See: tx_clients.utils.threads.CodecThreadPool
+
+    The json serializer is selected with codec. Codecs which can not encode
+    incrementally encode the whole document when the producer is created, or
+    in the threadPool when one is given. Documents larger than smallBodySize
+    are still written in chunkSize slices. See: tx_clients.utils.codecs
+    """
     implements(IBodyProducer)
 
-    def __init__(self, body):
+    chunkSize = 2 ** 16
+    chunksPerSlice = 1
+    smallBodySize = 2 ** 14
+
+    def __init__(self, body, cooperator=task, chunkSize=None, chunksPerSlice=None,
+                 smallBodySize=None, threadPool=None, codec=None):
         self.body = body
+        self.threadPool = threadPool
+        self.codec = get_codec(codec)
         self.length = client.UNKNOWN_LENGTH
+        if chunkSize is not None:
+            self.chunkSize = chunkSize
+        if chunksPerSlice is not None:
+            self.chunksPerSlice = chunksPerSlice
+        if smallBodySize is not None:
+            self.smallBodySize = smallBodySize
+        self._cooperate = cooperator.cooperate
         self._consumer = None
         self._iterable = None
         self._task = None
+        self._paused = False
+        self._stopped = False
+        self._encoded = None
+        self._prefix = None
+        self._fragments = None
+        self._failure = None
+        self._encodeSmallBody()
+
+    def _encodeSmallBody(self):
+        """
+        Encode up to smallBodySize bytes of the body. When the whole body fits
+        its length becomes known. Otherwise the encoded prefix is kept so that
+        no encoding work is repeated when producing starts.
+        """
+        if self.threadPool is not None:
+            return
+        try:
+            self._encoded, self._prefix, self._fragments = _encode_prefix(
+                self.codec, self.body, self.smallBodySize
+            )
+        except Exception:  # pylint: disable=broad-except
+            # Bodies which can not be encoded fail in startProducing.
+            self._failure = failure.Failure()
+            return
+        if self._encoded is not None:
+            self.length = len(self._encoded)
 
     def startProducing(self, consumer):
         """ Must NOT call registerProducer on the consumer """
         self._consumer = consumer
-        self._iterable = json.JSONEncoder().iterencode(self.body)
-        self._task = cooperate(self._produce())
+        if self._failure is not None:
+            return defer.fail(self._failure)
+        if self._encoded is not None:
+            if len(self._encoded) > self.smallBodySize:
+                # Codecs without iterencode encode large documents in one piece.
+                return self._start(_slices(self._encoded, self.chunkSize))
+            consumer.write(self._encoded)
+            return defer.succeed(None)
+        if self.threadPool is not None:
+            d = self.threadPool.run(self.codec.dumps, self.body)
+            d.addCallback(self._cbEncoded)
+            return d
+        self._iterable = _coalesce(itertools.chain(self._prefix, self._fragments), self.chunkSize)
+        return self._start(self._iterable)
+
+    def _cbEncoded(self, encoded):
+        if self._stopped:
+            # See: twisted.web.client.FileBodyProducer.startProducing
+            return defer.Deferred()
+        return self._start(_slices(encoded, self.chunkSize))
+
+    def _start(self, chunks):
+        self._task = self._cooperate(_produce(chunks, self._consumer, self.chunksPerSlice))
+        if self._paused:
+            self._task.pause()
         d = self._task.whenDone()
         return d
 
     def pauseProducing(self):
-        self._task.pause()
+        self._paused = True
+        if self._task is not None:
+            self._task.pause()
 
     def resumeProducing(self):
-        self._task.resume()
+        self._paused = False
+        if self._task is not None:
+            self._task.resume()
 
     def stopProducing(self):
-        self._task.stop()
-
-    def _produce(self):
-        for chunk in self._iterable:
-            self._consumer.write(chunk)
-            yield None
+        self._stopped = True
+        if self._task is not None:
+            self._task.stop()
 
 
 class AsyncJSON(object):
-    """ See: twisted.internet.interfaces.IPushProducer """
-    def __init__(self, value):
+    """ See: twisted.internet.interfaces.IPushProducer
+
+    Fragments are joined into chunks of chunkSize bytes before they are
+    written. See: JSONBodyProducer
+
+    When a threadPool is given, values which encode to more than smallBodySize
+    bytes are encoded by json.dumps in the pool instead of on the reactor
+    thread. See: tx_clients.utils.threads.CodecThreadPool
+
+    The json serializer is selected with codec. See: tx_clients.utils.codecs
+    """
+    chunkSize = 2 ** 16
+    chunksPerSlice = 1
+    smallBodySize = 2 ** 14
+
+    def __init__(self, value, cooperator=task, chunkSize=None, chunksPerSlice=None,
+                 smallBodySize=None, threadPool=None, codec=None):
         self.value = value
+        self.threadPool = threadPool
+        self.codec = get_codec(codec)
+        if chunkSize is not None:
+            self.chunkSize = chunkSize
+        if chunksPerSlice is not None:
+            self.chunksPerSlice = chunksPerSlice
+        if smallBodySize is not None:
+            self.smallBodySize = smallBodySize
+        self._cooperate = cooperator.cooperate
         self._consumer = None
         self._iterable = None
         self._task = None
+        self._paused = False
+        self._stopped = False
 
     def beginProducing(self, consumer):
         """ See: twisted.internet.interfaces.IConsumer """
         self._consumer = consumer
-        self._iterable = json.JSONEncoder().iterencode(self.value)
         self._consumer.registerProducer(self, True)
-        self._task = cooperate(self._produce())
-        d = self._task.whenDone()
+        if self.threadPool is None:
+            if self.codec.iterencode is None:
+                self._iterable = _slices(self.codec.dumps(self.value), self.chunkSize)
+            else:
+                self._iterable = _coalesce(self.codec.iterencode(self.value), self.chunkSize)
+            d = self._start(self._iterable)
+        else:
+            encoded = None
+            if self.codec.iterencode is not None:
+                encoded, _, _ = _encode_prefix(self.codec, self.value, self.smallBodySize)
+            if encoded is not None:
+                d = self._start(iter([encoded]))
+            else:
+                d = self.threadPool.run(self.codec.dumps, self.value)
+                d.addCallback(self._cbEncoded)
         d.addBoth(self._unregister)
         return d
 
+    def _cbEncoded(self, encoded):
+        if self._stopped:
+            raise task.TaskStopped()
+        return self._start(_slices(encoded, self.chunkSize))
+
+    def _start(self, chunks):
+        self._task = self._cooperate(_produce(chunks, self._consumer, self.chunksPerSlice))
+        if self._paused:
+            self._task.pause()
+        return self._task.whenDone()
+
     def pauseProducing(self):
-        self._task.pause()
+        self._paused = True
+        if self._task is not None:
+            self._task.pause()
 
     def resumeProducing(self):
-        self._task.resume()
+        self._paused = False
+        if self._task is not None:
+            self._task.resume()
 
     def stopProducing(self):
-        self._task.stop()
-
-    def _produce(self):
-        for chunk in self._iterable:
-            self._consumer.write(chunk)
-            yield None
+        self._stopped = True
+        if self._task is not None:
+            self._task.stop()
 
     def _unregister(self, passthrough):
         self._consumer.unregisterProducer()
         return passthrough
 
 
+class GzipBodyProducer(object):
+    """ See: twisted.web.iweb.IBodyProducer
+
+    Compresses the body written by another IBodyProducer with gzip as it is
+    produced. Nothing is buffered beyond the compressor's window and pausing,
+    resuming and stopping are passed through to the wrapped producer.
+
+    The request MUST be sent with a "Content-Encoding: gzip" header. The length
+    of the compressed body is never known in advance so it is sent with
+    chunked transfer encoding.
+
+    received: Bytes written by the wrapped producer
+    sent: Compressed bytes written to the consumer
+
+    Usage:
+        producer = GzipBodyProducer(client.FileBodyProducer(fd), level=6)
+    """
+    implements(IBodyProducer)
+
+    level = 6
+
+    def __init__(self, producer, level=None):
+        """
+        producer: The twisted.web.iweb.IBodyProducer which writes the body
+        level: zlib compression level from 1 (fastest) to 9 (smallest)
+        """
+        if level is not None:
+            self.level = level
+        self.producer = producer
+        self.length = client.UNKNOWN_LENGTH
+        self.received = 0
+        self.sent = 0
+        self._compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._consumer = None
+        self._stopped = False
+
+    def startProducing(self, consumer):
+        self._consumer = consumer
+        d = self.producer.startProducing(self)
+        d.addCallback(self._cbFinished)
+        return d
+
+    def write(self, data):
+        """ See: twisted.internet.interfaces.IConsumer """
+        self.received += len(data)
+        self._write(self._compressor.compress(data))
+
+    def _write(self, data):
+        if data and not self._stopped:
+            self.sent += len(data)
+            self._consumer.write(data)
+
+    def _cbFinished(self, _):
+        self._write(self._compressor.flush())
+
+    def pauseProducing(self):
+        self.producer.pauseProducing()
+
+    def resumeProducing(self):
+        self.producer.resumeProducing()
+
+    def stopProducing(self):
+        self._stopped = True
+        self.producer.stopProducing()
+
+
+class JSONStreamDecoder(object):
+    """
+    Incrementally decodes a stream of json as the chunks arrive. Each complete
+    record is passed to callback as soon as its final byte has been fed.
+
+    - A top level array yields each element of the array
+    - ndjson (newline delimited json) yields each line
+    - Any other top level value is yielded once the stream is closed
+
+    Only the bytes of the record currently being received are buffered.
+
+    Usage:
+        decoder = JSONStreamDecoder(handle_record)
+        d = response.stream.each(decoder.feed)
+        d.addCallback(lambda _: decoder.close())
+    """
+    _outside = re.compile(r'[\[\]{}",]')
+    _inside = re.compile(r'["\\]')
+
+    def __init__(self, callback, ndjson=False, codec=None):
+        """
+        callback: Called with every decoded record.
+        ndjson: The stream contains one json document per line.
+        codec: The json codec used to decode records. See: tx_clients.utils.codecs
+        """
+        self.callback = callback
+        self.ndjson = ndjson
+        self.codec = get_codec(codec)
+        self.records = 0
+        self._buffer = ''
+        self._array = None
+        self._pos = 0
+        self._start = 0
+        self._depth = 0
+        self._inString = False
+        self._separated = False
+        self._done = False
+
+    def feed(self, data):
+        """ Decode the records completed by data """
+        self._buffer += data
+        if self.ndjson:
+            lines = self._buffer.split('\n')
+            self._buffer = lines.pop()
+            for line in lines:
+                self._decode(line)
+            return
+        if self._array is None:
+            stripped = self._buffer.lstrip()
+            if not stripped:
+                return
+            self._array = stripped[0] == '['
+        if self._array:
+            self._scan()
+
+    def close(self):
+        """ Decode any remaining record. Raises ValueError if the stream is incomplete """
+        if self.ndjson or not self._array:
+            self._decode(self._buffer)
+        elif not self._done or self._buffer[self._pos:].strip():
+            raise ValueError('Incomplete json array')
+        self._buffer = ''
+
+    def _scan(self):
+        buf = self._buffer
+        pos = self._pos
+        while not self._done:
+            if self._inString:
+                match = self._inside.search(buf, pos)
+                if match is None:
+                    pos = len(buf)
+                    break
+                if match.group() == '\\':
+                    if match.end() >= len(buf):
+                        pos = match.start()
+                        break
+                    pos = match.end() + 1
+                    continue
+                self._inString = False
+                pos = match.end()
+                continue
+            match = self._outside.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+            char = match.group()
+            pos = match.end()
+            if char == '"':
+                self._inString = True
+            elif char in '[{':
+                self._depth += 1
+                if self._depth == 1:
+                    self._start = pos
+            elif char in ']}':
+                self._depth -= 1
+                if self._depth == 0:
+                    # [] is empty but [1,] has an empty last element
+                    self._element(buf[self._start:match.start()], self._separated)
+                    self._done = True
+            elif self._depth == 1:
+                self._element(buf[self._start:match.start()], True)
+                self._separated = True
+                self._start = pos
+        # Discard the records which have already been decoded.
+        if self._done:
+            self._buffer = buf[pos:]
+            self._pos = 0
+        else:
+            self._buffer = buf[self._start:]
+            self._pos = pos - self._start
+            self._start = 0
+
+    def _element(self, data, required):
+        if required and not data.strip():
+            raise ValueError('Empty json array element')
+        self._decode(data)
+
+    def _decode(self, data):
+        if data.strip():
+            self.records += 1
+            self.callback(self.codec.loads(data))
+
+
 def generate_basic_authorization_string(user, password):
     # Basic Auth Credentials
     base64string = base64.encodestring('%s:%s' % (user, password))[:-1]